@@ -0,0 +1,60 @@
+"""Posts an import to a running application and reports analytics latency and worker memory.
+
+Usage: YB_APP_URL=http://0.0.0.0:8080 python -m benchmarks.bench_analytics_memory [number of citizens]
+
+Start the application with YB_TRACE_MEMORY=1 to get traced Python allocations as well.
+"""
+import os
+import random
+import sys
+import time
+
+import requests
+
+
+def get_citizens(n):
+    towns = [f"town {i}" for i in range(100)]
+    citizens = []
+    for i in range(n):
+        citizens.append({
+            "citizen_id": i,
+            "town": random.choice(towns),
+            "street": "street",
+            "building": "1",
+            "apartment": i,
+            "name": f"name {i}",
+            "birth_date": f"{random.randint(1, 28)}.{random.randint(1, 12)}.{random.randint(1900, 2018)}",
+            "gender": random.choice(["male", "female"]),
+            "relatives": []
+        })
+    # pair neighbours as relatives
+    for i in range(0, n - 1, 2):
+        citizens[i]['relatives'].append(i + 1)
+        citizens[i + 1]['relatives'].append(i)
+    return citizens
+
+
+def main():
+    server_api = os.getenv("YB_APP_URL", "http://0.0.0.0:8080")
+    # imports are stored as one document, so they have to fit into 16MB BSON limit
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    random.seed(0)
+
+    r = requests.post(f"{server_api}/imports", json={"citizens": get_citizens(n)})
+    assert r.status_code == 201, r.text
+    import_id = r.json()['data']['import_id']
+
+    for route in ("citizens/birthdays", "towns/stat/percentile/age"):
+        t = time.perf_counter()
+        r = requests.get(f"{server_api}/imports/{import_id}/{route}")
+        assert r.status_code == 200, r.text
+        print(f"{route}: {time.perf_counter() - t:.3f}s")
+
+    stats = requests.get(f"{server_api}/stats").json()['data']
+    for k, v in sorted(stats.items()):
+        if k.startswith("memory."):
+            print(f"{k}: {v}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""Compares posting small imports one by one with posting them in one `POST /imports/batch`.
+
+Usage: YB_APP_URL=http://0.0.0.0:8080 python -m benchmarks.bench_batch_imports [imports] [citizens per import]
+"""
+import os
+import sys
+import time
+
+import requests
+
+from tools.generate import Generator
+
+
+def main():
+    server_api = os.getenv("YB_APP_URL", "http://0.0.0.0:8080")
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    citizens = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    generator = Generator(seed=0)
+    imports = [{"citizens": list(generator.citizens(citizens))} for _ in range(n)]
+
+    session = requests.Session()
+
+    started = time.perf_counter()
+    for imp in imports:
+        r = session.post(f"{server_api}/imports", json=imp)
+        assert r.status_code == 201, r.text
+    one_by_one = time.perf_counter() - started
+
+    started = time.perf_counter()
+    r = session.post(f"{server_api}/imports/batch", json={"imports": imports})
+    assert r.status_code == 201, r.text
+    batch = time.perf_counter() - started
+
+    print(f"imports:    {n} x {citizens} citizens")
+    print(f"one by one: {one_by_one:.3f}s ({one_by_one / n * 1000:.1f}ms per import)")
+    print(f"batch:      {batch:.3f}s ({batch / n * 1000:.1f}ms per import, {one_by_one / batch:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Compares per-citizen age and month computation with the batch kernel from `dates`.
+
+Usage: python -m benchmarks.bench_dates [number of citizens]
+"""
+import datetime
+import random
+import sys
+import time
+
+from dates import parse_birth_dates, ages
+
+
+def per_citizen(dates, now):
+    result_ages, result_months = [], []
+    for date in dates:
+        d, m, year = date.split('.')
+        result_ages.append(now.year - int(year) - ((now.month, now.day) < (int(m), int(d))))
+        result_months.append(int(m))
+    return result_ages, result_months
+
+
+def batch(dates, now):
+    days, months, years = parse_birth_dates(dates)
+    return ages(days, months, years, now).tolist(), months.tolist()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    random.seed(0)
+    dates = [f"{random.randint(1, 28):02}.{random.randint(1, 12):02}.{random.randint(1900, 2018)}" for _ in range(n)]
+    now = datetime.datetime.utcnow()
+
+    # import numpy before measuring
+    batch(dates[:1], now)
+
+    t = time.perf_counter()
+    expected = per_citizen(dates, now)
+    loop_time = time.perf_counter() - t
+
+    t = time.perf_counter()
+    actual = batch(dates, now)
+    batch_time = time.perf_counter() - t
+
+    assert actual == expected
+
+    print(f"citizens:    {n}")
+    print(f"per-citizen: {loop_time:.3f}s")
+    print(f"batch:       {batch_time:.3f}s ({loop_time / batch_time:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Measures throughput and latency of writes with every durability profile.
+
+Usage: YB_APP_URL=http://0.0.0.0:8080 YB_TOKEN=... python -m benchmarks.bench_durability [citizens] [requests] [concurrency]
+
+Run it against an application connected to a replica set (see "Replica set" in README), with a standalone
+`mongod` majority and w=1 writes cost the same. The profile is chosen per request with `X-Durability` header,
+so the application has to know the same YB_TOKEN.
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from tools.generate import Generator, iter_json
+
+PROFILES = ("fast", "durable")
+
+
+def run(fn, n, concurrency):
+    """Calls fn(i) for i in range(n) from `concurrency` threads, returns total time and sorted latencies"""
+    def timed(i):
+        started = time.perf_counter()
+        fn(i)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = sorted(pool.map(timed, range(n)))
+    return time.perf_counter() - started, latencies
+
+
+def report(name, profile, elapsed, latencies):
+    def q(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000
+
+    print(f"{name:<8} {profile:<8} {len(latencies) / elapsed:8.1f} req/s  "
+          f"p50 {q(50):7.1f}ms  p99 {q(99):7.1f}ms")
+
+
+def main():
+    server_api = os.getenv("YB_APP_URL", "http://0.0.0.0:8080")
+    token = os.getenv('YB_TOKEN', '52ce8098-d510-4bbc-88b9-e1a733292786')
+    citizens = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+    body = ''.join(iter_json(Generator(seed=0).citizens(citizens))).encode('utf-8')
+
+    for profile in PROFILES:
+        headers = {"Content-Type": "application/json", "X-Durability": profile, "X-Token": token}
+        import_ids = []
+
+        def post(_):
+            r = requests.post(f"{server_api}/imports", data=body, headers=headers)
+            assert r.status_code == 201, r.text
+            import_ids.append(r.json()['data']['import_id'])
+
+        report("post", profile, *run(post, n, concurrency))
+
+        def patch(i):
+            r = requests.patch(f"{server_api}/imports/{import_ids[i % len(import_ids)]}/citizens/{1 + i % citizens}",
+                               json={"name": f"name {i}"}, headers=headers)
+            assert r.status_code == 200, r.text
+
+        report("patch", profile, *run(patch, n * 10, concurrency))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Compares the single-process `uvicorn main:app` with the production runtime (`gunicorn -c gunicorn.conf.py`).
+
+Usage: YB_MONGO_URL=mongodb://localhost:27017/ python -m benchmarks.bench_runtime [seconds] [clients] [citizens]
+
+Starts the application in each mode on port 8090, waits for `/ready`, then `clients` processes with keep-alive
+sessions send requests to one route at a time for `seconds`. The analytics cache is disabled, so every analytics
+request is computed. Run it on the host where the application runs in production, with MongoDB on another host,
+so the numbers include the cores the application would have.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import requests
+
+from tools.generate import Generator, iter_json
+
+HOST = "127.0.0.1"
+
+PORT = 8090
+
+MODES = {
+    "uvicorn": ["uvicorn", "--host", HOST, "--port", str(PORT), "main:app"],
+    "gunicorn": ["gunicorn", "-c", "gunicorn.conf.py", "--bind", f"{HOST}:{PORT}", "main:app"],
+}
+
+
+def routes(import_id, citizen_id, body):
+    """(name, method, path, body) of the measured requests"""
+    return [
+        ("ready", "GET", "/ready", None),
+        ("get_citizens", "GET", f"/imports/{import_id}/citizens", None),
+        ("get_age_stat", "GET", f"/imports/{import_id}/towns/stat/percentile/age", None),
+        ("patch_citizen", "PATCH", f"/imports/{import_id}/citizens/{citizen_id}", json.dumps({"name": "name"})),
+        ("post_imports", "POST", "/imports", body),
+    ]
+
+
+def client(method, url, body, seconds):
+    """Sends requests for `seconds`, returns latencies"""
+    session = requests.Session()
+    headers = {"Content-Type": "application/json"}
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while True:
+        started = time.perf_counter()
+        if started > deadline:
+            return latencies
+        r = session.request(method, url, data=body, headers=headers)
+        assert r.status_code in (200, 201), r.text
+        latencies.append(time.perf_counter() - started)
+
+
+def wait_ready(url, process):
+    for _ in range(300):
+        if process.poll() is not None:
+            raise RuntimeError(f"The application has exited with code {process.returncode}")
+        try:
+            if requests.get(f"{url}/ready").status_code == 200:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError("The application is not ready")
+
+
+def measure(mode, seconds, clients, citizens):
+    url = f"http://{HOST}:{PORT}"
+    env = dict(os.environ, YB_ANALYTICS_CACHE_SIZE="0", YB_ROUTE_LIMITS="")
+    process = subprocess.Popen(MODES[mode], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(url, process)
+        data = list(Generator(seed=0).citizens(citizens))
+        body = ''.join(iter_json(data))
+        r = requests.post(f"{url}/imports", data=body.encode('utf-8'), headers={"Content-Type": "application/json"})
+        assert r.status_code == 201, r.text
+        import_id = r.json()['data']['import_id']
+
+        with ProcessPoolExecutor(max_workers=clients) as pool:
+            for name, method, path, route_body in routes(import_id, data[0]['citizen_id'], body):
+                started = time.perf_counter()
+                futures = [pool.submit(client, method, url + path, route_body, seconds) for _ in range(clients)]
+                latencies = sorted(l for f in futures for l in f.result())
+                elapsed = time.perf_counter() - started
+
+                def q(p):
+                    return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000
+
+                print(f"{mode:<9} {name:<14} {len(latencies) / elapsed:9.1f} req/s  "
+                      f"p50 {q(50):8.1f}ms  p99 {q(99):8.1f}ms")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 2 * (os.cpu_count() or 1)
+    citizens = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+
+    for mode in MODES:
+        measure(mode, seconds, clients, citizens)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Measures overhead of tracing with sampling off on routes of the application.
+
+Usage: python -m benchmarks.bench_tracing [number of requests]
+
+Requests are sent directly to the ASGI application, without network and MongoDB, so only routes which do not
+query MongoDB are measured: `GET /ready`, `GET /stats` and `POST /imports` with 100 citizens, one of them invalid,
+which is parsed and validated and then rejected. Routes which query MongoDB spend more time in the handler, so
+their relative overhead is smaller. The baseline is the same application without tracing: without the middleware,
+with the handlers not wrapped by `traced` and with `span` replaced by a function returning a no-op context manager.
+"""
+import asyncio
+import gc
+import json
+import sys
+import time
+
+from tools.generate import Generator
+
+import main
+import tracing
+
+
+def routes():
+    citizens = list(Generator(seed=0).citizens(100))
+    citizens[-1]['town'] = ''
+    body = json.dumps({"citizens": citizens}).encode('utf-8')
+    return [
+        ("ready", "GET", "/ready", b"", 200),
+        ("stats", "GET", "/stats", b"", 200),
+        ("post_imports", "POST", "/imports", body, 400),
+    ]
+
+
+class Switch:
+    """Turns tracing of main.app off and on again"""
+
+    def __init__(self):
+        self.middleware = main.app.error_middleware
+        self.traced = self.middleware.app
+        assert isinstance(self.traced, tracing.TracingMiddleware)
+        self.dependants = [r.dependant for r in main.app.routes if hasattr(r, 'dependant')]
+        self.calls = [d.call for d in self.dependants]
+
+    def set(self, on):
+        self.middleware.app = self.traced if on else self.traced.app
+        for dependant, call in zip(self.dependants, self.calls):
+            dependant.call = call if on else getattr(call, '__wrapped__', call)
+        main.span = tracing.span if on else (lambda name, **tags: tracing.NOOP_SPAN)
+
+
+async def run(method, path, body, status, n):
+    scope = {
+        "type": "http", "http_version": "1.1", "method": method, "path": path, "root_path": "",
+        "scheme": "http", "query_string": b"", "server": ("test", 80), "client": ("test", 1),
+        "headers": [(b"host", b"test"), (b"user-agent", b"bench"), (b"accept", b"*/*"),
+                    (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    }
+    statuses = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            statuses.append(message['status'])
+
+    started = time.perf_counter()
+    for _ in range(n):
+        await main.app(dict(scope), receive, send)
+    elapsed = time.perf_counter() - started
+    assert set(statuses) == {status}, set(statuses)
+    return elapsed
+
+
+def main_():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    loop = asyncio.get_event_loop()
+    main.ready = True
+    switch = Switch()
+
+    print(f"requests: {n}")
+    for name, method, path, body, status in routes():
+        # alternate runs and take the best of them to filter out noise
+        # and change their order, so neither of them always runs after the other one
+        best = {False: float('inf'), True: float('inf')}
+        for i in range(20):
+            for on in (False, True) if i % 2 == 0 else (True, False):
+                switch.set(on)
+                gc.collect()
+                best[on] = min(best[on], loop.run_until_complete(run(method, path, body, status, n)))
+        plain_time, traced_time = best[False], best[True]
+        print(f"{name:<13} plain {plain_time / n * 1e6:8.1f}us  traced {traced_time / n * 1e6:8.1f}us  "
+              f"overhead {(traced_time - plain_time) / plain_time * 100:5.1f}%")
+
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,75 @@
+"""Compares validation of an import with pydantic models and with `validation.validate_import`.
+
+Usage: python -m benchmarks.bench_validation [number of citizens]
+
+Both paths start from decoded JSON and end with Mongo-ready citizen dicts. The last lines compare rejecting
+an import where every citizen is invalid with all errors and in the fast-fail mode (YB_VALIDATION_MAX_ERRORS).
+"""
+import copy
+import json
+import sys
+import time
+import tracemalloc
+
+from main import Import
+from tools.generate import Generator
+from validation import validate_import, ImportValidationError
+
+MAX_ERRORS = 100
+
+
+def with_pydantic(data):
+    return Import(**data).dict()['citizens']
+
+
+def with_validator(data):
+    return validate_import(data)
+
+
+def rejected(fn, data):
+    """Returns time to reject `data` and the size of the error text"""
+    body = copy.deepcopy(data)
+    started = time.perf_counter()
+    try:
+        fn(body)
+    except ImportValidationError as e:
+        return time.perf_counter() - started, e
+    raise AssertionError("the import is valid")
+
+
+def measure(fn, data):
+    body = copy.deepcopy(data)
+    started = time.perf_counter()
+    fn(body)
+    elapsed = time.perf_counter() - started
+
+    body = copy.deepcopy(data)
+    tracemalloc.start()
+    fn(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    data = {"citizens": list(Generator(seed=0).citizens(n))}
+
+    pydantic_time, pydantic_peak = measure(with_pydantic, data)
+    lean_time, lean_peak = measure(with_validator, data)
+
+    print(f"citizens:  {n}")
+    print(f"pydantic:  {pydantic_time:.3f}s, peak {pydantic_peak / 2 ** 20:.1f}MB")
+    print(f"validator: {lean_time:.3f}s ({pydantic_time / lean_time:.1f}x), peak {lean_peak / 2 ** 20:.1f}MB")
+
+    for c in data["citizens"]:
+        c["town"] = ""
+    full_time, full = rejected(validate_import, data)
+    fast_time, fast = rejected(lambda d: validate_import(d, max_errors=MAX_ERRORS), data)
+    print(f"malformed, all errors: {full_time:.3f}s, {len(full.display(loc=('body', 'data')))} bytes of errors")
+    print(f"malformed, fast-fail:  {fast_time:.3f}s, {len(json.dumps(fast.compact(loc=('body', 'data'))))} bytes "
+          f"of errors")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""Limits of request bodies, enforced while a body is being read.
+
+A request whose Content-Length is over the limit of its route is rejected with 413 before any of the body is
+read, so a client which sent `Expect: 100-continue` does not send the body at all. Otherwise the chunks are
+counted as they arrive and the request is rejected as soon as the body grows over the limit, which also bounds
+chunked bodies without Content-Length. A worker never buffers more than the limit of a route per request.
+
+Routes with a citizen limit also count `"citizen_id":` keys in the chunks, which rejects an import with too many
+citizens before it is parsed. The count may be off for bodies which are not valid imports, validation of the
+parsed import remains the exact check.
+
+Bytes received by the requests in progress are accounted in `body.bytes_in_flight` of the stats.
+"""
+import re
+
+from starlette.responses import JSONResponse
+from starlette.routing import Match
+
+CITIZEN_KEY = re.compile(rb'"citizen_id"\s*:')
+
+# the end of a chunk scanned again with the next one, so keys split between chunks are counted
+OVERLAP = 64
+
+
+class BodyTooLarge(Exception):
+    """Raised to the application from `receive` after the request has been rejected"""
+
+
+def route_name(scope):
+    """Name of the route matching the request, None if there is no such route.
+
+    The name is kept in the scope, so the routes are matched once for all middleware of a request.
+    """
+    if 'route_name' not in scope:
+        scope['route_name'] = None
+        for route in scope['app'].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                scope['route_name'] = route.name
+                break
+    return scope['route_name']
+
+
+class CitizenCounter:
+    """Counts citizens in the chunks of an import body without parsing it"""
+
+    def __init__(self):
+        self.count = 0
+        self.tail = b''
+        self.tail_count = 0
+
+    def feed(self, chunk):
+        data = self.tail + chunk
+        # keys within the tail were counted with the previous chunk
+        self.count += len(CITIZEN_KEY.findall(data)) - self.tail_count
+        self.tail = data[-OVERLAP:]
+        self.tail_count = len(CITIZEN_KEY.findall(self.tail))
+        return self.count
+
+
+class BodyLimitMiddleware:
+    """Rejects requests with 413 as soon as their body is over the limits of the route.
+
+    `limits` maps route name to (max_bytes, max_citizens), other routes are limited to `max_bytes`, 0 is no limit.
+    """
+
+    def __init__(self, app, limits, max_bytes, stats):
+        self.app = app
+        self.limits = limits
+        self.max_bytes = max_bytes
+        self.stats = stats
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        route = route_name(scope)
+        max_bytes, max_citizens = self.limits.get(route, (self.max_bytes, 0))
+        name = route or "unknown"
+
+        for k, v in scope['headers']:
+            if k == b'content-length':
+                try:
+                    content_length = int(v)
+                except ValueError:
+                    response = JSONResponse({"detail": "Invalid Content-Length header"}, status_code=400)
+                    await response(scope, receive, send)
+                    return
+                if max_bytes and content_length > max_bytes:
+                    await self.reject(name, f"Request body is larger than {max_bytes} bytes", scope, receive, send)
+                    return
+                break
+
+        counter = CitizenCounter() if max_citizens else None
+        received = 0
+        started = False
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            message = await receive()
+            if message['type'] != 'http.request' or rejected:
+                return message
+
+            chunk = message.get('body', b'')
+            received += len(chunk)
+            self.add_in_flight(len(chunk))
+            if max_bytes and received > max_bytes:
+                detail = f"Request body is larger than {max_bytes} bytes"
+            elif counter is not None and counter.feed(chunk) > max_citizens:
+                detail = f"Import has more than {max_citizens} citizens"
+            else:
+                return message
+
+            rejected = True
+            if not started:
+                await self.reject(name, detail, scope, receive, send)
+            raise BodyTooLarge(detail)
+
+        async def limited_send(message):
+            nonlocal started
+            # the response of the application to BodyTooLarge is dropped, 413 has already been sent
+            if not rejected:
+                started = True
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, limited_send)
+        except BodyTooLarge:
+            if not rejected:
+                raise
+        finally:
+            self.stats["body.bytes_in_flight"] -= received
+            key = f"body.{name}.max_bytes"
+            self.stats[key] = max(self.stats[key], received)
+
+    def add_in_flight(self, n):
+        in_flight = self.stats["body.bytes_in_flight"] + n
+        self.stats["body.bytes_in_flight"] = in_flight
+        self.stats["body.max_bytes_in_flight"] = max(self.stats["body.max_bytes_in_flight"], in_flight)
+
+    async def reject(self, name, detail, scope, receive, send):
+        self.stats[f"body.{name}.rejected"] += 1
+        response = JSONResponse({"detail": detail}, status_code=413)
+        await response(scope, receive, send)
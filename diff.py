@@ -0,0 +1,57 @@
+"""Diff of stored citizens of an import against a replacement list."""
+
+
+def diff_citizens(old, new):
+    """Returns ids of removed citizens, changed fields of kept citizens (citizen_id -> fields) and added citizens.
+
+    Relatives are compared regardless of order, a citizen whose relatives changed gets the whole new list.
+    """
+    stored = {c['citizen_id']: c for c in old}
+    changed = {}
+    added = []
+    for c in new:
+        s = stored.pop(c['citizen_id'], None)
+        if s is None:
+            added.append(c)
+            continue
+
+        fields = {}
+        for k, v in c.items():
+            if k == 'relatives':
+                if sorted(v) != sorted(s.get(k, [])):
+                    fields[k] = v
+            elif s.get(k) != v:
+                fields[k] = v
+        if fields:
+            changed[c['citizen_id']] = fields
+
+    return list(stored), changed, added
+
+
+
+def delta_pipeline(removed, changed, added):
+    """Update pipeline which applies the diff to `citizens` of the import document in one update.
+
+    Kept citizens stay in their order with changed fields merged in, added citizens go to the end. Values are
+    wrapped in `$literal`, so strings starting with `$` are not taken for field paths. Needs MongoDB 4.2+.
+    """
+    changed_ids = list(changed)
+    citizen = "$$c"
+    if changed:
+        position = {"$indexOfArray": [{"$literal": changed_ids}, "$$c.citizen_id"]}
+        citizen = {"$let": {"vars": {"i": position}, "in": {"$cond": [
+            {"$eq": ["$$i", -1]},
+            "$$c",
+            {"$mergeObjects": ["$$c", {"$arrayElemAt": [{"$literal": [changed[i] for i in changed_ids]}, "$$i"]}]}
+        ]}}}
+    kept = "$citizens"
+    if removed:
+        kept = {"$filter": {"input": "$citizens", "as": "c",
+                            "cond": {"$not": [{"$in": ["$$c.citizen_id", {"$literal": list(removed)}]}]}}}
+    return [
+        {"$set": {"citizens": {"$concatArrays": [
+            {"$map": {"input": kept, "as": "c", "in": citizen}},
+            {"$literal": list(added)}
+        ]}}},
+        {"$set": {"version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}}}
+    ]
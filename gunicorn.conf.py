@@ -0,0 +1,41 @@
+"""Production runtime: gunicorn supervises one uvicorn worker per core.
+
+Usage: gunicorn -c gunicorn.conf.py main:app
+
+Settings are read from the environment, see "Production runtime" in README.
+"""
+import os
+
+
+def cpu_count():
+    """Number of cores the process may run on, which is less than os.cpu_count() in a container limited by a cpuset"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+bind = os.getenv('YB_BIND', '0.0.0.0:8080')
+
+# every worker is a single-threaded event loop, so one per core keeps all cores busy without context switches
+workers = int(os.getenv('YB_WORKERS', '0')) or cpu_count()
+
+worker_class = 'workers.Worker'
+
+# connections waiting to be accepted while all workers are busy, e.g. during a burst of new connections
+backlog = int(os.getenv('YB_BACKLOG', '2048'))
+
+# longer than the idle timeout of the load balancer, so it never reuses a connection the worker is closing
+keepalive = int(os.getenv('YB_KEEP_ALIVE', '75'))
+
+# a worker whose loop is blocked that long is killed and restarted
+timeout = int(os.getenv('YB_WORKER_TIMEOUT', '60'))
+
+graceful_timeout = 30
+
+# the heartbeat file of workers, on a tmpfs it is never blocked by disk writes
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+# workers report callbacks which block the loop, see loop_monitor.py
+os.environ.setdefault('YB_SLOW_CALLBACK_MS', '100')
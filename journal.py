@@ -0,0 +1,352 @@
+import asyncio
+import time
+from collections import Counter
+from logging import getLogger
+
+from bson import ObjectId
+from pymongo import UpdateOne, WriteConcern
+from pymongo.collection import ReturnDocument
+
+log = getLogger(__name__)
+
+
+class ImportMoving(Exception):
+    """Raised by `append` if the import is being moved to another shard or does not exist on this one"""
+
+    def __init__(self, import_id):
+        super().__init__(f"Import {import_id} is being moved")
+        self.import_id = import_id
+
+
+def apply_patch(citizens, citizen_id, fields):
+    """Applies patch to `citizens` dict (citizen_id -> citizen) the same way as patch_citizen does in MongoDB"""
+    citizen = citizens[citizen_id]
+    old_relatives = set(citizen['relatives'])
+
+    citizen.update(fields)
+
+    if 'relatives' in fields:
+        citizen['relatives'] = list(fields['relatives'])
+        new_relatives = set(fields['relatives'])
+
+        for r in new_relatives.difference(old_relatives):
+            if r in citizens:
+                citizens[r]['relatives'].append(citizen_id)
+
+        for r in old_relatives.difference(new_relatives):
+            if r in citizens:
+                citizens[r]['relatives'] = [i for i in citizens[r]['relatives'] if i != citizen_id]
+
+
+def apply_to_citizen(citizen, entry):
+    """Applies a journal entry to one citizen the same way as `apply_patch` does to all citizens of the import"""
+    fields = entry['fields']
+    if entry['citizen_id'] == citizen['citizen_id']:
+        citizen.update(fields)
+        if 'relatives' in fields:
+            citizen['relatives'] = list(fields['relatives'])
+    elif 'relatives' in fields:
+        # relatives are mutual, so the patched citizen is among relatives of this one if this one was among its
+        if citizen['citizen_id'] in fields['relatives']:
+            if entry['citizen_id'] not in citizen['relatives']:
+                citizen['relatives'].append(entry['citizen_id'])
+        else:
+            citizen['relatives'] = [i for i in citizen['relatives'] if i != entry['citizen_id']]
+
+
+class PatchJournal:
+    """Journaled write path for citizen patches.
+
+    Patches are appended to `patches` collection in batches (group commit): all patches
+    that arrive while the previous batch is being written share one sequence allocation,
+    one `insert_many` and one import stamp update, and are acknowledged together once the
+    batch is durable. Pending patches are periodically folded into the import document.
+
+    Readers see pending patches through `overlay`. The import document keeps ids of the
+    patches which were folded but not yet deleted in `journal_folded`, so a reader never
+    applies a patch twice, and a compaction increments `version`, so a reader which raced
+    with it can detect that and retry.
+
+    A batch adds its id to `journal_appending` of the import document while it writes patches,
+    unless the import has `moving_to` set by tools/rebalance.py, which waits for the list to become
+    empty before moving the import. Patches of a moving import fail with ImportMoving.
+
+    The insert of the patches is the commit point: once it succeeded the patches are acknowledged,
+    and the following update of the import document is retried until it is done. A failed insert
+    is rolled back, so a patch reported as failed is never applied.
+    """
+
+    def __init__(self, imports, patches, counter, batch_size=1000, delay=0.002):
+        self.imports = imports
+        self.patches = patches.with_options(write_concern=WriteConcern(w='majority', j=True))
+        self.counter = counter
+        self.batch_size = batch_size
+        self.delay = delay
+        self.queue = []
+        self.flusher = None
+        self.stats = Counter()
+
+    async def append(self, import_id, citizen_id, fields):
+        """Appends patch to the journal and waits until it is durable, raises ImportMoving if the import is moving"""
+        waiter = asyncio.get_event_loop().create_future()
+        self.queue.append(({"import_id": import_id, "citizen_id": citizen_id, "fields": fields}, waiter))
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.ensure_future(self.flush())
+        await waiter
+
+    async def flush(self):
+        # give concurrent patches a chance to join the batch
+        await asyncio.sleep(self.delay)
+        while self.queue:
+            batch, self.queue = self.queue[:self.batch_size], self.queue[self.batch_size:]
+            try:
+                moving = await self.commit([entry for entry, _ in batch])
+            except Exception as e:
+                log.exception("Failed to commit patches")
+                for _, waiter in batch:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+            else:
+                for entry, waiter in batch:
+                    if not waiter.done():
+                        if entry['import_id'] in moving:
+                            waiter.set_exception(ImportMoving(entry['import_id']))
+                        else:
+                            waiter.set_result(None)
+
+    async def commit(self, entries):
+        """Writes the entries, returns ids of the moving imports whose entries were not written"""
+        # the batch id makes the updates of journal_appending idempotent, so they can be retried
+        batch_id = ObjectId()
+        import_ids = list({entry['import_id'] for entry in entries})
+        try:
+            opened = await asyncio.gather(*(self.imports.update_one({"import_id": import_id,
+                                                                     "moving_to": {"$exists": False}},
+                                                                    {"$addToSet": {"journal_appending": batch_id}})
+                                            for import_id in import_ids))
+        except Exception:
+            await self.close_batch(batch_id, import_ids)
+            raise
+        moving = {import_id for import_id, r in zip(import_ids, opened) if r.matched_count == 0}
+        appending = [import_id for import_id in import_ids if import_id not in moving]
+        entries = [entry for entry in entries if entry['import_id'] not in moving]
+        if not entries:
+            return moving
+
+        stamps = {}
+        try:
+            c = await self.counter.find_one_and_update(filter={"_id": "patch_seq"},
+                                                       update={"$inc": {"c": len(entries)}},
+                                                       upsert=True,
+                                                       return_document=ReturnDocument.AFTER)
+            seq = c['c'] - len(entries)
+            now = time.time()
+            for entry in entries:
+                seq += 1
+                entry['_id'] = ObjectId()
+                entry['seq'] = seq
+                entry['ts'] = now
+                stamps[entry['import_id']] = seq
+
+            await self.patches.insert_many(entries)
+        except Exception:
+            written = [entry['_id'] for entry in entries if '_id' in entry]
+            if written:
+                # some of the entries may have been inserted before the error
+                await self.retry(lambda: self.patches.delete_many({"_id": {"$in": written}}))
+            await self.close_batch(batch_id, appending)
+            raise
+
+        # readers use journal_seq together with version to detect new patches
+        await self.close_batch(batch_id, appending, stamps)
+
+        self.stats["journal.appended"] += len(entries)
+        self.stats["journal.batches"] += 1
+        self.stats["journal.max_batch_size"] = max(self.stats["journal.max_batch_size"], len(entries))
+        return moving
+
+    async def close_batch(self, batch_id, import_ids, stamps=None):
+        """Removes the batch from `journal_appending` of the imports and raises their `journal_seq` to `stamps`"""
+        updates = []
+        for import_id in import_ids:
+            update = {"$pull": {"journal_appending": batch_id}}
+            if stamps is not None:
+                update["$max"] = {"journal_seq": stamps[import_id]}
+            updates.append(UpdateOne({"import_id": import_id}, update))
+        await self.retry(lambda: self.imports.bulk_write(updates, ordered=False))
+
+    async def retry(self, operation):
+        """Runs an idempotent operation until it succeeds, the patches are already committed or rolled back"""
+        delay = self.delay
+        while True:
+            try:
+                return await operation()
+            except Exception:
+                log.exception("Failed to finish an append, retrying")
+                self.stats["journal.retries"] += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1)
+
+    async def load_citizens(self, import_id, ids):
+        """Loads citizens with given ids from the import document (without pending patches)"""
+        if not ids:
+            return {}
+        cursor = self.imports.aggregate([
+            {"$match": {"import_id": import_id}},
+            {"$project": {"citizens": {"$filter": {
+                "input": "$citizens",
+                "as": "c",
+                "cond": {"$in": ["$$c.citizen_id", list(ids)]}
+            }}}}
+        ])
+        result = {}
+        async for imp in cursor:
+            for c in imp['citizens']:
+                result[c['citizen_id']] = c
+        return result
+
+    async def overlay(self, import_id):
+        """Returns import version and citizens changed by pending patches (citizen_id -> citizen).
+
+        Returns (None, {}) if the import does not exist. Callers which also read the import document
+        have to compare the returned version with the version of the document they read and retry on mismatch.
+        """
+        while True:
+            head = await self.imports.find_one({"import_id": import_id},
+                                               projection={"version": True, "journal_folded": True})
+            if head is None:
+                return None, {}
+
+            entries = await self.patches.find(
+                {"import_id": import_id, "_id": {"$nin": head.get('journal_folded', [])}}
+            ).sort("seq").to_list(None)
+
+            citizens = {}
+            if entries:
+                ids = set()
+                for e in entries:
+                    ids.add(e['citizen_id'])
+                    ids.update(e['fields'].get('relatives', []))
+                citizens = await self.load_citizens(import_id, ids)
+
+                # relatives removed by a patch have to be updated too
+                extra = set(r for c in citizens.values() for r in c['relatives']).difference(citizens)
+                citizens.update(await self.load_citizens(import_id, extra))
+
+            check = await self.imports.find_one({"import_id": import_id}, projection={"version": True})
+            if check is None:
+                return None, {}
+            if check.get('version') != head.get('version'):
+                # the import was compacted while we were reading it
+                continue
+
+            for e in entries:
+                if e['citizen_id'] in citizens:
+                    apply_patch(citizens, e['citizen_id'], e['fields'])
+
+            return head.get('version'), citizens
+
+    async def load_citizen(self, import_id, citizen_id, relatives=()):
+        """Returns the citizen with pending patches applied and ids of `relatives` which are in the import.
+
+        Only the citizen and `relatives` are read from the import document, and only the patches which can
+        change the citizen, so a patch does not pay for the overlay of the whole import.
+        Returns None instead of the citizen if there is no such citizen.
+        """
+        ids = list({citizen_id, *relatives})
+        while True:
+            cursor = self.imports.aggregate([
+                {"$match": {"import_id": import_id}},
+                {"$project": {"version": True, "journal_folded": True, "citizens": {"$filter": {
+                    "input": "$citizens",
+                    "as": "c",
+                    "cond": {"$in": ["$$c.citizen_id", ids]}
+                }}}}
+            ])
+            imp = next(iter(await cursor.to_list(None)), None)
+            if imp is None:
+                return None, set()
+            citizens = {c['citizen_id']: c for c in imp['citizens']}
+            found = set(relatives).intersection(citizens)
+            citizen = citizens.get(citizen_id)
+            if citizen is None:
+                return None, found
+
+            entries = await self.patches.find({
+                "import_id": import_id,
+                "_id": {"$nin": imp.get('journal_folded', [])},
+                "$or": [{"citizen_id": citizen_id}, {"fields.relatives": {"$exists": True}}]
+            }).sort("seq").to_list(None)
+
+            check = await self.imports.find_one({"import_id": import_id}, projection={"version": True})
+            if check is None:
+                return None, set()
+            if check.get('version') != imp.get('version'):
+                # the import was compacted while we were reading it
+                continue
+
+            for e in entries:
+                apply_to_citizen(citizen, e)
+            return citizen, found
+
+    async def has_pending(self, import_id, folded):
+        """Returns True if the import has patches which are not folded into it, `folded` is its `journal_folded`"""
+        entry = await self.patches.find_one({"import_id": import_id, "_id": {"$nin": folded}}, projection={"_id": True})
+        return entry is not None
+
+    async def compact(self, import_id):
+        """Folds pending patches into the import document, returns number of folded patches"""
+        imp = await self.imports.find_one({"import_id": import_id})
+        if imp is None:
+            await self.patches.delete_many({"import_id": import_id})
+            return 0
+
+        folded = imp.get('journal_folded', [])
+        if folded:
+            # previous compaction was interrupted after the import had been updated
+            await self.patches.delete_many({"_id": {"$in": folded}})
+            await self.imports.update_one({"import_id": import_id}, {"$pullAll": {"journal_folded": folded}})
+
+        entries = await self.patches.find({"import_id": import_id, "_id": {"$nin": folded}}).sort("seq").to_list(None)
+        if not entries:
+            return 0
+
+        citizens = {c['citizen_id']: c for c in imp['citizens']}
+        for e in entries:
+            if e['citizen_id'] in citizens:
+                apply_patch(citizens, e['citizen_id'], e['fields'])
+
+        ids = [e['_id'] for e in entries]
+        r = await self.imports.update_one(
+            {"import_id": import_id, "version": imp.get('version')},
+            {"$set": {"citizens": list(citizens.values()), "journal_folded": ids}, "$inc": {"version": 1}}
+        )
+        if r.modified_count == 0:
+            log.info(f"Import {import_id} was changed during compaction, will retry later")
+            return 0
+
+        await self.patches.delete_many({"_id": {"$in": ids}})
+        await self.imports.update_one({"import_id": import_id}, {"$pullAll": {"journal_folded": ids}})
+
+        self.stats["journal.compacted"] += len(entries)
+        self.stats["journal.compactions"] += 1
+        return len(entries)
+
+    async def compact_all(self):
+        for import_id in await self.patches.distinct("import_id"):
+            try:
+                await self.compact(import_id)
+            except Exception:
+                log.exception(f"Failed to compact import {import_id}")
+
+    async def run_compaction(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self.compact_all()
+
+    async def get_stats(self):
+        result = dict(self.stats)
+        result["journal.pending"] = await self.patches.estimated_document_count()
+        oldest = await self.patches.find_one({}, sort=[("seq", 1)], projection={"ts": True})
+        result["journal.compaction_lag"] = round(time.time() - oldest['ts'], 3) if oldest is not None else 0
+        return result
@@ -0,0 +1,59 @@
+"""Detection of callbacks which block the event loop.
+
+The loop touches a heartbeat several times per threshold. A daemon thread which finds the heartbeat older
+than the threshold logs the current stack of the loop's thread, which is the stack of the blocking code,
+once per stall. Unlike asyncio debug mode it costs nothing per callback and shows where the loop is stuck,
+not only which callback was slow.
+"""
+import sys
+import threading
+import time
+import traceback
+from logging import getLogger
+
+log = getLogger(__name__)
+
+
+class LoopMonitor:
+    def __init__(self, threshold, stats):
+        self.threshold = threshold
+        self.interval = threshold / 4
+        self.stats = stats
+        self.loop = None
+        self.thread_id = None
+        self.heartbeat = None
+        self.stopped = threading.Event()
+
+    def start(self, loop):
+        """Starts monitoring of `loop`, must be called from the loop's thread"""
+        self.loop = loop
+        self.thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        loop.call_later(self.interval, self.beat)
+        threading.Thread(target=self.watch, name="loop-monitor", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def beat(self):
+        now = time.monotonic()
+        stall = now - self.heartbeat - self.interval
+        if stall > self.threshold:
+            self.stats["loop.stalls"] += 1
+            self.stats["loop.max_stall_ms"] = max(self.stats["loop.max_stall_ms"], round(stall * 1000))
+        self.heartbeat = now
+        if not self.stopped.is_set():
+            self.loop.call_later(self.interval, self.beat)
+
+    def watch(self):
+        reported = None
+        while not self.stopped.wait(self.interval):
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked <= self.threshold or heartbeat == reported:
+                continue
+            reported = heartbeat
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = ''.join(traceback.format_stack(frame))
+                log.warning(f"Event loop is blocked for {blocked * 1000:.0f}ms, stack of the loop thread:\n{stack}")
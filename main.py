@@ -1,31 +1,167 @@
+import asyncio
+import csv
 import datetime
+import hashlib
+import hmac
+import io
+import json
+import math
 import os
-from collections import defaultdict, Counter
+import resource
+import time
+import tracemalloc
+from bisect import bisect_right
+from collections import defaultdict, Counter, deque, OrderedDict
 from enum import Enum
 from logging import getLogger
+from contextlib import contextmanager
 from typing import List
 
-import numpy as np
 from fastapi import FastAPI, HTTPException
+from fastapi.openapi.utils import get_openapi
 from fastapi.exceptions import RequestValidationError
 from motor.motor_asyncio import AsyncIOMotorClient
 from pydantic import BaseModel, validator, Extra, Schema
+from pydantic.schema import model_schema
+from bson import ObjectId, SON
+from pymongo import WriteConcern
 from pymongo.collection import ReturnDocument
-from starlette.responses import JSONResponse
+from pymongo.errors import DocumentTooLarge, DuplicateKeyError, WriteConcernError, WriteError
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+
+from body_limits import BodyLimitMiddleware, route_name
+from dates import parse_birth_dates, ages
+from diff import diff_citizens, delta_pipeline
+from journal import PatchJournal, ImportMoving
+from loop_monitor import LoopMonitor
+from sharding import HashRing, parse_mongo_urls
+from snapshots import SnapshotStore, ColumnsBuilder, birthday_presents, age_histograms
+from tracing import TracingMiddleware, span, traced, inherit
+from validation import validate_import, ImportValidationError, truncated_error
+from working_set import WorkingSet
 
 log = getLogger(__name__)
 
 MONGO_URL = os.getenv('YB_MONGO_URL', 'mongodb://localhost:27017/')
 
-log.info(f"MONGO_URL={MONGO_URL}")
+# shards in form `name=url name=url ...`, by default the only shard is YB_MONGO_URL, see sharding.py
+MONGO_URLS = parse_mongo_urls(os.getenv('YB_MONGO_URLS', ''), MONGO_URL)
 
-client = AsyncIOMotorClient(MONGO_URL)
+# used instead of the shard's url for the routes from YB_READ_PREFERENCES when there is a single shard
+ANALYTICS_MONGO_URL = os.getenv('YB_ANALYTICS_MONGO_URL', '')
 
-db = client['yaback']
+ANALYTICS_POOL_SIZE = int(os.getenv('YB_ANALYTICS_POOL_SIZE', '10'))
 
-imports = db['imports']
+BATCH_SIZE = int(os.getenv('YB_BATCH_SIZE', '1000'))
 
-counter = db['counter']
+PATCH_JOURNAL = os.getenv('YB_PATCH_JOURNAL', '0') == '1'
+
+JOURNAL_COMPACT_INTERVAL = float(os.getenv('YB_JOURNAL_COMPACT_INTERVAL', '5'))
+
+WARMUP = os.getenv('YB_WARMUP', '1') == '1'
+
+# how many times PUT /imports/{import_id} recomputes the diff if the import is changed concurrently
+REPLACE_ATTEMPTS = 5
+
+# max number of import ids remembered to be on the shard given by the ring, they are looked up again after that
+PLACED_CACHE_SIZE = 1000000
+
+TRACE_MEMORY = os.getenv('YB_TRACE_MEMORY', '0') == '1'
+
+# callbacks which block the event loop longer than this are logged with their stack, 0 disables the check
+SLOW_CALLBACK_MS = float(os.getenv('YB_SLOW_CALLBACK_MS', '0'))
+
+SNAPSHOT_DIR = os.getenv('YB_SNAPSHOT_DIR', '')
+
+SNAPSHOT_MAX_BYTES = int(os.getenv('YB_SNAPSHOT_MAX_BYTES', str(1024 * 1024 * 1024)))
+
+DEDUP_IMPORTS = os.getenv('YB_DEDUP_IMPORTS', '0') == '1'
+
+ANALYTICS_CACHE_SIZE = int(os.getenv('YB_ANALYTICS_CACHE_SIZE', '128'))
+
+WORKING_SET_BYTES = int(os.getenv('YB_WORKING_SET_BYTES', '0'))
+
+# stop validation of a body after this many errors and return them as a list, 0 returns all errors as text
+VALIDATION_MAX_ERRORS = int(os.getenv('YB_VALIDATION_MAX_ERRORS', '0'))
+
+MAX_CITIZENS = int(os.getenv('YB_MAX_CITIZENS', '0'))
+
+# limit of request bodies of the routes without a limit in YB_BODY_LIMITS, 0 is no limit
+MAX_BODY_BYTES = int(os.getenv('YB_MAX_BODY_BYTES', str(1024 * 1024)))
+
+TOKEN = os.getenv('YB_TOKEN', '52ce8098-d510-4bbc-88b9-e1a733292786')
+
+# the default token is public, so it does not make a caller trusted
+TOKEN_IS_SET = 'YB_TOKEN' in os.environ
+
+log.info(f"MONGO_URLS={[name for name, _ in MONGO_URLS]}")
+
+# shard name -> Shard, connections and collections are created in startup hook
+shards = {}
+
+# the first shard, which also keeps the global counters and idempotency keys
+config = None
+
+ring = HashRing([name for name, _ in MONGO_URLS])
+
+# ids of imports found on the shard given by the ring, imports are only ever moved to that shard
+placed = set()
+
+# local snapshots for analytics, created in startup hook if YB_SNAPSHOT_DIR is set
+snapshots = None
+
+# hot imports kept in memory, created in startup hook if YB_WORKING_SET_BYTES is set
+working_set = None
+
+# detector of blocking callbacks, created in startup hook if YB_SLOW_CALLBACK_MS is set
+monitor = None
+
+ready = False
+
+stats = Counter()
+
+
+def percentile(counts, q):
+    """Same as numpy.percentile(values, q, interpolation='linear') for values given as Counter (value -> count)"""
+    values = sorted(counts)
+    positions = []
+    n = 0
+    for v in values:
+        n += counts[v]
+        positions.append(n)
+
+    k = q / 100 * (n - 1)
+    below = math.floor(k)
+    above = min(below + 1, n - 1)
+    weight = k - below
+    return values[bisect_right(positions, below)] * (1 - weight) + values[bisect_right(positions, above)] * weight
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def rss_kb():
+    """Current RSS of the worker, None where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except OSError:
+        return None
+
+
+@contextmanager
+def memory_watermark(name):
+    """Records how much the worker's peak RSS grew while running the block"""
+    before = max_rss_kb()
+    try:
+        yield
+    finally:
+        growth = max_rss_kb() - before
+        key = f"memory.{name}.max_rss_growth_kb"
+        stats[key] = max(stats[key], growth)
 
 
 class Token(BaseModel):
@@ -68,6 +204,11 @@ class Citizen(BaseModel):
         return v
 
 
+class ExportFormat(str, Enum):
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+
 class Patch(BaseModel):
     town: str = NonEmptyStrOpt
     street: str = NonEmptyStrOpt
@@ -92,6 +233,8 @@ class Patch(BaseModel):
         return v
 
 
+# POST /imports validates the body with validation.validate_import, which must follow this model,
+# the model itself documents the body in OpenAPI schema
 class Import(BaseModel):
     citizens: List[Citizen]
 
@@ -122,30 +265,809 @@ class Import(BaseModel):
         return v
 
 
+class ImportBatch(BaseModel):
+    imports: List[Import]
+
+    class Config:
+        extra = Extra.forbid
+
+
+class RouteLimiter:
+    """Concurrency limit with a bounded wait queue for a single route.
+
+    Up to `concurrency` requests run at once, up to `queue_size` more wait for a slot,
+    everything beyond that is rejected immediately so the client can retry later.
+    """
+
+    def __init__(self, name, concurrency, queue_size):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiters = deque()
+
+    async def acquire(self):
+        if self.active < self.concurrency and not self.waiters:
+            self.active += 1
+            stats[f"limits.{self.name}.admitted"] += 1
+            return True
+
+        if len(self.waiters) >= self.queue_size:
+            stats[f"limits.{self.name}.rejected"] += 1
+            return False
+
+        stats[f"limits.{self.name}.queued"] += 1
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            with span("admission.wait", route=self.name):
+                await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was already handed over to us, pass it on
+                self.release()
+            elif waiter in self.waiters:
+                # release() may have popped the cancelled waiter before this runs
+                self.waiters.remove(waiter)
+            raise
+        stats[f"limits.{self.name}.admitted"] += 1
+        return True
+
+    def release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                # hand the slot over without decrementing active
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+def parse_route_settings(value):
+    """Parse settings in form `route=value,...`"""
+    settings = {}
+    for item in value.split(','):
+        item = item.strip()
+        if item:
+            route, setting = item.split('=')
+            settings[route.strip()] = setting.strip()
+    return settings
+
+
+def parse_route_limits(value):
+    """Parse limits in form `route=concurrency:queue_size,...`"""
+    limits = {}
+    for route, limit in parse_route_settings(value).items():
+        concurrency, queue_size = limit.split(':')
+        limits[route] = (int(concurrency), int(queue_size))
+    return limits
+
+
+# every route which parses and validates whole imports is limited, so none of them bypasses the admission
+ROUTE_LIMITS = parse_route_limits(os.getenv('YB_ROUTE_LIMITS', 'post_imports=4:16,post_imports_batch=2:8,'
+                                                              'replace_import=4:16,get_age_stat=8:32'))
+
+RETRY_AFTER = os.getenv('YB_RETRY_AFTER', '1')
+
+# how long a request waits for tools/rebalance.py to finish moving an import before it gets 503
+MOVE_WAIT_SECONDS = float(os.getenv('YB_MOVE_WAIT_SECONDS', '5'))
+
+log.info(f"ROUTE_LIMITS={ROUTE_LIMITS}")
+
+limiters = {route: RouteLimiter(route, c, q) for route, (c, q) in ROUTE_LIMITS.items()}
+
+
+def parse_body_limits(value):
+    """Parse limits in form `route=max_bytes:max_citizens,...`, max_citizens may be omitted"""
+    limits = {}
+    for route, limit in parse_route_settings(value).items():
+        max_bytes, _, max_citizens = limit.partition(':')
+        limits[route] = (int(max_bytes), int(max_citizens or '0'))
+    return limits
+
+
+# an import is one MongoDB document, which is limited to 16MB
+BODY_LIMITS = parse_body_limits(os.getenv('YB_BODY_LIMITS', 'post_imports=16777216,post_imports_batch=16777216,'
+                                                            'replace_import=16777216'))
+
+# an import with more than YB_MAX_CITIZENS citizens is rejected while it is read, unless the route sets its own limit
+for route in ("post_imports", "replace_import"):
+    max_body_bytes, max_citizens = BODY_LIMITS.get(route, (MAX_BODY_BYTES, 0))
+    BODY_LIMITS[route] = (max_body_bytes, max_citizens or MAX_CITIZENS)
+
+log.info(f"BODY_LIMITS={BODY_LIMITS}, MAX_BODY_BYTES={MAX_BODY_BYTES}")
+
+READ_PREFERENCE_MODES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest
+}
+
+# read routes are get_citizens, get_birthdays, get_age_stat and export_citizens
+READ_PREFERENCES = parse_route_settings(os.getenv('YB_READ_PREFERENCES', ''))
+
+log.info(f"READ_PREFERENCES={READ_PREFERENCES}")
+
+DURABILITY_PROFILES = {
+    'fast': WriteConcern(w=1, j=False),
+    'durable': WriteConcern(w='majority', j=True)
+}
+
+# write routes are post_imports, post_imports_batch, patch_citizen and replace_import, other routes use the client's default write concern
+DURABILITY = parse_route_settings(os.getenv('YB_DURABILITY', ''))
+
+log.info(f"DURABILITY={DURABILITY}")
+
+for route, profile in DURABILITY.items():
+    if profile not in DURABILITY_PROFILES:
+        raise ValueError(f"Unknown durability profile {profile} for route {route}")
+
+
+class AdmissionMiddleware:
+    """Applies per-route limits before the request body is read and validated"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        limiter = None
+        if scope['type'] == 'http':
+            limiter = limiters.get(route_name(scope))
+
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+
+        if not await limiter.acquire():
+            response = JSONResponse({"detail": f"Too many concurrent requests to {limiter.name}"},
+                                    status_code=503,
+                                    headers={"Retry-After": RETRY_AFTER})
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
+
+
+class SingleFlight:
+    """Shares one in-flight computation between concurrent calls with the same key.
+
+    Keys include the import version, so a call made after a patch never joins
+    a computation started before it.
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, fn):
+        route = key[0]
+        call = self.calls.get(key)
+        if call is None:
+            stats[f"singleflight.{route}.computed"] += 1
+            call = asyncio.ensure_future(fn())
+            inherit(call)
+            self.calls[key] = call
+            call.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            stats[f"singleflight.{route}.coalesced"] += 1
+        # shield the shared call so a disconnected client does not cancel it for others
+        return await asyncio.shield(call)
+
+
+analytics = SingleFlight()
+
+
+class VersionedCache:
+    """LRU cache of analytics results of the worker, one entry per route and import.
+
+    An entry is used only if it was computed for the version stamp just read from the primary. Every acknowledged
+    patch or replace changes the stamp, so a worker never serves a result older than the last acknowledged write,
+    whichever worker made it, without any invalidation messages between workers.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        # (route, import_id) -> (stamp, result)
+        self.entries = OrderedDict()
+
+    async def get(self, route, import_id, stamp, fn):
+        key = (route, import_id)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == stamp:
+            self.entries.move_to_end(key)
+            stats[f"cache.{route}.hits"] += 1
+            return entry[1]
+
+        stats[f"cache.{route}.misses"] += 1
+        result = await fn()
+        if self.size > 0:
+            # a result of an older stamp is replaced, it can never be used again
+            self.entries[key] = (stamp, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                stats["cache.evicted"] += 1
+        return result
+
+
+cache = VersionedCache(ANALYTICS_CACHE_SIZE)
+
+deduplicated = SingleFlight()
+
+
+class Shard:
+    """Connection and collections of one MongoDB deployment, which keeps a part of imports"""
+
+    def __init__(self, name, url, analytics_url):
+        self.name = name
+        self.client = AsyncIOMotorClient(url)
+        self.db = self.client['yaback']
+        self.imports = self.db['imports']
+        self.patches = self.db['patches']
+        # imports which tools/rebalance.py is moving to this shard
+        self.moving = self.db['imports_moving']
+        # global counters and idempotency keys, used on the config shard only
+        self.counter = self.db['counter']
+        self.dedup = self.db['dedup']
+        self.journal = None
+
+        # route name -> imports collection with the route's read preference
+        self.readers = {}
+        self.analytics_client = None
+        if READ_PREFERENCES:
+            self.analytics_client = AsyncIOMotorClient(analytics_url, maxPoolSize=ANALYTICS_POOL_SIZE)
+            for route, mode in READ_PREFERENCES.items():
+                self.readers[route] = self.analytics_client['yaback'].get_collection(
+                    'imports', read_preference=READ_PREFERENCE_MODES[mode]())
+
+        # (collection name, durability profile) -> collection with the profile's write concern
+        self.writers = {}
+        for profile, write_concern in DURABILITY_PROFILES.items():
+            for collection in ('imports', 'counter', 'dedup'):
+                self.writers[collection, profile] = self.db.get_collection(collection, write_concern=write_concern)
+
+    def writer(self, collection, profile):
+        """Returns the collection with the write concern of the durability profile, or the default one for None"""
+        if profile is None:
+            return getattr(self, collection)
+        return self.writers[collection, profile]
+
+    async def ensure_indexes(self):
+        """Creates indexes for every query shape the handlers issue, see tools/explain.py"""
+        await self.imports.create_index("import_id", unique=True)
+        await self.imports.create_index([("import_id", 1), ("citizens.citizen_id", 1)])
+        await self.moving.create_index("import_id", unique=True)
+        await self.patches.create_index([("import_id", 1), ("seq", 1)])
+        await self.patches.create_index("seq")
+
+    async def drop(self):
+        for collection in (self.imports, self.patches, self.moving, self.counter, self.dedup):
+            await collection.drop()
+
+    def close(self):
+        self.client.close()
+        if self.analytics_client is not None:
+            self.analytics_client.close()
+
+
+async def locate(import_id):
+    """Returns the shard which keeps the import, or the shard given by the ring if there is no such import.
+
+    Imports are created on the shard given by the ring, others are there only until tools/rebalance.py moves them.
+    """
+    home = shards[ring.shard_for(import_id)]
+    if len(shards) == 1 or import_id in placed:
+        return home
+
+    query = {"import_id": import_id}
+    deadline = time.monotonic() + MOVE_WAIT_SECONDS
+    while True:
+        with span("mongo.find_one", query="locate", shard=home.name):
+            if await home.imports.find_one(query, projection={"_id": True}) is not None:
+                remember_placed([import_id])
+                return home
+
+        others = [shard for shard in shards.values() if shard is not home]
+        with span("shards.fan_out", query="locate"):
+            found = await asyncio.gather(*(shard.imports.find_one(query, projection={"_id": True})
+                                           for shard in others))
+        for shard, imp in zip(others, found):
+            if imp is not None:
+                stats["shards.misplaced_reads"] += 1
+                return shard
+
+        if await home.moving.find_one(query, projection={"_id": True}) is None:
+            return home
+        # the import is between the shards, tools/rebalance.py finishes the move in a few round trips,
+        # unless it died in the middle of the move and waits for the next run
+        wait_for_move(import_id, deadline)
+        await asyncio.sleep(0.01)
+
+
+def wait_for_move(import_id, deadline):
+    """Raises 503 if a move of the import which the request waits for is not over by `deadline`"""
+    if time.monotonic() > deadline:
+        stats["shards.move_wait_timeouts"] += 1
+        raise HTTPException(status_code=503, detail=f"Import {import_id} is being moved, try again later",
+                            headers={"Retry-After": RETRY_AFTER})
+
+
+def remember_placed(import_ids):
+    if len(shards) > 1:
+        if len(placed) >= PLACED_CACHE_SIZE:
+            placed.clear()
+        placed.update(import_ids)
+
+
+async def relocate(import_id, shard):
+    """Returns the new shard of the import which was not found in `shard`, or None if it has not been moved"""
+    if len(shards) == 1:
+        return None
+    moved = await locate(import_id)
+    if moved is shard:
+        return None
+    stats["shards.relocated"] += 1
+    return moved
+
+
+async def get_import_version(import_id, shard):
+    """Returns import version stamp, which changes with every patch of the import.
+
+    The stamp includes the document `_id`, so an import created after /clear with the same import_id gets another one.
+    """
+    with span("mongo.find_one", query="version"):
+        imp = await shard.imports.find_one({"import_id": import_id}, projection={"version": True, "journal_seq": True})
+    if imp is None:
+        raise HTTPException(status_code=400, detail=f"Import with id {import_id} not found")
+    return imp.get('version'), imp.get('journal_seq'), str(imp['_id'])
+
+
+async def locate_version(import_id):
+    """Returns the shard which keeps the import and its version stamp, the import is located again if it was moved"""
+    shard = await locate(import_id)
+    try:
+        return shard, await get_import_version(import_id, shard)
+    except HTTPException:
+        moved = await relocate(import_id, shard)
+        if moved is None:
+            raise
+        return moved, await get_import_version(import_id, moved)
+
+
+async def find_import(import_id, shard, projection=None, route=None):
+    """Finds import with pending journal patches applied.
+
+    Projection should include `version` and `citizens.citizen_id` when the journal is enabled.
+    """
+    reader = shard.readers.get(route)
+    while True:
+        imp = None
+        if reader is not None:
+            # the replica is used only if it has caught up with the version on the primary,
+            # so a read after an acknowledged patch always sees it, `_id` tells an import created after /clear
+            version, _, _id = await get_import_version(import_id, shard)
+            with span("mongo.find_one", query="import", replica=True):
+                imp = await reader.find_one({"import_id": import_id, "version": version, "_id": ObjectId(_id)},
+                                            projection=projection)
+            stats[f"reads.{route}.{'replica' if imp is not None else 'replica_fallback'}"] += 1
+
+        if imp is None:
+            with span("mongo.find_one", query="import"):
+                imp = await shard.imports.find_one({"import_id": import_id}, projection=projection)
+
+        if imp is None or shard.journal is None:
+            return imp
+
+        with span("journal.overlay"):
+            version, changed = await shard.journal.overlay(import_id)
+        if version == imp.get('version'):
+            if changed:
+                imp['citizens'] = [changed.get(c['citizen_id'], c) for c in imp['citizens']]
+            return imp
+
+
+async def open_citizens_cursor(collection, match, projection):
+    """Returns cursor over citizens of the matched import and its first batch, or (None, []) if nothing matched"""
+    # the import is unwound on the server, so citizens arrive in batches
+    cursor = collection.aggregate([
+        {"$match": match},
+        {"$project": projection},
+        {"$unwind": "$citizens"},
+        {"$replaceRoot": {"newRoot": "$citizens"}}
+    ], batchSize=BATCH_SIZE)
+
+    with span("mongo.aggregate", query="citizens"):
+        batch = await cursor.to_list(BATCH_SIZE)
+    if not batch and await collection.find_one(match, projection={"_id": True}) is None:
+        return None, []
+    return cursor, batch
+
+
+async def iter_citizens(import_id, shard, fields, route=None, stamp=None):
+    """Yields batches of citizens of the import with pending journal patches applied.
+
+    `stamp` is the import version stamp already read from the primary, if any.
+    """
+    projection = {f"citizens.{f}": True for f in fields}
+    projection['citizens.citizen_id'] = True
+    projection['_id'] = False
+
+    reader = shard.readers.get(route)
+    journal = shard.journal
+
+    while True:
+        changed = {}
+        match = {"import_id": import_id}
+        if journal is not None:
+            with span("journal.overlay"):
+                version, changed = await journal.overlay(import_id)
+            if version is None:
+                return
+            match['version'] = version
+
+        cursor, batch = None, []
+        if reader is not None:
+            # the replica is used only if it has caught up with the version on the primary
+            if stamp is None:
+                stamp = await get_import_version(import_id, shard)
+            replica_match = dict(match, _id=ObjectId(stamp[2]))
+            replica_match.setdefault('version', stamp[0])
+            cursor, batch = await open_citizens_cursor(reader, replica_match, projection)
+            stats[f"reads.{route}.{'replica' if cursor is not None else 'replica_fallback'}"] += 1
+
+        if cursor is None:
+            cursor, batch = await open_citizens_cursor(shard.imports, match, projection)
+
+        if cursor is not None or journal is None:
+            break
+
+    while batch:
+        if changed:
+            batch = [changed.get(c['citizen_id'], c) for c in batch]
+        yield batch
+        with span("mongo.aggregate", query="citizens"):
+            batch = await cursor.to_list(BATCH_SIZE)
+
+
 app = FastAPI(docs_url="/")
 
+app.add_middleware(AdmissionMiddleware)
+
+# outside of the admission, so bodies over the limit are rejected without waiting for a slot
+app.add_middleware(BodyLimitMiddleware, limits=BODY_LIMITS, max_bytes=MAX_BODY_BYTES, stats=stats)
+
+app.add_middleware(TracingMiddleware)
+
+
+def warmup():
+    """Runs the request handling code paths once, so the first requests don't pay for it"""
+    citizen = {
+        "citizen_id": 1, "town": "town", "street": "street", "building": "1", "apartment": 1,
+        "name": "name", "birth_date": "01.01.2000", "gender": "male", "relatives": []
+    }
+    validate_import({"citizens": [dict(citizen)]})
+    Patch(name="name").dict(skip_defaults=True)
+    percentile(Counter([1, 2, 3]), 50)
+    json.dumps(citizen, ensure_ascii=False)
+
+
+async def connect():
+    global ready
+    while True:
+        try:
+            for shard in shards.values():
+                await shard.client.admin.command('ping')
+                await shard.ensure_indexes()
+        except Exception:
+            log.exception("MongoDB is not available, will retry")
+            await asyncio.sleep(1)
+        else:
+            ready = True
+            return
+
+
+@app.on_event("startup")
+async def startup():
+    global config, snapshots, monitor, working_set
+    started = time.monotonic()
+
+    for name, url in MONGO_URLS:
+        analytics_url = ANALYTICS_MONGO_URL if ANALYTICS_MONGO_URL and len(MONGO_URLS) == 1 else url
+        shards[name] = Shard(name, url, analytics_url)
+    config = shards[MONGO_URLS[0][0]]
+
+    if PATCH_JOURNAL:
+        for shard in shards.values():
+            # patch sequence numbers are global, so patches of a moved import keep their order
+            shard.journal = PatchJournal(shard.imports, shard.patches, config.counter)
+            asyncio.ensure_future(shard.journal.run_compaction(JOURNAL_COMPACT_INTERVAL))
+
+    if SNAPSHOT_DIR:
+        snapshots = SnapshotStore(SNAPSHOT_DIR, SNAPSHOT_MAX_BYTES)
+
+    if WORKING_SET_BYTES > 0:
+        working_set = WorkingSet(WORKING_SET_BYTES)
+
+    if TRACE_MEMORY:
+        tracemalloc.start()
+
+    if SLOW_CALLBACK_MS > 0:
+        monitor = LoopMonitor(SLOW_CALLBACK_MS / 1000, stats)
+        monitor.start(asyncio.get_event_loop())
+
+    if WARMUP:
+        warmup()
+
+    connecting = asyncio.ensure_future(connect())
+    try:
+        await asyncio.wait_for(asyncio.shield(connecting), timeout=5)
+    except asyncio.TimeoutError:
+        log.warning("MongoDB is not available yet, the application is not ready")
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    stats["startup.seconds"] = round(time.monotonic() - started, 3)
+    stats["startup.cpu_seconds"] = round(usage.ru_utime + usage.ru_stime, 3)
+    stats["startup.max_rss_kb"] = usage.ru_maxrss
+    log.info(f"Started in {stats['startup.seconds']}s, "
+             f"cpu {stats['startup.cpu_seconds']}s, max rss {usage.ru_maxrss}kb")
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if monitor is not None:
+        monitor.stop()
+    for shard in shards.values():
+        shard.close()
+
+
+@app.get('/ready')
+@traced
+async def get_ready():
+    if not ready:
+        raise HTTPException(status_code=503, detail="Not ready")
+    return {"data": "ok"}
+
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request, exc):
-    return JSONResponse({"detail": str(exc)}, status_code=400)
+    if not VALIDATION_MAX_ERRORS:
+        return JSONResponse({"detail": str(exc)}, status_code=400)
+    # pydantic has already found every error, only the response is bounded
+    errors = exc.errors()
+    detail = [{"loc": list(e['loc']), "msg": e['msg'], "type": e['type']} for e in errors[:VALIDATION_MAX_ERRORS]]
+    if len(errors) > VALIDATION_MAX_ERRORS:
+        detail.append(truncated_error((), VALIDATION_MAX_ERRORS))
+    return JSONResponse({"detail": detail}, status_code=400)
+
+
+@app.exception_handler(DocumentTooLarge)
+async def document_too_large_handler(request, exc):
+    # BSON of an import may be larger than its JSON, so a body under the limit can still be rejected by MongoDB
+    stats[f"body.{route_name(request.scope)}.rejected"] += 1
+    return JSONResponse({"detail": "Import is too large to be stored"}, status_code=413)
+
+
+def validation_detail(e, loc):
+    """Detail of the response for ImportValidationError, compact list of errors in the fast-fail mode"""
+    return e.compact(loc) if VALIDATION_MAX_ERRORS else e.display(loc)
+
+
+def get_durability(route, request):
+    """Returns the durability profile of the route, None for the default write concern.
+
+    Trusted callers (with `X-Token` header equal to YB_TOKEN) may choose the profile with `X-Durability` header,
+    only if YB_TOKEN is set.
+    """
+    profile = request.headers.get("x-durability")
+    if profile is not None:
+        token = request.headers.get("x-token", "")
+        if not TOKEN_IS_SET or not hmac.compare_digest(token.encode('utf-8'), TOKEN.encode('utf-8')):
+            raise HTTPException(status_code=403, detail="X-Durability header requires a valid X-Token")
+        if profile not in DURABILITY_PROFILES:
+            raise HTTPException(status_code=400, detail=f"Unknown durability profile {profile}")
+    else:
+        profile = DURABILITY.get(route)
+    return profile
+
+
+async def read_body(request):
+    """Reads the request body into a bytearray.
+
+    Request.body() of Starlette concatenates the chunks into bytes, which copies the body read so far for every
+    chunk and takes seconds for a body of tens of megabytes.
+    """
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+    return body
+
+
+async def read_import(request):
+    return parse_import(await read_body(request))
+
+
+def parse_json(body):
+    try:
+        return json.loads(body) if body else None
+    except Exception as e:
+        log.error(f"Error getting request body: {e}")
+        raise HTTPException(status_code=400, detail="There was an error parsing the body") from e
+
+
+def parse_import(body):
+    """Parses and validates import body with `validate_import`, errors are the same as for `Import` model"""
+    with memory_watermark("parse_import"):
+        data = parse_json(body)
+        with span("validate.import"):
+            try:
+                return validate_import(data, VALIDATION_MAX_ERRORS, MAX_CITIZENS)
+            except ImportValidationError as e:
+                raise HTTPException(status_code=400, detail=validation_detail(e, ("body", "data")))
+
+
+# (path, method) -> model of the body of the routes which validate the body themselves
+BODY_MODELS = {
+    ("/imports", "post"): Import,
+    ("/imports/batch", "post"): ImportBatch,
+    ("/imports/{import_id}", "put"): Import
+}
+
+
+def openapi():
+    """OpenAPI schema, routes which validate the body themselves are documented with the body model"""
+    if app.openapi_schema is None:
+        schema = get_openapi(title=app.title, version=app.version, openapi_version=app.openapi_version,
+                             description=app.description, routes=app.routes, openapi_prefix=app.openapi_prefix)
+        schemas = schema.setdefault("components", {}).setdefault("schemas", {})
+        for (path, method), model in BODY_MODELS.items():
+            body_schema = model_schema(model, ref_prefix="#/components/schemas/")
+            schemas.update(body_schema.pop("definitions", {}))
+            schemas[model.__name__] = body_schema
+            schema["paths"][path][method]["requestBody"] = {
+                "content": {"application/json": {"schema": {"$ref": f"#/components/schemas/{model.__name__}"}}},
+                "required": True
+            }
+        app.openapi_schema = schema
+    return app.openapi_schema
+
+
+app.openapi = openapi
 
 
 @app.post("/imports", status_code=201)
-async def post_imports(data: Import):
-    imp = data.dict()
-    c = await counter.find_one_and_update(filter={"_id": "import_id"},
-                                          update={"$inc": {"c": 1}},
-                                          upsert=True,
-                                          return_document=ReturnDocument.AFTER)
-    import_id = c['c']
-    imp['import_id'] = import_id
-    await imports.insert_one(imp)
+@traced
+async def post_imports(request: Request):
+    body = await read_body(request)
+    profile = get_durability("post_imports", request)
+
+    key = request.headers.get("idempotency-key")
+    if key is None and not DEDUP_IMPORTS:
+        import_id, _ = await create_import(body, profile)
+        return {"data": {"import_id": import_id}}
+
+    with span("sha256"):
+        digest = hashlib.sha256(body).hexdigest()
+    dedup_key = f"key:{key}" if key is not None else f"sha256:{digest}"
+
+    with span("mongo.find_one", query="dedup_key"):
+        import_id = await find_duplicate(dedup_key, digest)
+    if import_id is None:
+        # concurrent retries in this worker wait for the first one instead of validating the body again
+        flight = ("post_imports", dedup_key, digest)
+        coalesced = flight in deduplicated.calls
+        import_id, created = await deduplicated.do(flight, lambda: create_import(body, profile, dedup_key, digest))
+        if created and not coalesced:
+            return {"data": {"import_id": import_id}}
+
+    stats["imports.deduplicated"] += 1
+    log.info(f"Import {import_id} was already created with the same {'key' if key is not None else 'body'}")
+    return JSONResponse({"data": {"import_id": import_id}}, status_code=201, headers={"Idempotent-Replayed": "true"})
+
+
+async def find_duplicate(dedup_key, digest):
+    """Returns id of the import created with `dedup_key` or None"""
+    record = await config.dedup.find_one({"_id": dedup_key})
+    if record is None:
+        return None
+    if record['body_sha256'] != digest:
+        raise HTTPException(status_code=400, detail="Idempotency-Key was already used with a different body")
+    return record['import_id']
+
+
+async def allocate_import_ids(profile, n=1):
+    """Allocates `n` consecutive import ids on the config shard, returns the first one"""
+    with span("allocate_id"):
+        c = await config.writer('counter', profile).find_one_and_update(filter={"_id": "import_id"},
+                                                                         update={"$inc": {"c": n}},
+                                                                         upsert=True,
+                                                                         return_document=ReturnDocument.AFTER)
+    return c['c'] - n + 1
+
+
+async def create_import(body, profile, dedup_key=None, digest=None):
+    """Validates and inserts an import, returns its id and False if it was created concurrently with `dedup_key`"""
+    citizens = parse_import(body)
+    import_id = await allocate_import_ids(profile)
+    shard = shards[ring.shard_for(import_id)]
+    imp = {"citizens": citizens, "import_id": import_id, "version": 0}
+    with span("mongo.insert_one", shard=shard.name):
+        await shard.writer('imports', profile).insert_one(imp)
+    remember_placed([import_id])
+    if working_set is not None:
+        # a new import is the most likely to be read and patched next
+        working_set.put(import_id, (0, None, str(imp['_id'])), citizens)
+
+    if dedup_key is not None:
+        # keys are kept on the config shard, so they are unique across shards
+        try:
+            with span("mongo.insert_one", query="dedup_key"):
+                await config.writer('dedup', profile).insert_one(
+                    {"_id": dedup_key, "import_id": import_id, "body_sha256": digest})
+        except DuplicateKeyError:
+            # the same import was created concurrently by another worker, this one is removed
+            # whatever the lookup ends with, so a 400 or a vanished record leaves no orphan
+            try:
+                duplicate = await find_duplicate(dedup_key, digest)
+            finally:
+                await shard.imports.delete_one({"import_id": import_id})
+                if working_set is not None:
+                    working_set.drop(import_id)
+            if duplicate is None:
+                raise
+            return duplicate, False
+
     log.info(f"Created import with id: {import_id}")
-    return {"data": {"import_id": import_id}}
+    return import_id, True
+
+
+@app.post("/imports/batch", status_code=201)
+@traced
+async def post_imports_batch(request: Request):
+    profile = get_durability("post_imports_batch", request)
+    data = parse_json(await read_body(request))
+    if not isinstance(data, dict) or set(data) != {"imports"} or not isinstance(data["imports"], list):
+        raise HTTPException(status_code=400, detail='Body must be {"imports": [...]}')
+
+    # every import is validated independently, results keep the order of the request
+    results = []
+    created = []
+    with span("validate.imports"):
+        for i, item in enumerate(data["imports"]):
+            try:
+                citizens = validate_import(item, VALIDATION_MAX_ERRORS, MAX_CITIZENS)
+            except ImportValidationError as e:
+                results.append({"error": validation_detail(e, ("body", "imports", i))})
+            else:
+                imp = {"citizens": citizens, "version": 0}
+                results.append(imp)
+                created.append(imp)
+
+    if not created:
+        raise HTTPException(status_code=400, detail=results)
+
+    first_id = await allocate_import_ids(profile, len(created))
+    by_shard = defaultdict(list)
+    for import_id, imp in enumerate(created, first_id):
+        imp['import_id'] = import_id
+        by_shard[ring.shard_for(import_id)].append(imp)
+
+    with span("mongo.insert_many", shards=len(by_shard)):
+        await asyncio.gather(*(shards[name].writer('imports', profile).insert_many(batch)
+                               for name, batch in by_shard.items()))
+    remember_placed(imp['import_id'] for imp in created)
+    log.info(f"Created imports with ids {first_id}..{first_id + len(created) - 1}")
+
+    return {"data": [{"error": r["error"]} if "error" in r else {"import_id": r["import_id"]} for r in results]}
 
 
 @app.patch("/imports/{import_id}/citizens/{citizen_id}")
-async def patch_citizen(import_id: int, citizen_id: int, data: Patch):
+@traced
+async def patch_citizen(import_id: int, citizen_id: int, data: Patch, request: Request):
+    profile = get_durability("patch_citizen", request)
     fields = data.dict(skip_defaults=True)
 
     for k, v in fields.items():
@@ -155,10 +1077,16 @@ async def patch_citizen(import_id: int, citizen_id: int, data: Patch):
     if fields == {}:
         raise HTTPException(status_code=400, detail="Empty patch not allowed")
 
+    shard = await locate(import_id)
+
+    if shard.journal is not None:
+        # journaled patches are always durable, see PatchJournal
+        return await patch_citizen_journaled(import_id, citizen_id, fields, shard)
+
     if "relatives" in fields:
         relatives = fields["relatives"]
         if len(relatives) > 0:
-            cursor = imports.aggregate(
+            cursor = shard.imports.aggregate(
                 [
                     {"$match": {"import_id": import_id}},
                     {"$unwind": "$citizens"},
@@ -166,18 +1094,29 @@ async def patch_citizen(import_id: int, citizen_id: int, data: Patch):
                     {"$group": {"_id": None, "count": {"$sum": 1}}}
                 ]
             )
-            cnt = await cursor.to_list(None)
+            with span("mongo.aggregate", query="relatives"):
+                cnt = await cursor.to_list(None)
             if len(cnt) != 1 or cnt[0]['count'] != len(relatives):
                 raise HTTPException(status_code=400, detail=f"Some relatives does not exists in import {import_id}")
 
-    citizen = await imports.find_one_and_update(
-        filter={"import_id": import_id, "citizens.citizen_id": citizen_id},
-        projection={"citizens.$": True},
-        update={"$set": {f"citizens.$.{k}": v for k, v in fields.items()}},
-        return_document=ReturnDocument.BEFORE)
+    while True:
+        imports_writer = shard.writer('imports', profile)
+        with span("mongo.find_one_and_update"):
+            citizen = await imports_writer.find_one_and_update(
+                filter={"import_id": import_id, "citizens.citizen_id": citizen_id},
+                projection={"citizens.$": True},
+                update={"$set": {f"citizens.$.{k}": v for k, v in fields.items()}, "$inc": {"version": 1}},
+                return_document=ReturnDocument.BEFORE)
+        # the import may have been moved to another shard since it was located
+        moved = await relocate(import_id, shard) if citizen is None else None
+        if moved is None:
+            break
+        shard = moved
 
     if citizen is not None:
         citizen = citizen['citizens'][0]
+        # every update of the import increments its version once
+        updates = 1
 
         if 'relatives' in fields.keys():
 
@@ -188,102 +1127,419 @@ async def patch_citizen(import_id: int, citizen_id: int, data: Patch):
             log.info(f"Relatives to remove for citizen {citizen_id}: {del_rels}")
 
             if len(add_rels) > 0:
-                await imports.update_many(
-                    {"import_id": import_id},
-                    {"$push": {"citizens.$[elem].relatives": citizen_id}},
-                    array_filters=[{"elem.citizen_id": {"$in": list(add_rels)}}]
-                )
+                with span("mongo.update_many", query="add_relatives"):
+                    await imports_writer.update_many(
+                        {"import_id": import_id},
+                        {"$push": {"citizens.$[elem].relatives": citizen_id}, "$inc": {"version": 1}},
+                        array_filters=[{"elem.citizen_id": {"$in": list(add_rels)}}]
+                    )
+                updates += 1
 
             if len(del_rels) > 0:
-                await imports.update_many(
-                    {"import_id": import_id},
-                    {"$pull": {"citizens.$[elem].relatives": citizen_id}},
-                    array_filters=[{"elem.citizen_id": {"$in": list(del_rels)}}]
-                )
-
+                with span("mongo.update_many", query="remove_relatives"):
+                    await imports_writer.update_many(
+                        {"import_id": import_id},
+                        {"$pull": {"citizens.$[elem].relatives": citizen_id}, "$inc": {"version": 1}},
+                        array_filters=[{"elem.citizen_id": {"$in": list(del_rels)}}]
+                    )
+                updates += 1
+
+        await invalidate_snapshots(import_id)
+        await write_through(import_id, shard, citizen_id, fields, updates)
         citizen.update(fields)
         return {"data": citizen}
     else:
         raise HTTPException(status_code=400, detail=f"Citizen {citizen_id} in import {import_id} not found")
 
 
+async def write_through(import_id, shard, citizen_id, fields, updates):
+    """Applies an acknowledged patch to the import in the working set.
+
+    The patch is applied only if the version grew by exactly its own `updates`, otherwise the import was also
+    changed by someone else and is dropped, to be loaded again on the next read.
+    """
+    hot = working_set.imports.get(import_id) if working_set is not None else None
+    if hot is None:
+        return
+    stamp = await get_import_version(import_id, shard)
+    version, journal_seq, _id = hot.stamp
+    if stamp == ((version or 0) + updates, journal_seq, _id) and working_set.imports.get(import_id) is hot:
+        with span("working_set.patch"):
+            working_set.patch(import_id, citizen_id, fields)
+        hot.stamp = stamp
+    else:
+        working_set.drop(import_id)
+
+
+async def patch_citizen_journaled(import_id, citizen_id, fields, shard):
+    relatives = fields.get("relatives", [])
+    # the citizen and the new relatives are checked by one read instead of the overlay of the whole import
+    with span("journal.load_citizen"):
+        citizen, found = await shard.journal.load_citizen(import_id, citizen_id, relatives)
+    if len(found) != len(relatives):
+        raise HTTPException(status_code=400, detail=f"Some relatives does not exists in import {import_id}")
+    if citizen is None:
+        raise HTTPException(status_code=400, detail=f"Citizen {citizen_id} in import {import_id} not found")
+
+    deadline = time.monotonic() + MOVE_WAIT_SECONDS
+    while True:
+        try:
+            with span("journal.append"):
+                await shard.journal.append(import_id, citizen_id, fields)
+            break
+        except ImportMoving:
+            stats["journal.moving_retries"] += 1
+        # a move with `moving_to` set is left by tools/rebalance.py if it died, until the next run rolls it back
+        wait_for_move(import_id, deadline)
+        # tools/rebalance.py is moving the import, the patch is appended on the shard where it ends up
+        moved = await relocate(import_id, shard)
+        if moved is not None:
+            shard = moved
+        elif await shard.imports.find_one({"import_id": import_id}, projection={"_id": True}) is None:
+            raise HTTPException(status_code=400, detail=f"Citizen {citizen_id} in import {import_id} not found")
+        else:
+            await asyncio.sleep(0.01)
+    await invalidate_snapshots(import_id)
+
+    citizen.update(fields)
+    return {"data": citizen}
+
+
+async def update_pipeline(collection, query, pipeline):
+    """Updates one document with an update pipeline, returns the number of matched documents.
+
+    pymongo 3.8 accepts only update documents, so the update command is sent as is.
+    """
+    command = SON([("update", collection.name), ("updates", [{"q": query, "u": pipeline}])])
+    if collection.write_concern.document:
+        command["writeConcern"] = collection.write_concern.document
+    result = await collection.database.command(command)
+    if result.get('writeErrors'):
+        error = result['writeErrors'][0]
+        raise WriteError(error.get('errmsg'), error.get('code'), error)
+    if 'writeConcernError' in result:
+        error = result['writeConcernError']
+        raise WriteConcernError(error.get('errmsg'), error.get('code'), error)
+    return result['n']
+
+
+@app.put("/imports/{import_id}")
+@traced
+async def replace_import(import_id: int, request: Request):
+    profile = get_durability("replace_import", request)
+    citizens = await read_import(request)
+
+    for _ in range(REPLACE_ATTEMPTS):
+        # every attempt locates the import again, as it may be moved to another shard meanwhile
+        shard = await locate(import_id)
+        imports_writer = shard.writer('imports', profile)
+        journal = shard.journal
+        if journal is not None:
+            # pending patches are folded first, so the diff is computed against the current data
+            with span("journal.compact"):
+                await journal.compact(import_id)
+
+        with span("mongo.find_one"):
+            imp = await shard.imports.find_one({"import_id": import_id},
+                                               projection={"citizens": True, "version": True, "journal_seq": True,
+                                                           "journal_folded": True})
+        if imp is None:
+            if await relocate(import_id, shard) is not None:
+                continue
+            raise HTTPException(status_code=400, detail=f"Import with id {import_id} not found")
+
+        if journal is not None:
+            with span("journal.has_pending"):
+                if await journal.has_pending(import_id, imp.get('journal_folded', [])):
+                    continue
+
+        with span("diff"):
+            removed, changed, added = diff_citizens(imp['citizens'], citizens)
+
+        if removed or changed or added:
+            # the delta is applied by one update, so readers see either the old or the new import,
+            # and only if nothing was patched since it was read, also by a patch being journaled
+            with span("mongo.update", removed=len(removed), changed=len(changed), added=len(added)):
+                matched = await update_pipeline(
+                    imports_writer,
+                    {"_id": imp['_id'], "version": imp.get('version'), "journal_seq": imp.get('journal_seq'),
+                     "journal_appending.0": {"$exists": False}},
+                    delta_pipeline(removed, changed, added))
+            await invalidate_snapshots(import_id)
+            if matched == 0:
+                log.info(f"Import {import_id} was changed during replace, retrying")
+                continue
+
+            if working_set is not None:
+                stamp = (imp.get('version'), imp.get('journal_seq'), str(imp['_id']))
+                with span("working_set.replace"):
+                    working_set.apply_diff(import_id, stamp, ((imp.get('version') or 0) + 1,) + stamp[1:],
+                                           removed, changed, added)
+
+        log.info(f"Replaced import {import_id}: {len(added)} added, {len(removed)} removed, {len(changed)} changed")
+        return {"data": {"import_id": import_id, "added": len(added), "removed": len(removed),
+                         "changed": len(changed)}}
+
+    raise HTTPException(status_code=409, detail=f"Import {import_id} is being modified concurrently, try again")
+
+
 @app.get("/imports/{import_id}/citizens")
+@traced
 async def get_citizens(import_id: int):
-    imp = await imports.find_one({"import_id": import_id})
+    if working_set is not None:
+        hot = await get_hot_import(import_id, "get_citizens")
+        with span("working_set.citizens", citizens=len(hot)):
+            return {"data": hot.citizens()}
+
+    shard = await locate(import_id)
+    imp = await find_import(import_id, shard, route="get_citizens")
+    if imp is None:
+        moved = await relocate(import_id, shard)
+        if moved is not None:
+            imp = await find_import(import_id, moved, route="get_citizens")
     if imp is not None:
         return {"data": imp['citizens']}
     else:
         raise HTTPException(status_code=400, detail=f"Import with id {import_id} not found")
 
 
+async def get_hot_import(import_id, route):
+    """Returns the import from the working set, loads it there if it is not there yet"""
+    shard, stamp = await locate_version(import_id)
+    hot = working_set.get(import_id, stamp)
+    if hot is None:
+        imp = await find_import(import_id, shard, route=route)
+        if imp is None:
+            raise HTTPException(status_code=400, detail=f"Import with id {import_id} not found")
+        with span("working_set.load", citizens=len(imp['citizens'])):
+            hot = working_set.put(import_id, stamp, imp['citizens'])
+    return hot
+
+
+async def citizen_batches(import_id, shard, fields, route, stamp):
+    """Yields batches of citizens from the working set if the import is there, otherwise from MongoDB"""
+    hot = working_set.get(import_id, stamp) if working_set is not None and stamp is not None else None
+    if hot is not None:
+        for batch in hot.batches(fields, BATCH_SIZE):
+            yield batch
+        return
+    async for batch in iter_citizens(import_id, shard, fields, route=route, stamp=stamp):
+        yield batch
+
+
+@app.get('/imports/{import_id}/citizens/export')
+@traced
+async def export_citizens(import_id: int, format: ExportFormat = ExportFormat.ndjson, fields: str = None):
+    shard, stamp = await locate_version(import_id)
+
+    columns = list(Citizen.__annotations__.keys())
+    if fields is not None:
+        selected = [f.strip() for f in fields.split(',') if f.strip()]
+        unknown = [f for f in selected if f not in columns]
+        if unknown or not selected:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+        columns = selected
+
+    # the response is produced only as fast as the client reads it
+    batches = citizen_batches(import_id, shard, columns, "export_citizens", stamp)
+
+    if format == ExportFormat.csv:
+        return StreamingResponse(export_csv(batches, columns), media_type="text/csv")
+    else:
+        return StreamingResponse(export_ndjson(batches, columns), media_type="application/x-ndjson")
+
+
+async def export_ndjson(batches, columns):
+    async for batch in batches:
+        lines = [json.dumps({k: c.get(k) for k in columns}, ensure_ascii=False) for c in batch]
+        lines.append('')
+        yield '\n'.join(lines).encode('utf-8')
+
+
+async def export_csv(batches, columns):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    async for batch in batches:
+        for c in batch:
+            writer.writerow([' '.join(map(str, c[k])) if k == 'relatives' else c.get(k) for k in columns])
+        yield buf.getvalue().encode('utf-8')
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue().encode('utf-8')
+
+
 @app.get('/imports/{import_id}/citizens/birthdays')
+@traced
 async def get_birthdays(import_id: int):
-    imp = await imports.find_one({"import_id": import_id}, projection={
-        "import_id": True,
-        "citizens.birth_date": True,
-        "citizens.relatives": True
-    })
-    if imp is None:
-        raise HTTPException(status_code=400, detail=f"Import with id {import_id} not found")
+    shard, version = await locate_version(import_id)
+    return await cache.get("get_birthdays", import_id, version,
+                           lambda: analytics.do(("get_birthdays", import_id, version),
+                                                lambda: compute_birthdays(import_id, shard, version)))
+
+
+async def open_snapshot(import_id, shard, stamp, route):
+    """Returns snapshot of the import version, which is built on the first query, or None"""
+    key = "-".join(str(s) for s in stamp)
+    snapshot = await asyncio.get_event_loop().run_in_executor(None, snapshots.open, import_id, key)
+    if snapshot is None:
+        snapshot = await analytics.do(("build_snapshot", import_id, stamp),
+                                      lambda: build_snapshot(import_id, shard, key, stamp, route))
+    return snapshot
+
+
+async def build_snapshot(import_id, shard, key, stamp, route):
+    builder = ColumnsBuilder()
+    with memory_watermark("build_snapshot"):
+        async for batch in iter_citizens(import_id, shard, ["town", "birth_date", "relatives"], route=route,
+                                         stamp=stamp):
+            with span("snapshot.fold", citizens=len(batch)):
+                builder.add(batch)
+        with span("snapshot.columns"):
+            built = builder.finish()
+    if built is None:
+        return None
+    with span("snapshot.write"):
+        return await asyncio.get_event_loop().run_in_executor(None, snapshots.write, import_id, key, *built)
+
+
+async def invalidate_snapshots(import_id):
+    if snapshots is not None:
+        await asyncio.get_event_loop().run_in_executor(None, snapshots.invalidate, import_id)
+
+
+async def compute_birthdays(import_id, shard, stamp=None):
+    if snapshots is not None and stamp is not None:
+        snapshot = await open_snapshot(import_id, shard, stamp, "get_birthdays")
+        if snapshot is not None:
+            with span("compute.snapshot"):
+                presents = birthday_presents(snapshot)
+                result = {str(i): [{"citizen_id": k, "presents": v} for k, v in presents.get(i, [])]
+                          for i in range(1, 13)}
+            return {"data": result}
 
     birthdays = defaultdict(Counter)
 
-    for c in imp['citizens']:
-        d, m, y = c['birth_date'].split('.')
-        for r in c['relatives']:
-            cnt = birthdays[int(m)]
-            cnt[r] += 1
+    # citizens are folded into counters batch by batch, the import is never loaded as a whole
+    with memory_watermark("get_birthdays"):
+        async for batch in citizen_batches(import_id, shard, ["birth_date", "relatives"], "get_birthdays", stamp):
+            with span("compute.fold", citizens=len(batch)):
+                _, months, _ = parse_birth_dates([c['birth_date'] for c in batch])
+
+                for m, c in zip(months.tolist(), batch):
+                    if c['relatives']:
+                        birthdays[m].update(c['relatives'])
 
     result = {}
 
-    for i in range(1, 13):
-        if i in birthdays.keys():
-            result[str(i)] = [{"citizen_id": k, "presents": v} for k, v in birthdays[i].items()]
-        else:
-            result[str(i)] = []
+    with span("compute.result"):
+        for i in range(1, 13):
+            if i in birthdays.keys():
+                result[str(i)] = [{"citizen_id": k, "presents": v} for k, v in birthdays[i].items()]
+            else:
+                result[str(i)] = []
 
     return {"data": result}
 
 
 @app.get('/imports/{import_id}/towns/stat/percentile/age')
+@traced
 async def get_age_stat(import_id: int):
-    imp = await imports.find_one({"import_id": import_id}, projection={
-        "import_id": True,
-        "citizens.birth_date": True,
-        "citizens.town": True
-    })
-    if imp is None:
-        raise HTTPException(status_code=400, detail=f"Import with id {import_id} not found")
+    shard, version = await locate_version(import_id)
+    # ages change with the date, so a result is valid only for the day it was computed on
+    today = datetime.datetime.utcnow().date()
+    return await cache.get("get_age_stat", import_id, (version, today),
+                           lambda: analytics.do(("get_age_stat", import_id, version),
+                                                lambda: compute_age_stat(import_id, shard, version)))
+
 
-    towns = defaultdict(list)
+async def compute_age_stat(import_id, shard, stamp=None):
+    # ages are small integers, so a histogram per town is enough for exact percentiles
+    towns = defaultdict(Counter)
 
     now = datetime.datetime.utcnow()
 
-    for c in imp['citizens']:
-        d, m, year = c['birth_date'].split('.')
-        age = now.year - int(year) - ((now.month, now.day) < (int(m), int(d)))
-        towns[c['town']].append(age)
+    snapshot = None
+    if snapshots is not None and stamp is not None:
+        snapshot = await open_snapshot(import_id, shard, stamp, "get_age_stat")
+
+    if snapshot is not None:
+        with span("compute.snapshot"):
+            towns.update(age_histograms(snapshot, now))
+    else:
+        with memory_watermark("get_age_stat"):
+            async for batch in citizen_batches(import_id, shard, ["birth_date", "town"], "get_age_stat", stamp):
+                with span("compute.fold", citizens=len(batch)):
+                    days, months, years = parse_birth_dates([c['birth_date'] for c in batch])
+
+                    for age, c in zip(ages(days, months, years, now).tolist(), batch):
+                        towns[c['town']][age] += 1
 
     result = []
 
     log.debug(f"TOWNS: {towns}")
 
-    for town, ages in towns.items():
-        result.append({
-            "town": town,
-            "p50": round(np.percentile(ages, 50, interpolation='linear'), 2),
-            "p75": round(np.percentile(ages, 75, interpolation='linear'), 2),
-            "p99": round(np.percentile(ages, 99, interpolation='linear'), 2)
-        })
+    with span("compute.result"):
+        for town, town_ages in towns.items():
+            result.append({
+                "town": town,
+                "p50": round(percentile(town_ages, 50), 2),
+                "p75": round(percentile(town_ages, 75), 2),
+                "p99": round(percentile(town_ages, 99), 2)
+            })
+
+    return {"data": result}
+
 
+def merge_journal_stats(shard_stats):
+    """Sums journal stats of the shards, except for maximums"""
+    result = Counter()
+    for stats_of_shard in shard_stats:
+        for k, v in stats_of_shard.items():
+            result[k] = max(result[k], v) if k in ("journal.max_batch_size", "journal.compaction_lag") else result[k] + v
+    return dict(result)
+
+
+@app.get('/stats')
+@traced
+async def get_stats():
+    result = dict(stats)
+    for name, limiter in limiters.items():
+        result[f"limits.{name}.active"] = limiter.active
+        result[f"limits.{name}.waiting"] = len(limiter.waiters)
+    result["memory.max_rss_kb"] = max_rss_kb()
+    rss = rss_kb()
+    if rss is not None:
+        result["memory.rss_kb"] = rss
+    result["cache.entries"] = len(cache.entries)
+    if TRACE_MEMORY:
+        current, peak = tracemalloc.get_traced_memory()
+        result["memory.traced_kb"] = current // 1024
+        result["memory.traced_peak_kb"] = peak // 1024
+    if PATCH_JOURNAL:
+        result.update(merge_journal_stats(await asyncio.gather(*(shard.journal.get_stats()
+                                                                 for shard in shards.values()))))
+    if snapshots is not None:
+        result.update(snapshots.get_stats())
+    if working_set is not None:
+        result.update(working_set.get_stats())
     return {"data": result}
 
 
 @app.post('/clear')
+@traced
 async def clear(data: Token):
-    if data.dict()['token'] == os.getenv('YB_TOKEN', '52ce8098-d510-4bbc-88b9-e1a733292786'):
-        await imports.drop()
-        await counter.drop()
+    if hmac.compare_digest(data.dict()['token'].encode('utf-8'), TOKEN.encode('utf-8')):
+        with span("mongo.drop", shards=len(shards)):
+            await asyncio.gather(*(shard.drop() for shard in shards.values()))
+        placed.clear()
+        cache.entries.clear()
+        if working_set is not None:
+            working_set.clear()
+        if snapshots is not None:
+            await asyncio.get_event_loop().run_in_executor(None, snapshots.clear)
+        with span("mongo.create_index", shards=len(shards)):
+            await asyncio.gather(*(shard.ensure_indexes() for shard in shards.values()))
         return {"data": "ok"}
     else:
         raise HTTPException(status_code=400)
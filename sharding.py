@@ -0,0 +1,47 @@
+"""Application-level sharding of imports by import_id across several MongoDB deployments.
+
+Every import lives in one shard, which is chosen by a consistent hash ring of shard names, so adding
+a shard to the list moves only the imports which the ring assigns to it (see tools/rebalance.py).
+The first shard of the list is the config shard: it also keeps the global counters (ids of imports
+and of journaled patches) and idempotency keys of imports.
+"""
+import hashlib
+from bisect import bisect_right
+
+
+def parse_mongo_urls(value, default):
+    """Parse shards in form `name=url name=url ...` as a list of (name, url).
+
+    Shards are separated by whitespace, because urls of replica sets contain commas. A shard without
+    a name is named by its position, `shard0`, `shard1`, ... An empty value is a single shard with `default` url.
+    """
+    shards = []
+    for i, item in enumerate(value.split()):
+        name, sep, url = item.partition('=')
+        if not sep or '://' in name:
+            name, url = f"shard{i}", item
+        if any(name == n for n, _ in shards):
+            raise ValueError(f"Duplicate shard name {name}")
+        shards.append((name, url))
+    return shards or [("shard0", default)]
+
+
+def hash_point(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring, each shard owns `vnodes` points so imports are spread evenly"""
+
+    def __init__(self, names, vnodes=160):
+        points = sorted((hash_point(f"{name}#{i}"), name) for name in names for i in range(vnodes))
+        self.names = list(names)
+        self.points = [p for p, _ in points]
+        self.owners = [name for _, name in points]
+
+    def shard_for(self, import_id):
+        """Returns name of the shard which owns the import"""
+        if len(self.names) == 1:
+            return self.names[0]
+        i = bisect_right(self.points, hash_point(str(import_id)))
+        return self.owners[i % len(self.owners)]
@@ -0,0 +1,215 @@
+"""Local columnar snapshots of imports for analytics.
+
+A snapshot keeps the columns analytics need as `.npy` files in a directory per import version:
+citizen ids, town codes (names are in `towns.json`), birth date day, month and year and relatives
+as CSR arrays (`offsets` and positions of relatives in the columns). Files are opened with
+`mmap_mode='r'`, so all workers on the host share them through the page cache without copying.
+
+Snapshots are immutable, a patched import gets a new version and so a new snapshot. The total size of
+the directory is bounded, least recently used snapshots are evicted first.
+"""
+import json
+import os
+import shutil
+import time
+import uuid
+from collections import Counter
+
+from dates import parse_birth_dates, ages
+
+COLUMNS = ("citizen_id", "town", "day", "month", "year", "offsets", "relatives")
+
+
+class Snapshot:
+    def __init__(self, path, columns, towns):
+        self.path = path
+        self.towns = towns
+        for name in COLUMNS:
+            setattr(self, name, columns[name])
+
+    def __len__(self):
+        return len(self.citizen_id)
+
+
+class ColumnsBuilder:
+    """Collects snapshot columns from batches of citizens, so the import is never loaded as a whole"""
+
+    def __init__(self):
+        self.towns = {}
+        self.citizen_id, self.town, self.dates, self.offsets, self.relatives = [], [], [], [0], []
+
+    def add(self, batch):
+        towns = self.towns
+        for c in batch:
+            self.citizen_id.append(c['citizen_id'])
+            self.town.append(towns.setdefault(c['town'], len(towns)))
+            self.dates.append(c['birth_date'])
+            self.relatives.extend(c['relatives'])
+            self.offsets.append(len(self.relatives))
+
+    def finish(self):
+        """Returns columns and town names, or None if the citizens can't be stored as columns"""
+        import numpy as np
+
+        positions = {citizen_id: i for i, citizen_id in enumerate(self.citizen_id)}
+        try:
+            relatives = [positions[r] for r in self.relatives]
+            citizen_id = np.array(self.citizen_id, dtype=np.int64)
+        except (KeyError, OverflowError):
+            # a relative outside of the import or an id which does not fit into int64
+            return None
+
+        day, month, year = parse_birth_dates(self.dates)
+        columns = {
+            "citizen_id": citizen_id,
+            "town": np.array(self.town, dtype=np.int32),
+            "day": day.astype(np.int8),
+            "month": month.astype(np.int8),
+            "year": year.astype(np.int16),
+            "offsets": np.array(self.offsets, dtype=np.int64),
+            "relatives": np.array(relatives, dtype=np.int32)
+        }
+        return columns, list(self.towns)
+
+
+def birthday_presents(snapshot):
+    """Returns month -> list of (citizen_id, presents), same as counting relatives by birth month one by one"""
+    import numpy as np
+
+    n = len(snapshot)
+    if n == 0:
+        return {}
+    months = np.repeat(snapshot.month.astype(np.int64), np.diff(snapshot.offsets))
+    keys, counts = np.unique(months * n + snapshot.relatives, return_counts=True)
+    ids = snapshot.citizen_id[keys % n]
+
+    result = {}
+    for month, citizen_id, presents in zip((keys // n).tolist(), ids.tolist(), counts.tolist()):
+        result.setdefault(month, []).append((citizen_id, presents))
+    return result
+
+
+def age_histograms(snapshot, now):
+    """Returns list of (town, Counter of ages) in the order towns first appear in the import"""
+    import numpy as np
+
+    citizen_ages = ages(snapshot.day.astype(np.int32), snapshot.month.astype(np.int32),
+                        snapshot.year.astype(np.int32), now)
+    if len(citizen_ages) == 0:
+        return []
+    low = int(citizen_ages.min())
+    width = int(citizen_ages.max()) - low + 1
+    keys, counts = np.unique(snapshot.town.astype(np.int64) * width + (citizen_ages - low), return_counts=True)
+
+    histograms = [Counter() for _ in snapshot.towns]
+    for town, age, count in zip((keys // width).tolist(), (keys % width + low).tolist(), counts.tolist()):
+        histograms[town][age] = count
+    return [(town, h) for town, h in zip(snapshot.towns, histograms) if h]
+
+
+class SnapshotStore:
+    """Directory of snapshots `<directory>/<import_id>/<key>/`, bounded by `max_bytes`"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = Counter()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, import_id, key=None):
+        path = os.path.join(self.directory, str(import_id))
+        return path if key is None else os.path.join(path, key)
+
+    def open(self, import_id, key):
+        """Returns memory mapped snapshot or None if there is none"""
+        import numpy as np
+
+        path = self.path(import_id, key)
+        try:
+            columns = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in COLUMNS}
+            with open(os.path.join(path, "towns.json"), encoding='utf-8') as f:
+                towns = json.load(f)
+            # the directory mtime is the last use for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            self.stats["snapshots.misses"] += 1
+            return None
+        self.stats["snapshots.hits"] += 1
+        return Snapshot(path, columns, towns)
+
+    def write(self, import_id, key, columns, towns):
+        """Writes snapshot atomically, replaces snapshots of other versions of the import"""
+        import numpy as np
+
+        size = sum(c.nbytes for c in columns.values())
+        if size > self.max_bytes:
+            return None
+
+        parent = self.path(import_id)
+        os.makedirs(parent, exist_ok=True)
+        tmp = os.path.join(parent, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp)
+        try:
+            for name, column in columns.items():
+                np.save(os.path.join(tmp, f"{name}.npy"), column)
+            with open(os.path.join(tmp, "towns.json"), 'w', encoding='utf-8') as f:
+                json.dump(towns, f, ensure_ascii=False)
+            os.rename(tmp, self.path(import_id, key))
+        except OSError:
+            # another worker has written the same snapshot
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        try:
+            names = os.listdir(parent)
+        except FileNotFoundError:
+            # the import is invalidated while the snapshot was written, the caller reads the import
+            return None
+        for name in names:
+            if name != key and not name.startswith(".tmp-"):
+                shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+        self.stats["snapshots.written"] += 1
+        self.evict()
+        return self.open(import_id, key)
+
+    def invalidate(self, import_id):
+        shutil.rmtree(self.path(import_id), ignore_errors=True)
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def list(self):
+        """Returns list of (last use, size, path) of all snapshots"""
+        result = []
+        for import_dir in os.scandir(self.directory):
+            try:
+                for snapshot_dir in os.scandir(import_dir.path):
+                    if not snapshot_dir.name.startswith(".tmp-"):
+                        size = sum(f.stat().st_size for f in os.scandir(snapshot_dir.path))
+                        result.append((snapshot_dir.stat().st_mtime, size, snapshot_dir.path))
+            except FileNotFoundError:
+                # removed by another worker
+                pass
+        return result
+
+    def evict(self):
+        """Removes least recently used snapshots until the total size fits into `max_bytes`"""
+        snapshots = sorted(self.list())
+        total = sum(size for _, size, _ in snapshots)
+        for _, size, path in snapshots:
+            if total <= self.max_bytes:
+                break
+            # files which are mapped by other workers stay readable until they are unmapped
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            self.stats["snapshots.evicted"] += 1
+
+    def get_stats(self):
+        result = dict(self.stats)
+        snapshots = self.list()
+        result["snapshots.count"] = len(snapshots)
+        result["snapshots.bytes"] = sum(size for _, size, _ in snapshots)
+        if snapshots:
+            result["snapshots.oldest_use_age"] = round(time.time() - min(s[0] for s in snapshots), 3)
+        return result
@@ -0,0 +1,50 @@
+import requests
+
+from .utils import get_server_api, get_random_citizen, clear_mongo_db
+
+
+def setup():
+    clear_mongo_db()
+
+
+def teardown():
+    clear_mongo_db()
+
+
+def test_batch_imports():
+    server_api = get_server_api()
+    imports = [{'citizens': [get_random_citizen(relatives=False) for _ in range(3)]} for _ in range(5)]
+    invalid = {'citizens': [get_random_citizen(relatives=True)]}
+
+    r = requests.post(f"{server_api}/imports/batch", json={'imports': imports[:2] + [invalid] + imports[2:]})
+    print(f"RESPONSE: {r.json()}")
+    assert r.status_code == 201
+    result = r.json()['data']
+    assert len(result) == 6
+    assert "error" in result[2]
+
+    ids = [item['import_id'] for item in result[:2] + result[3:]]
+    assert ids == list(range(ids[0], ids[0] + 5))
+
+    for import_id, imp in zip(ids, imports):
+        r = requests.get(f"{server_api}/imports/{import_id}/citizens")
+        assert r.status_code == 200
+        assert sorted(r.json()['data'], key=lambda c: c['citizen_id']) == \
+            sorted(imp['citizens'], key=lambda c: c['citizen_id'])
+
+    # ids keep growing after a batch
+    r = requests.post(f"{server_api}/imports", json=imports[0])
+    assert r.status_code == 201
+    assert r.json()['data']['import_id'] == ids[-1] + 1
+
+
+def test_batch_imports_all_invalid():
+    server_api = get_server_api()
+    invalid = {'citizens': [get_random_citizen(relatives=True)]}
+
+    r = requests.post(f"{server_api}/imports/batch", json={'imports': [invalid, invalid]})
+    assert r.status_code == 400
+    assert len(r.json()['detail']) == 2
+
+    r = requests.post(f"{server_api}/imports/batch", json={'citizens': []})
+    assert r.status_code == 400
@@ -0,0 +1,134 @@
+import asyncio
+import json
+from collections import Counter
+
+from fastapi import FastAPI
+from pydantic import BaseModel
+from starlette.requests import Request
+
+from body_limits import BodyLimitMiddleware, CitizenCounter, route_name
+from tools.generate import Generator, iter_json
+
+
+class Patch(BaseModel):
+    name: str
+
+
+def make_app(limits, max_bytes):
+    app = FastAPI()
+    stats = Counter()
+    read = []
+
+    @app.post("/imports")
+    async def post_imports(request: Request):
+        body = bytearray()
+        async for chunk in request.stream():
+            body += chunk
+        read.append(len(body))
+        return {"data": len(body)}
+
+    @app.patch("/patch")
+    async def patch(data: Patch):
+        return {"data": data.name}
+
+    app.add_middleware(BodyLimitMiddleware, limits=limits, max_bytes=max_bytes, stats=stats)
+    return app, stats, read
+
+
+def request(app, method, path, chunks, content_length=None):
+    """Sends the body in `chunks`, returns status, response body and the number of chunks the app received"""
+    headers = [(b'content-type', b'application/json')]
+    if content_length is not None:
+        headers.append((b'content-length', str(content_length).encode()))
+    scope = {"type": "http", "method": method, "path": path, "headers": headers, "query_string": b"",
+             "root_path": "", "scheme": "http", "server": ("test", 80), "client": ("test", 1), "http_version": "1.1"}
+    messages = [{"type": "http.request", "body": c, "more_body": i < len(chunks) - 1} for i, c in enumerate(chunks)]
+    received = []
+    sent = []
+
+    async def receive():
+        received.append(messages[len(received)])
+        return received[-1]
+
+    async def send(message):
+        sent.append(message)
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(app(scope, receive, send))
+    loop.close()
+    body = b''.join(m.get('body', b'') for m in sent if m['type'] == 'http.response.body')
+    return sent[0]['status'], json.loads(body), len(received)
+
+
+def test_citizens_are_counted_across_chunks():
+    body = ''.join(iter_json(Generator(seed=0).citizens(1000))).encode()
+    for size in (1, 7, 64, 1000, len(body)):
+        counter = CitizenCounter()
+        for start in range(0, len(body), size):
+            counter.feed(body[start:start + size])
+        assert counter.count == 1000
+
+    counter = CitizenCounter()
+    counter.feed(b'{"citizens": [{"citizen_id" ')
+    counter.feed(b' : 1, "name": "citizen_id"}]}')
+    assert counter.count == 1
+
+
+def test_content_length_over_the_limit_is_rejected_before_reading():
+    app, stats, read = make_app({"post_imports": (100, 0)}, 0)
+    status, body, received = request(app, "POST", "/imports", [b'x' * 101], content_length=101)
+    assert status == 413
+    assert received == 0
+    assert read == []
+    assert stats["body.post_imports.rejected"] == 1
+
+
+def test_invalid_content_length_is_rejected():
+    app, stats, read = make_app({"post_imports": (100, 0)}, 0)
+    status, body, received = request(app, "POST", "/imports", [b'x'], content_length="1x")
+    assert (status, body, received) == (400, {"detail": "Invalid Content-Length header"}, 0)
+    assert read == []
+
+
+def test_body_over_the_limit_is_rejected_while_reading():
+    app, stats, read = make_app({"post_imports": (100, 0)}, 0)
+    status, body, received = request(app, "POST", "/imports", [b'x' * 60] * 5)
+    assert status == 413
+    assert body == {"detail": "Request body is larger than 100 bytes"}
+    assert received == 2
+    assert read == []
+    assert stats["body.bytes_in_flight"] == 0
+    assert stats["body.max_bytes_in_flight"] == 120
+
+    status, body, _ = request(app, "POST", "/imports", [b'x' * 50] * 2)
+    assert (status, body) == (200, {"data": 100})
+
+
+def test_too_many_citizens_are_rejected_while_reading():
+    app, stats, read = make_app({"post_imports": (0, 10)}, 0)
+    body = ''.join(iter_json(Generator(seed=0).citizens(100))).encode()
+    chunks = [body[start:start + 100] for start in range(0, len(body), 100)]
+    status, detail, received = request(app, "POST", "/imports", chunks)
+    assert status == 413
+    assert detail == {"detail": "Import has more than 10 citizens"}
+    assert received < len(chunks) / 5
+
+    body = ''.join(iter_json(Generator(seed=0).citizens(10))).encode()
+    assert request(app, "POST", "/imports", [body])[0] == 200
+
+
+def test_routes_validated_by_models_get_413():
+    app, stats, _ = make_app({}, 100)
+    status, body, _ = request(app, "PATCH", "/patch", [b'{"name": "', b'x' * 100, b'"}'])
+    assert status == 413
+    assert stats["body.patch.rejected"] == 1
+
+    assert request(app, "PATCH", "/patch", [b'{"name": "name"}']) == (200, {"data": "name"}, 1)
+
+
+def test_route_is_matched_once():
+    app, _, _ = make_app({}, 0)
+    scope = {"type": "http", "method": "PATCH", "path": "/patch", "app": app}
+    assert route_name(scope) == "patch"
+    app.router.routes.clear()
+    assert route_name(scope) == "patch"
@@ -0,0 +1,77 @@
+"""Stress test of analytics caches of several workers.
+
+Run the application with several workers, e.g. `uvicorn --workers 4 main:app`, every request below uses
+a new connection, so consecutive requests are served by different workers with their own caches.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .utils import get_server_api, get_random_citizen, clear_mongo_db
+
+WRITERS = 8
+
+ROUNDS = 12
+
+READS = 4
+
+
+def setup():
+    clear_mongo_db()
+
+
+def teardown():
+    clear_mongo_db()
+
+
+def birthday_presents(server_api, import_id):
+    r = requests.get(f"{server_api}/imports/{import_id}/citizens/birthdays", headers={"Connection": "close"})
+    assert r.status_code == 200
+    return {month: {p['citizen_id']: p['presents'] for p in presents} for month, presents in r.json()['data'].items()}
+
+
+def age_towns(server_api, import_id):
+    r = requests.get(f"{server_api}/imports/{import_id}/towns/stat/percentile/age", headers={"Connection": "close"})
+    assert r.status_code == 200
+    return {t['town'] for t in r.json()['data']}
+
+
+def patch_and_read(server_api, import_id, first, second):
+    for i in range(ROUNDS):
+        # the other citizen is born in January
+        month = i % 11 + 2
+        r = requests.patch(f"{server_api}/imports/{import_id}/citizens/{first}",
+                           json={"birth_date": f"01.{month:02}.1990", "town": f"town {i}"},
+                           headers={"Connection": "close"})
+        assert r.status_code == 200
+
+        # the patch is acknowledged, no worker may serve a result computed before it
+        for _ in range(READS):
+            presents = birthday_presents(server_api, import_id)
+            assert presents[str(month)] == {second: 1}
+            assert presents["1"] == {first: 1}
+            assert all(not p for m, p in presents.items() if m not in ("1", str(month)))
+            assert f"town {i}" in age_towns(server_api, import_id)
+
+
+def test_reads_after_patch_on_all_workers():
+    server_api = get_server_api()
+
+    import_ids = []
+    for _ in range(WRITERS):
+        first, second = get_random_citizen(relatives=False), get_random_citizen(relatives=False)
+        first['relatives'] = [second['citizen_id']]
+        second['relatives'] = [first['citizen_id']]
+        second['birth_date'] = "01.01.1990"
+        r = requests.post(f"{server_api}/imports", json={'citizens': [first, second]})
+        assert r.status_code == 201
+        import_ids.append((r.json()['data']['import_id'], first['citizen_id'], second['citizen_id']))
+
+        # every worker caches the results of the import before it is patched
+        for _ in range(READS):
+            birthday_presents(server_api, import_ids[-1][0])
+            age_towns(server_api, import_ids[-1][0])
+
+    with ThreadPoolExecutor(max_workers=WRITERS) as pool:
+        for f in [pool.submit(patch_and_read, server_api, *ids) for ids in import_ids]:
+            f.result()
@@ -0,0 +1,30 @@
+import datetime
+import random
+
+from dates import parse_birth_dates, ages
+
+
+def expected_age(date, now):
+    d, m, year = date.split('.')
+    return now.year - int(year) - ((now.month, now.day) < (int(m), int(d)))
+
+
+def test_ages_match_per_citizen_logic():
+    dates = ['29.02.2000', '28.02.2000', '01.03.2000', '1.3.2000', '31.12.1999', '01.01.2000', '9.8.2015']
+    dates += [f"{random.randint(1, 28)}.{random.randint(1, 12)}.{random.randint(1900, 2018)}" for _ in range(1000)]
+
+    for now in [datetime.datetime(2019, 2, 28), datetime.datetime(2019, 3, 1), datetime.datetime(2020, 2, 28),
+                datetime.datetime(2020, 2, 29), datetime.datetime(2020, 3, 1), datetime.datetime(2019, 12, 31),
+                datetime.datetime(2020, 1, 1), datetime.datetime.utcnow()]:
+        days, months, years = parse_birth_dates(dates)
+        assert ages(days, months, years, now).tolist() == [expected_age(d, now) for d in dates]
+
+
+def test_parse_birth_dates():
+    days, months, years = parse_birth_dates(['01.02.2000', '9.12.1980'])
+    assert days.tolist() == [1, 9]
+    assert months.tolist() == [2, 12]
+    assert years.tolist() == [2000, 1980]
+
+    days, months, years = parse_birth_dates([])
+    assert len(days) == len(months) == len(years) == 0
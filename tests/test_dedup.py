@@ -0,0 +1,55 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .utils import get_server_api, get_random_citizen, clear_mongo_db
+
+
+def setup():
+    clear_mongo_db()
+
+
+def teardown():
+    clear_mongo_db()
+
+
+def test_idempotency_key():
+    server_api = get_server_api()
+    body = json.dumps({'citizens': [get_random_citizen(relatives=False) for _ in range(5)]})
+    headers = {"Content-Type": "application/json", "Idempotency-Key": "import-1"}
+
+    r = requests.post(f"{server_api}/imports", data=body, headers=headers)
+    assert r.status_code == 201
+    import_id = r.json()['data']['import_id']
+    assert 'Idempotent-Replayed' not in r.headers
+
+    r = requests.post(f"{server_api}/imports", data=body, headers=headers)
+    assert r.status_code == 201
+    assert r.json()['data']['import_id'] == import_id
+    assert r.headers['Idempotent-Replayed'] == "true"
+
+    # same key with another body
+    other = json.dumps({'citizens': [get_random_citizen(relatives=False)]})
+    r = requests.post(f"{server_api}/imports", data=other, headers=headers)
+    assert r.status_code == 400
+
+    # without a key every request creates a new import
+    r = requests.post(f"{server_api}/imports", data=body, headers={"Content-Type": "application/json"})
+    assert r.status_code == 201
+    assert r.json()['data']['import_id'] != import_id
+
+
+def test_concurrent_retries():
+    server_api = get_server_api()
+    body = json.dumps({'citizens': [get_random_citizen(relatives=False) for _ in range(1000)]})
+    headers = {"Content-Type": "application/json", "Idempotency-Key": "import-2"}
+
+    def post(_):
+        return requests.post(f"{server_api}/imports", data=body, headers=headers)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        responses = list(pool.map(post, range(8)))
+
+    assert all(r.status_code == 201 for r in responses)
+    assert len(set(r.json()['data']['import_id'] for r in responses)) == 1
@@ -0,0 +1,89 @@
+import copy
+
+from diff import diff_citizens, delta_pipeline
+
+from .examples import CITIZEN
+
+
+def citizen(citizen_id, **fields):
+    return dict(CITIZEN, citizen_id=citizen_id, **fields)
+
+
+def test_diff_citizens():
+    old = [citizen(1, relatives=[2, 3]), citizen(2, relatives=[1]), citizen(3, relatives=[1]), citizen(4)]
+    new = [citizen(1, relatives=[3, 2], name="new"), citizen(2, relatives=[5]), citizen(3, relatives=[1]),
+           citizen(5, relatives=[2])]
+
+    removed, changed, added = diff_citizens(old, new)
+    assert removed == [4]
+    assert changed == {1: {"name": "new"}, 2: {"relatives": [5]}}
+    assert added == [new[3]]
+
+
+def test_diff_same_citizens():
+    old = [citizen(1, relatives=[2]), citizen(2, relatives=[1])]
+    assert diff_citizens(old, [dict(c) for c in old]) == ([], {}, [])
+
+
+
+def evaluate(expr, doc, variables):
+    """Evaluates the aggregation expressions used by delta_pipeline, as MongoDB does"""
+    if isinstance(expr, str) and expr.startswith("$$"):
+        name, _, path = expr[2:].partition(".")
+        value = variables[name]
+        return value[path] if path else value
+    if isinstance(expr, str) and expr.startswith("$"):
+        return doc.get(expr[1:])
+    if isinstance(expr, list):
+        return [evaluate(e, doc, variables) for e in expr]
+    if not isinstance(expr, dict):
+        return expr
+    (op, args), = expr.items()
+    if op == "$literal":
+        return copy.deepcopy(args)
+    if op in ("$map", "$filter"):
+        key = "in" if op == "$map" else "cond"
+        items = evaluate(args["input"], doc, variables)
+        values = [evaluate(args[key], doc, dict(variables, **{args["as"]: item})) for item in items]
+        return values if op == "$map" else [item for item, keep in zip(items, values) if keep]
+    if op == "$let":
+        local = {k: evaluate(v, doc, variables) for k, v in args["vars"].items()}
+        return evaluate(args["in"], doc, dict(variables, **local))
+    if op == "$cond":
+        condition, then, otherwise = args
+        return evaluate(then if evaluate(condition, doc, variables) else otherwise, doc, variables)
+    a = evaluate(args, doc, variables)
+    operations = {
+        "$concatArrays": lambda: [x for part in a for x in part],
+        "$not": lambda: not a[0],
+        "$in": lambda: a[0] in a[1],
+        "$eq": lambda: a[0] == a[1],
+        "$indexOfArray": lambda: a[0].index(a[1]) if a[1] in a[0] else -1,
+        "$arrayElemAt": lambda: a[0][a[1]],
+        "$mergeObjects": lambda: dict(a[0], **a[1]),
+        "$ifNull": lambda: a[1] if a[0] is None else a[0],
+        "$add": lambda: sum(a),
+    }
+    return operations[op]()
+
+
+def apply_pipeline(pipeline, doc):
+    for stage in pipeline:
+        (op, fields), = stage.items()
+        assert op == "$set"
+        doc = dict(doc, **{k: evaluate(v, doc, {}) for k, v in fields.items()})
+    return doc
+
+
+def test_delta_pipeline_gives_new_citizens():
+    old = [citizen(1, relatives=[2, 3]), citizen(2, relatives=[1]), citizen(3, relatives=[1]), citizen(4)]
+    new = [citizen(1, relatives=[3], name="$name"), citizen(3, relatives=[1]), citizen(4, town="new"),
+           citizen(5, street="$citizens")]
+
+    removed, changed, added = diff_citizens(old, new)
+    doc = apply_pipeline(delta_pipeline(removed, changed, added), {"citizens": copy.deepcopy(old), "version": 3})
+    assert doc["version"] == 4
+    assert sorted(doc["citizens"], key=lambda c: c["citizen_id"]) == new
+
+    doc = apply_pipeline(delta_pipeline([], {}, []), {"citizens": copy.deepcopy(old)})
+    assert doc == {"citizens": old, "version": 1}
@@ -0,0 +1,49 @@
+import os
+
+import pytest
+import requests
+
+from .utils import get_server_api, get_random_citizen, clear_mongo_db
+
+TOKEN = os.getenv('YB_TOKEN', '52ce8098-d510-4bbc-88b9-e1a733292786')
+
+
+def setup():
+    clear_mongo_db()
+
+
+def teardown():
+    clear_mongo_db()
+
+
+@pytest.mark.skipif('YB_TOKEN' not in os.environ, reason="X-Durability requires YB_TOKEN to be set")
+def test_durability_profiles():
+    server_api = get_server_api()
+    citizen = get_random_citizen(relatives=False)
+    data = {'citizens': [citizen]}
+
+    for profile in ("fast", "durable"):
+        headers = {"X-Durability": profile, "X-Token": TOKEN}
+        r = requests.post(f"{server_api}/imports", json=data, headers=headers)
+        assert r.status_code == 201
+        import_id = r.json()['data']['import_id']
+
+        r = requests.patch(f"{server_api}/imports/{import_id}/citizens/{citizen['citizen_id']}",
+                           json={"name": profile}, headers=headers)
+        assert r.status_code == 200
+        assert r.json()['data']['name'] == profile
+
+
+def test_durability_requires_token():
+    server_api = get_server_api()
+    data = {'citizens': [get_random_citizen(relatives=False)]}
+
+    r = requests.post(f"{server_api}/imports", json=data, headers={"X-Durability": "fast"})
+    assert r.status_code == 403
+
+    r = requests.post(f"{server_api}/imports", json=data, headers={"X-Durability": "fast", "X-Token": "wrong"})
+    assert r.status_code == 403
+
+    r = requests.post(f"{server_api}/imports", json=data, headers={"X-Durability": "unknown", "X-Token": TOKEN})
+    # the default token is public and is not accepted
+    assert r.status_code == (400 if 'YB_TOKEN' in os.environ else 403)
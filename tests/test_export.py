@@ -0,0 +1,79 @@
+import csv
+import io
+import json
+
+import requests
+
+from .utils import get_server_api, get_random_citizen, clear_mongo_db
+
+
+def setup():
+    clear_mongo_db()
+
+
+def teardown():
+    clear_mongo_db()
+
+
+def post_import(citizens):
+    server_api = get_server_api()
+    data = {
+        'citizens': citizens
+    }
+    r = requests.post(f"{server_api}/imports", json=data)
+    assert r.status_code == 201
+    return r.json()['data']['import_id']
+
+
+def test_export_ndjson():
+    server_api = get_server_api()
+
+    citizens = [get_random_citizen(relatives=False) for _ in range(2500)]
+    import_id = post_import(citizens)
+
+    r = requests.get(f"{server_api}/imports/{import_id}/citizens/export", stream=True)
+    assert r.status_code == 200
+    assert r.headers['content-type'].startswith('application/x-ndjson')
+
+    exported = [json.loads(line) for line in r.iter_lines() if line]
+    assert exported == citizens
+
+    r = requests.get(f"{server_api}/imports/{import_id}/citizens/export?fields=citizen_id,town")
+    assert r.status_code == 200
+
+    exported = [json.loads(line) for line in r.text.splitlines()]
+    assert exported == [{"citizen_id": c["citizen_id"], "town": c["town"]} for c in citizens]
+
+
+def test_export_csv():
+    server_api = get_server_api()
+
+    citizens = [get_random_citizen(relatives=False) for _ in range(5)]
+    citizens[0]['relatives'] = [citizens[1]['citizen_id']]
+    citizens[1]['relatives'] = [citizens[0]['citizen_id']]
+    import_id = post_import(citizens)
+
+    r = requests.get(f"{server_api}/imports/{import_id}/citizens/export?format=csv&fields=citizen_id,relatives")
+    assert r.status_code == 200
+    assert r.headers['content-type'].startswith('text/csv')
+
+    rows = list(csv.reader(io.StringIO(r.text)))
+    assert rows[0] == ['citizen_id', 'relatives']
+    assert rows[1] == [str(citizens[0]['citizen_id']), str(citizens[1]['citizen_id'])]
+    assert rows[3] == [str(citizens[2]['citizen_id']), '']
+    assert len(rows) == len(citizens) + 1
+
+
+def test_export_errors():
+    server_api = get_server_api()
+
+    import_id = post_import([get_random_citizen(relatives=False)])
+
+    r = requests.get(f"{server_api}/imports/{import_id}/citizens/export?fields=citizen_id,password")
+    assert r.status_code == 400
+
+    r = requests.get(f"{server_api}/imports/{import_id}/citizens/export?format=xml")
+    assert r.status_code == 400
+
+    r = requests.get(f"{server_api}/imports/10000/citizens/export")
+    assert r.status_code == 400
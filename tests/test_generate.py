@@ -0,0 +1,43 @@
+import json
+
+import requests
+
+from tools.generate import Generator, CitizenEncoder, iter_json
+from .utils import get_server_api, clear_mongo_db
+
+
+def setup():
+    clear_mongo_db()
+
+
+def teardown():
+    clear_mongo_db()
+
+
+def test_generator_is_deterministic():
+    assert list(Generator(seed=1).citizens(1000)) == list(Generator(seed=1).citizens(1000))
+    assert list(Generator(seed=1).citizens(1000)) != list(Generator(seed=2).citizens(1000))
+
+
+def test_generated_relatives_are_mutual():
+    citizens = {c['citizen_id']: c for c in Generator(seed=1, family_size=6, family_density=1).citizens(10000)}
+    assert len(citizens) == 10000
+    assert any(len(c['relatives']) == 5 for c in citizens.values())
+    for citizen_id, c in citizens.items():
+        for r in c['relatives']:
+            assert citizen_id in citizens[r]['relatives']
+
+
+def test_encoder():
+    encoder = CitizenEncoder()
+    for c in Generator(seed=1).citizens(1000):
+        assert json.loads(encoder.encode(c)) == c
+
+
+def test_generated_import_is_valid():
+    server_api = get_server_api()
+
+    body = "".join(iter_json(Generator(seed=1).citizens(5000)))
+    r = requests.post(f"{server_api}/imports", data=body.encode('utf-8'), headers={"Content-Type": "application/json"})
+    print(f"RESPONSE: {r.json()}")
+    assert r.status_code == 201
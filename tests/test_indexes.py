@@ -0,0 +1,57 @@
+import requests
+
+from tools.explain import record, query_shapes, plan_stages
+from .utils import get_server_api, get_random_citizen, clear_mongo_db, get_shard_dbs
+
+
+def setup():
+    clear_mongo_db()
+
+
+def teardown():
+    for db in get_shard_dbs().values():
+        db.command("profile", 0)
+    clear_mongo_db()
+
+
+def test_no_collection_scans():
+    server_api = get_server_api()
+    dbs = get_shard_dbs()
+    for db in dbs.values():
+        # only the queries issued by the application below are recorded
+        db.command("profile", 0)
+        db['system.profile'].drop()
+        record(db)
+
+    citizens = [get_random_citizen(relatives=False) for _ in range(3)]
+    ids = [c['citizen_id'] for c in citizens]
+    r = requests.post(f"{server_api}/imports", json={'citizens': citizens})
+    assert r.status_code == 201
+    import_id = r.json()['data']['import_id']
+
+    r = requests.post(f"{server_api}/imports/batch", json={'imports': [{'citizens': citizens}]})
+    assert r.status_code == 201
+
+    r = requests.patch(f"{server_api}/imports/{import_id}/citizens/{ids[0]}", json={"relatives": ids[1:]})
+    assert r.status_code == 200
+    r = requests.patch(f"{server_api}/imports/{import_id}/citizens/{ids[1]}", json={"relatives": []})
+    assert r.status_code == 200
+
+    for path in ("citizens", "citizens/export", "citizens/birthdays", "towns/stat/percentile/age"):
+        r = requests.get(f"{server_api}/imports/{import_id}/{path}")
+        assert r.status_code == 200, path
+
+    r = requests.put(f"{server_api}/imports/{import_id}", json={'citizens': citizens[:2]})
+    assert r.status_code == 200
+    r = requests.get(f"{server_api}/stats")
+    assert r.status_code == 200
+
+    shapes = 0
+    for name, db in dbs.items():
+        db.command("profile", 0)
+        for query, command in query_shapes(db):
+            shapes += 1
+            found = plan_stages(db, command)
+            print(f"{name} {query}: {found}")
+            assert "COLLSCAN" not in found, query
+    assert shapes > 0
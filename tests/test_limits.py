@@ -0,0 +1,114 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+from main import RouteLimiter
+from .utils import get_server_api, get_random_citizen, clear_mongo_db
+
+
+def setup():
+    clear_mongo_db()
+
+
+def teardown():
+    clear_mongo_db()
+
+
+def post_import(n):
+    server_api = get_server_api()
+    data = {
+        'citizens': [get_random_citizen(relatives=False) for _ in range(n)]
+    }
+    return requests.post(f"{server_api}/imports", json=data)
+
+
+def test_concurrent_imports():
+    server_api = get_server_api()
+
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        responses = list(pool.map(post_import, [1000] * 64))
+
+    for r in responses:
+        assert r.status_code in (201, 503)
+        if r.status_code == 503:
+            assert "Retry-After" in r.headers
+
+    r = requests.get(f"{server_api}/stats")
+    result = r.json()
+    print(f"RESPONSE: {result}")
+    assert r.status_code == 200
+
+    stats = result['data']
+    assert stats['limits.post_imports.admitted'] >= len([r for r in responses if r.status_code == 201])
+    assert stats['limits.post_imports.active'] == 0
+    assert stats['limits.post_imports.waiting'] == 0
+
+
+def test_light_routes_not_limited_by_heavy():
+    server_api = get_server_api()
+
+    r = post_import(5)
+    assert r.status_code == 201
+    import_id = r.json()['data']['import_id']
+
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        heavy = [pool.submit(post_import, 1000) for _ in range(32)]
+        light = [pool.submit(requests.get, f"{server_api}/imports/{import_id}/citizens") for _ in range(32)]
+
+        for f in light:
+            assert f.result().status_code == 200
+
+        for f in heavy:
+            assert f.result().status_code in (201, 503)
+
+
+def test_body_over_the_limit_is_rejected():
+    server_api = get_server_api()
+
+    r = post_import(5)
+    assert r.status_code == 201
+    import_id = r.json()['data']['import_id']
+    citizen_id = requests.get(f"{server_api}/imports/{import_id}/citizens").json()['data'][0]['citizen_id']
+
+    # the default limit of routes without YB_BODY_LIMITS is 1MB
+    body = json.dumps({"name": "x" * 2 ** 20})
+    r = requests.patch(f"{server_api}/imports/{import_id}/citizens/{citizen_id}", data=body,
+                       headers={"Content-Type": "application/json"})
+    assert r.status_code == 413
+
+    # without Content-Length the body is rejected while it is read
+    chunks = (body[i:i + 65536].encode() for i in range(0, len(body), 65536))
+    r = requests.patch(f"{server_api}/imports/{import_id}/citizens/{citizen_id}", data=chunks,
+                       headers={"Content-Type": "application/json"})
+    assert r.status_code == 413
+
+    r = requests.get(f"{server_api}/stats")
+    stats = r.json()['data']
+    assert stats['body.patch_citizen.rejected'] >= 2
+    assert stats['body.bytes_in_flight'] == 0
+
+
+def test_cancelled_waiter_popped_by_release():
+    limiter = RouteLimiter("route", 1, 2)
+    loop = asyncio.new_event_loop()
+
+    async def run():
+        assert await limiter.acquire()
+        first = loop.create_task(limiter.acquire())
+        second = loop.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        # the release pops the cancelled waiter before its task handles the cancellation
+        first.cancel()
+        limiter.release()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        assert await second
+        assert not limiter.waiters
+        limiter.release()
+        assert limiter.active == 0
+
+    loop.run_until_complete(run())
+    loop.close()
@@ -0,0 +1,53 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+
+from loop_monitor import LoopMonitor
+
+
+def blocking_handler():
+    time.sleep(0.3)
+
+
+def test_blocking_callback_is_reported(caplog):
+    stats = Counter()
+    loop = asyncio.new_event_loop()
+    monitor = LoopMonitor(0.1, stats)
+
+    async def run():
+        monitor.start(loop)
+        await asyncio.sleep(0.2)
+        blocking_handler()
+        await asyncio.sleep(0.2)
+        monitor.stop()
+
+    with caplog.at_level(logging.WARNING, logger="loop_monitor"):
+        loop.run_until_complete(run())
+    loop.close()
+
+    assert stats["loop.stalls"] == 1
+    assert 200 <= stats["loop.max_stall_ms"] < 400
+    reports = [r.getMessage() for r in caplog.records]
+    assert len(reports) == 1
+    assert "blocking_handler" in reports[0]
+
+
+def test_short_callbacks_are_not_reported(caplog):
+    stats = Counter()
+    loop = asyncio.new_event_loop()
+    monitor = LoopMonitor(0.1, stats)
+
+    async def run():
+        monitor.start(loop)
+        for _ in range(20):
+            time.sleep(0.01)
+            await asyncio.sleep(0.01)
+        monitor.stop()
+
+    with caplog.at_level(logging.WARNING, logger="loop_monitor"):
+        loop.run_until_complete(run())
+    loop.close()
+
+    assert stats["loop.stalls"] == 0
+    assert not caplog.records
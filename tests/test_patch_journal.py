@@ -0,0 +1,84 @@
+import copy
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from journal import apply_patch, apply_to_citizen
+from tools.generate import Generator
+from .utils import get_server_api, get_random_citizen, clear_mongo_db
+
+
+def setup():
+    clear_mongo_db()
+
+
+def teardown():
+    clear_mongo_db()
+
+
+def test_concurrent_patches():
+    server_api = get_server_api()
+
+    citizens = [get_random_citizen(relatives=False) for _ in range(100)]
+    ids = [c['citizen_id'] for c in citizens]
+
+    data = {
+        'citizens': citizens
+    }
+    r = requests.post(f"{server_api}/imports", json=data)
+    assert r.status_code == 201
+    import_id = r.json()['data']['import_id']
+
+    def patch(i):
+        # every citizen becomes a relative of the next one and gets a new name
+        body = {"name": f"name {i}", "relatives": [ids[(i + 1) % len(ids)]]} if i % 2 == 0 else {"name": f"name {i}"}
+        return requests.patch(f"{server_api}/imports/{import_id}/citizens/{ids[i]}", json=body)
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        responses = list(pool.map(patch, range(len(ids))))
+
+    for i, r in enumerate(responses):
+        assert r.status_code == 200
+        assert r.json()['data']['name'] == f"name {i}"
+
+    r = requests.get(f"{server_api}/imports/{import_id}/citizens")
+    assert r.status_code == 200
+    result = {c['citizen_id']: c for c in r.json()['data']}
+
+    for i, citizen_id in enumerate(ids):
+        c = result[citizen_id]
+        assert c['name'] == f"name {i}"
+        for rel in c['relatives']:
+            assert citizen_id in result[rel]['relatives']
+
+    for i in range(0, len(ids), 2):
+        assert ids[(i + 1) % len(ids)] in result[ids[i]]['relatives']
+
+    r = requests.get(f"{server_api}/imports/{import_id}/citizens/birthdays")
+    assert r.status_code == 200
+    presents = sum(p['presents'] for month in r.json()['data'].values() for p in month)
+    assert presents == sum(len(c['relatives']) for c in result.values())
+
+
+def test_entries_applied_to_one_citizen_match_the_import():
+    citizens = {c['citizen_id']: c for c in Generator(seed=5).citizens(50)}
+    ids = list(citizens)
+    rng = random.Random(5)
+    entries = []
+    for _ in range(200):
+        citizen_id = rng.choice(ids)
+        fields = {"name": str(rng.random())}
+        if rng.random() < 0.7:
+            fields["relatives"] = rng.sample([i for i in ids if i != citizen_id], rng.randint(0, 5))
+        entries.append({"citizen_id": citizen_id, "fields": fields})
+
+    single = {citizen_id: copy.deepcopy(c) for citizen_id, c in citizens.items()}
+    for e in entries:
+        apply_patch(citizens, e['citizen_id'], copy.deepcopy(e['fields']))
+        for c in single.values():
+            apply_to_citizen(c, e)
+
+    for citizen_id, c in citizens.items():
+        assert single[citizen_id]['name'] == c['name']
+        assert sorted(single[citizen_id]['relatives']) == sorted(c['relatives'])
@@ -0,0 +1,76 @@
+import json
+
+import requests
+
+from .utils import get_server_api, get_random_citizen, clear_mongo_db
+
+
+def setup():
+    clear_mongo_db()
+
+
+def teardown():
+    clear_mongo_db()
+
+
+def test_read_your_writes():
+    server_api = get_server_api()
+
+    citizens = [get_random_citizen(relatives=False) for _ in range(100)]
+    citizens[0]['birth_date'] = '01.01.2000'
+    citizens[1]['birth_date'] = '01.02.2000'
+
+    r = requests.post(f"{server_api}/imports", json={'citizens': citizens})
+    assert r.status_code == 201
+    import_id = r.json()['data']['import_id']
+
+    first, second = citizens[0]['citizen_id'], citizens[1]['citizen_id']
+
+    for i in range(10):
+        town = f"town {i}"
+        relatives = [second] if i % 2 == 0 else []
+
+        r = requests.patch(f"{server_api}/imports/{import_id}/citizens/{first}",
+                           json={"town": town, "relatives": relatives})
+        assert r.status_code == 200
+
+        r = requests.get(f"{server_api}/imports/{import_id}/citizens")
+        assert r.status_code == 200
+        result = {c['citizen_id']: c for c in r.json()['data']}
+        assert result[first]['town'] == town
+        assert result[first]['relatives'] == relatives
+
+        r = requests.get(f"{server_api}/imports/{import_id}/citizens/birthdays")
+        assert r.status_code == 200
+        presents = [p for p in r.json()['data']["1"] if p['citizen_id'] == second]
+        assert len(presents) == (1 if relatives else 0)
+
+        r = requests.get(f"{server_api}/imports/{import_id}/towns/stat/percentile/age")
+        assert r.status_code == 200
+        assert town in [t['town'] for t in r.json()['data']]
+
+        r = requests.get(f"{server_api}/imports/{import_id}/citizens/export?fields=citizen_id,town")
+        assert r.status_code == 200
+        exported = [json.loads(line) for line in r.text.splitlines()]
+        assert {"citizen_id": first, "town": town} in exported
+
+
+def test_reads_after_clear():
+    server_api = get_server_api()
+
+    # after a clear import ids and versions start over, a lagging replica must not serve the import cleared before
+    for i in range(3):
+        clear_mongo_db()
+        citizens = [get_random_citizen(relatives=False) for _ in range(10)]
+        r = requests.post(f"{server_api}/imports", json={'citizens': citizens})
+        assert r.status_code == 201
+        import_id = r.json()['data']['import_id']
+
+        r = requests.get(f"{server_api}/imports/{import_id}/citizens")
+        assert r.status_code == 200
+        assert r.json()['data'] == citizens
+
+        r = requests.get(f"{server_api}/imports/{import_id}/citizens/export?fields=citizen_id,name")
+        assert r.status_code == 200
+        assert [json.loads(line) for line in r.text.splitlines()] == [
+            {"citizen_id": c['citizen_id'], "name": c['name']} for c in citizens]
@@ -0,0 +1,20 @@
+import requests
+
+from .utils import get_server_api
+
+
+def test_ready():
+    server_api = get_server_api()
+
+    r = requests.get(f"{server_api}/ready")
+    result = r.json()
+    print(f"RESPONSE: {result}")
+    assert r.status_code == 200
+    assert result['data'] == "ok"
+
+    r = requests.get(f"{server_api}/stats")
+    result = r.json()
+    print(f"RESPONSE: {result}")
+    assert r.status_code == 200
+    assert result['data']['startup.seconds'] >= 0
+    assert result['data']['startup.max_rss_kb'] > 0
@@ -0,0 +1,101 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .utils import get_server_api, get_random_citizen, clear_mongo_db
+
+
+def setup():
+    clear_mongo_db()
+
+
+def teardown():
+    clear_mongo_db()
+
+
+def test_replace_import():
+    server_api = get_server_api()
+
+    citizens = [get_random_citizen(relatives=False) for _ in range(5)]
+    ids = [c['citizen_id'] for c in citizens]
+    citizens[0]['relatives'] = [ids[1]]
+    citizens[1]['relatives'] = [ids[0]]
+
+    r = requests.post(f"{server_api}/imports", json={'citizens': citizens})
+    assert r.status_code == 201
+    import_id = r.json()['data']['import_id']
+
+    # remove the 5th citizen, add a new one, move relation 0-1 to 0-2 and rename the 4th
+    new_citizen = get_random_citizen(relatives=False)
+    replacement = [dict(c) for c in citizens[:4]] + [new_citizen]
+    replacement[0]['relatives'] = [ids[2]]
+    replacement[1]['relatives'] = []
+    replacement[2]['relatives'] = [ids[0]]
+    replacement[3]['name'] = "new name"
+
+    r = requests.put(f"{server_api}/imports/{import_id}", json={'citizens': replacement})
+    print(f"RESPONSE: {r.json()}")
+    assert r.status_code == 200
+    assert r.json()['data'] == {"import_id": import_id, "added": 1, "removed": 1, "changed": 4}
+
+    r = requests.get(f"{server_api}/imports/{import_id}/citizens")
+    assert r.status_code == 200
+    result = sorted(r.json()['data'], key=lambda c: c['citizen_id'])
+    assert result == sorted(replacement, key=lambda c: c['citizen_id'])
+
+    # the same list again changes nothing
+    r = requests.put(f"{server_api}/imports/{import_id}", json={'citizens': replacement})
+    assert r.status_code == 200
+    assert r.json()['data'] == {"import_id": import_id, "added": 0, "removed": 0, "changed": 0}
+
+
+def test_replace_import_validation():
+    server_api = get_server_api()
+
+    citizens = [get_random_citizen(relatives=False) for _ in range(2)]
+    r = requests.post(f"{server_api}/imports", json={'citizens': citizens})
+    assert r.status_code == 201
+    import_id = r.json()['data']['import_id']
+
+    citizens[0]['relatives'] = [citizens[1]['citizen_id']]
+    r = requests.put(f"{server_api}/imports/{import_id}", json={'citizens': citizens})
+    assert r.status_code == 400
+
+    r = requests.put(f"{server_api}/imports/{import_id + 1}", json={'citizens': []})
+    assert r.status_code == 400
+
+
+def test_readers_never_see_a_partial_replace():
+    server_api = get_server_api()
+
+    first = [get_random_citizen(relatives=False) for _ in range(200)]
+    ids = [c['citizen_id'] for c in first]
+    for i in range(0, len(first), 2):
+        first[i]['relatives'] = [ids[i + 1]]
+        first[i + 1]['relatives'] = [ids[i]]
+    # the second list removes half of the citizens and relations between the others
+    second = [dict(c, relatives=[], name="second") for c in first[:100]] + \
+             [get_random_citizen(relatives=False) for _ in range(100)]
+
+    r = requests.post(f"{server_api}/imports", json={'citizens': first})
+    assert r.status_code == 201
+    import_id = r.json()['data']['import_id']
+
+    def key(citizens):
+        return sorted(json.dumps(c, sort_keys=True) for c in citizens)
+
+    expected = [key(first), key(second)]
+
+    def replace():
+        for i in range(10):
+            r = requests.put(f"{server_api}/imports/{import_id}", json={'citizens': second if i % 2 == 0 else first})
+            assert r.status_code == 200
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        replacing = pool.submit(replace)
+        while not replacing.done():
+            r = requests.get(f"{server_api}/imports/{import_id}/citizens")
+            assert r.status_code == 200
+            assert key(r.json()['data']) in expected
+        replacing.result()
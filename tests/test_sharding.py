@@ -0,0 +1,187 @@
+import asyncio
+import json
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+from sharding import HashRing, parse_mongo_urls
+from tools import rebalance
+from .utils import get_server_api, get_random_citizen, clear_mongo_db, get_shard_dbs
+
+
+def setup():
+    clear_mongo_db()
+
+
+def teardown():
+    clear_mongo_db()
+
+
+def test_parse_mongo_urls():
+    assert parse_mongo_urls("", "mongodb://localhost:27017/") == [("shard0", "mongodb://localhost:27017/")]
+    assert parse_mongo_urls("a=mongodb://h1:1,h2:2/?replicaSet=rs0  mongodb://h3:3/?w=1", "") == [
+        ("a", "mongodb://h1:1,h2:2/?replicaSet=rs0"),
+        ("shard1", "mongodb://h3:3/?w=1")
+    ]
+    with pytest.raises(ValueError):
+        parse_mongo_urls("a=mongodb://h1/ a=mongodb://h2/", "")
+
+
+def test_ring_is_balanced():
+    ring = HashRing(["a", "b", "c"])
+    counts = Counter(ring.shard_for(i) for i in range(30000))
+    assert set(counts) == {"a", "b", "c"}
+    assert all(8000 < n < 12000 for n in counts.values())
+
+
+def test_adding_shard_moves_only_its_imports():
+    before = HashRing(["a", "b", "c"])
+    after = HashRing(["a", "b", "c", "d"])
+    moved = [i for i in range(30000) if before.shard_for(i) != after.shard_for(i)]
+    assert all(after.shard_for(i) == "d" for i in moved)
+    assert 6000 < len(moved) < 9000
+
+
+def test_imports_are_stored_on_their_shards():
+    server_api = get_server_api()
+    dbs = get_shard_dbs()
+    ring = HashRing(list(dbs))
+
+    body = json.dumps({"imports": [{"citizens": [get_random_citizen(relatives=False)]} for _ in range(20)]})
+    r = requests.post(f"{server_api}/imports/batch", data=body, headers={"Content-Type": "application/json"})
+    assert r.status_code == 201
+    import_ids = [i['import_id'] for i in r.json()['data']]
+
+    r = requests.post(f"{server_api}/imports", json={"citizens": [get_random_citizen(relatives=False)]})
+    assert r.status_code == 201
+    import_ids.append(r.json()['data']['import_id'])
+
+    # ids are allocated globally
+    assert len(set(import_ids)) == len(import_ids)
+
+    for import_id in import_ids:
+        name = ring.shard_for(import_id)
+        assert dbs[name]['imports'].find_one({"import_id": import_id}) is not None
+        for other, db in dbs.items():
+            if other != name:
+                assert db['imports'].find_one({"import_id": import_id}) is None
+
+        r = requests.get(f"{server_api}/imports/{import_id}/citizens")
+        assert r.status_code == 200
+
+
+def test_misplaced_import_is_found():
+    server_api = get_server_api()
+    dbs = get_shard_dbs()
+    ring = HashRing(list(dbs))
+
+    r = requests.post(f"{server_api}/imports", json={"citizens": [get_random_citizen(relatives=False)]})
+    assert r.status_code == 201
+    import_id = r.json()['data']['import_id']
+    imp = dbs[ring.shard_for(import_id)]['imports'].find_one_and_delete({"import_id": import_id})
+
+    # an import created before a shard was added stays on the old shard until tools/rebalance.py moves it,
+    # the id is new, so the application has not seen it yet
+    imp['import_id'] = misplaced_id = import_id + 1000
+    home = ring.shard_for(misplaced_id)
+    other = next((name for name in dbs if name != home), home)
+    dbs[other]['imports'].insert_one(imp)
+
+    r = requests.get(f"{server_api}/imports/{misplaced_id}/citizens")
+    assert r.status_code == 200
+    assert r.json()['data'] == imp['citizens']
+
+    citizen_id = imp['citizens'][0]['citizen_id']
+    r = requests.patch(f"{server_api}/imports/{misplaced_id}/citizens/{citizen_id}", json={"name": "moved"})
+    assert r.status_code == 200
+    r = requests.get(f"{server_api}/imports/{misplaced_id}/citizens")
+    assert r.json()['data'][0]['name'] == "moved"
+
+
+def test_import_moved_after_it_was_read_is_found():
+    server_api = get_server_api()
+    dbs = get_shard_dbs()
+    ring = HashRing(list(dbs))
+
+    r = requests.post(f"{server_api}/imports", json={"citizens": [get_random_citizen(relatives=False)]})
+    assert r.status_code == 201
+    import_id = r.json()['data']['import_id']
+    # the application remembers where the import is, also in the working set when it is enabled
+    r = requests.get(f"{server_api}/imports/{import_id}/citizens")
+    assert r.status_code == 200
+
+    home = ring.shard_for(import_id)
+    imp = dbs[home]['imports'].find_one_and_delete({"import_id": import_id})
+    other = next((name for name in dbs if name != home), home)
+    dbs[other]['imports'].insert_one(imp)
+
+    for path in ("citizens", "citizens/export", "citizens/birthdays", "towns/stat/percentile/age"):
+        r = requests.get(f"{server_api}/imports/{import_id}/{path}")
+        assert r.status_code == 200, path
+    r = requests.get(f"{server_api}/imports/{import_id}/citizens")
+    assert r.json()['data'] == imp['citizens']
+
+
+def test_move_left_by_a_dead_tool_gets_503():
+    server_api = get_server_api()
+    dbs = get_shard_dbs()
+    ring = HashRing(list(dbs))
+
+    r = requests.post(f"{server_api}/imports", json={"citizens": [get_random_citizen(relatives=False)]})
+    assert r.status_code == 201
+    import_id = r.json()['data']['import_id'] + 1000
+    home = ring.shard_for(import_id)
+    # the tool deleted the source and died before inserting the import on the target
+    dbs[home]['imports_moving'].insert_one({"import_id": import_id, "moving_from": home})
+
+    r = requests.get(f"{server_api}/imports/{import_id}/citizens")
+    if len(dbs) > 1:
+        assert r.status_code == 503
+        assert 'Retry-After' in r.headers
+    else:
+        # a single shard has nothing to move
+        assert r.status_code == 400
+
+
+def test_move_keeps_concurrent_patches():
+    server_api = get_server_api()
+    dbs = get_shard_dbs()
+    ring = HashRing(list(dbs))
+
+    citizens = [get_random_citizen(relatives=False) for _ in range(50)]
+    r = requests.post(f"{server_api}/imports", json={"citizens": citizens})
+    assert r.status_code == 201
+    import_id = r.json()['data']['import_id']
+    imp = dbs[ring.shard_for(import_id)]['imports'].find_one_and_delete({"import_id": import_id})
+
+    imp['import_id'] = misplaced_id = import_id + 1000
+    home = ring.shard_for(misplaced_id)
+    other = next((name for name in dbs if name != home), None)
+    if other is None:
+        return
+    dbs[other]['imports'].insert_one(imp)
+
+    def patch(citizen):
+        return requests.patch(f"{server_api}/imports/{misplaced_id}/citizens/{citizen['citizen_id']}",
+                              json={"name": f"patched {citizen['citizen_id']}"})
+
+    urls = dict(parse_mongo_urls(os.getenv('YB_MONGO_URLS', ''),
+                                 os.getenv('YB_MONGO_URL', 'mongodb://localhost:27017/')))
+    source = rebalance.Shard(other, urls[other])
+    target = rebalance.Shard(home, urls[home])
+
+    # every acknowledged patch survives the move, whichever shard it was appended on
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        responses = pool.map(patch, citizens)
+        moved = asyncio.new_event_loop().run_until_complete(rebalance.move(source, target, misplaced_id, 10))
+        responses = list(responses)
+    assert moved
+    assert all(r.status_code == 200 for r in responses)
+
+    r = requests.get(f"{server_api}/imports/{misplaced_id}/citizens")
+    assert [c['name'] for c in r.json()['data']] == [f"patched {c['citizen_id']}" for c in citizens]
+    assert dbs[other]['imports'].find_one({"import_id": misplaced_id}) is None
+    assert dbs[other]['patches'].find_one({"import_id": misplaced_id}) is None
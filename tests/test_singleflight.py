@@ -0,0 +1,50 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .utils import get_server_api, get_random_citizen, clear_mongo_db
+
+
+def setup():
+    clear_mongo_db()
+
+
+def teardown():
+    clear_mongo_db()
+
+
+def get_stats():
+    server_api = get_server_api()
+    return requests.get(f"{server_api}/stats").json()['data']
+
+
+def test_concurrent_analytics_requests():
+    server_api = get_server_api()
+
+    citizens = [get_random_citizen(relatives=False) for _ in range(10000)]
+    data = {
+        'citizens': citizens
+    }
+    r = requests.post(f"{server_api}/imports", json=data)
+    assert r.status_code == 201
+    import_id = r.json()['data']['import_id']
+
+    for route in ('citizens/birthdays', 'towns/stat/percentile/age'):
+        name = 'get_birthdays' if route == 'citizens/birthdays' else 'get_age_stat'
+        before = get_stats()
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            responses = list(pool.map(requests.get, [f"{server_api}/imports/{import_id}/{route}"] * 8))
+
+        for r in responses:
+            assert r.status_code == 200
+            assert r.json() == responses[0].json()
+
+        after = get_stats()
+
+        computed = after.get(f"singleflight.{name}.computed", 0) - before.get(f"singleflight.{name}.computed", 0)
+        coalesced = after.get(f"singleflight.{name}.coalesced", 0) - before.get(f"singleflight.{name}.coalesced", 0)
+        # requests arriving after the result is cached are answered without the single flight
+        hits = after.get(f"cache.{name}.hits", 0) - before.get(f"cache.{name}.hits", 0)
+        assert computed >= 1
+        assert computed + coalesced + hits == len(responses)
@@ -0,0 +1,103 @@
+import datetime
+import os
+from collections import Counter, defaultdict
+
+from snapshots import SnapshotStore, ColumnsBuilder, birthday_presents, age_histograms
+from tools.generate import Generator
+
+
+def build(citizens, batch_size=100):
+    builder = ColumnsBuilder()
+    for i in range(0, len(citizens), batch_size):
+        builder.add(citizens[i:i + batch_size])
+    return builder.finish()
+
+
+def expected_presents(citizens):
+    birthdays = defaultdict(Counter)
+    for c in citizens:
+        birthdays[int(c['birth_date'].split('.')[1])].update(c['relatives'])
+    return {m: dict(counts) for m, counts in birthdays.items() if counts}
+
+
+def expected_ages(citizens, now):
+    towns = defaultdict(Counter)
+    for c in citizens:
+        d, m, y = map(int, c['birth_date'].split('.'))
+        towns[c['town']][now.year - y - ((now.month, now.day) < (m, d))] += 1
+    return list(towns.items())
+
+
+def test_snapshot_analytics(tmp_path):
+    citizens = list(Generator(seed=3).citizens(2000))
+    store = SnapshotStore(str(tmp_path), 10 * 1024 * 1024)
+    snapshot = store.write(1, "0-None-abc", *build(citizens))
+
+    assert len(snapshot) == len(citizens)
+    presents = birthday_presents(snapshot)
+    assert {m: dict(p) for m, p in presents.items()} == expected_presents(citizens)
+
+    now = datetime.datetime(2019, 6, 15)
+    assert age_histograms(snapshot, now) == expected_ages(citizens, now)
+
+    # another worker opens the same files
+    other = SnapshotStore(str(tmp_path), 10 * 1024 * 1024).open(1, "0-None-abc")
+    assert other.citizen_id.tolist() == [c['citizen_id'] for c in citizens]
+    assert other.towns == snapshot.towns
+
+
+def test_snapshot_versions_and_invalidation(tmp_path):
+    citizens = list(Generator(seed=3).citizens(100))
+    store = SnapshotStore(str(tmp_path), 10 * 1024 * 1024)
+
+    store.write(1, "0-None-abc", *build(citizens))
+    store.write(1, "1-None-abc", *build(citizens))
+    assert store.open(1, "0-None-abc") is None
+    assert store.open(1, "1-None-abc") is not None
+
+    store.invalidate(1)
+    assert store.open(1, "1-None-abc") is None
+
+
+def test_snapshot_invalidated_while_written(tmp_path, monkeypatch):
+    citizens = list(Generator(seed=3).citizens(100))
+    store = SnapshotStore(str(tmp_path), 10 * 1024 * 1024)
+    rename = os.rename
+
+    def invalidate_and_rename(src, dst):
+        store.invalidate(1)
+        rename(src, dst)
+
+    monkeypatch.setattr(os, "rename", invalidate_and_rename)
+    assert store.write(1, "0-None-abc", *build(citizens)) is None
+    monkeypatch.undo()
+    assert store.open(1, "0-None-abc") is None
+    assert store.write(1, "1-None-abc", *build(citizens)) is not None
+
+
+def test_snapshot_eviction(tmp_path):
+    citizens = list(Generator(seed=3).citizens(1000))
+    columns, towns = build(citizens)
+    size = sum(c.nbytes for c in columns.values())
+    store = SnapshotStore(str(tmp_path), size * 10)
+
+    for import_id in range(1, 4):
+        store.write(import_id, "0-None-abc", columns, towns)
+        os.utime(store.path(import_id, "0-None-abc"), (import_id, import_id))
+    store.open(1, "0-None-abc")
+    store.max_bytes = int(size * 2.5)
+    store.write(4, "0-None-abc", columns, towns)
+
+    # 2 and 3 were used least recently
+    assert store.open(1, "0-None-abc") is not None
+    assert store.open(2, "0-None-abc") is None
+    assert store.open(3, "0-None-abc") is None
+    assert store.open(4, "0-None-abc") is not None
+    assert store.get_stats()["snapshots.evicted"] == 2
+
+
+def test_columns_with_unknown_relative():
+    citizens = list(Generator(seed=3).citizens(10))
+    citizens[0]['relatives'].append(100)
+    assert build(citizens) is None
+    assert build([]) is not None
@@ -0,0 +1,24 @@
+import requests
+
+from .utils import get_server_api
+
+
+def test_sampled_request_returns_trace_id():
+    server_api = get_server_api()
+
+    r = requests.get(f"{server_api}/stats", headers={"X-B3-Sampled": "1", "X-B3-TraceId": "463ac35c9f6413ad"})
+    print(f"RESPONSE: {r.headers}")
+    assert r.status_code == 200
+    assert r.headers['X-B3-TraceId'] == "463ac35c9f6413ad"
+
+    r = requests.get(f"{server_api}/stats", headers={"X-B3-Sampled": "1"})
+    assert r.status_code == 200
+    assert len(r.headers['X-B3-TraceId']) == 16
+
+
+def test_not_sampled_request():
+    server_api = get_server_api()
+
+    r = requests.get(f"{server_api}/stats", headers={"X-B3-Sampled": "0"})
+    assert r.status_code == 200
+    assert 'X-B3-TraceId' not in r.headers
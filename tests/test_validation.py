@@ -0,0 +1,167 @@
+import copy
+
+import pytest
+from pydantic import ValidationError
+
+from main import Import
+from tools.generate import Generator
+from validation import validate_import, ImportValidationError
+
+CITIZEN = {
+    "citizen_id": 1, "town": "Москва", "street": "Ленина", "building": "1к2", "apartment": 7,
+    "name": "Иванов Иван", "birth_date": "01.02.2000", "gender": "male", "relatives": []
+}
+
+VALUES = {
+    "citizen_id": [0, 10 ** 30, "1", " 1 ", 1.7, True, -1, "-1", "1.0", None, [1], "", {}],
+    "apartment": [0, "0", 2.5, -5, None, "a"],
+    "town": ["", " a", "-a", "a-", "_", "é", "١", 5, 5.5, True, "a" * 256, "a" * 257, None, [], {}],
+    "street": ["", " ", "x", 0, None],
+    "building": ["1", "/1", "", 12, None],
+    "name": ["", " ", "-", 5, None, "a" * 257, []],
+    "birth_date": ["1.1.2000", " 1.1.2000", "01.01.2000 ", "31.02.2000", "29.02.2000", "29.02.2001", "01.01.3000",
+                   "01-01-2000", "01.13.2000", 5, "x" * 300, "", None],
+    "gender": ["female", "Male", "", 1, None, []],
+    "relatives": [[], [1], ["1"], (1,), [1.5], [True], "1", None, [None], {"a": 1}, [-1], [1, 1]],
+}
+
+
+def pydantic_result(data):
+    try:
+        return [c.dict() for c in Import(**data).citizens], None
+    except ValidationError as e:
+        return None, e.errors()
+
+
+def lean_result(data):
+    try:
+        return validate_import(data), None
+    except ImportValidationError as e:
+        return None, e.errors
+
+
+def assert_same(data):
+    expected, expected_errors = pydantic_result(copy.deepcopy(data))
+    actual, actual_errors = lean_result(copy.deepcopy(data))
+
+    if expected_errors is not None:
+        # pydantic orders errors of a citizen by its own field order
+        key = lambda e: [str(l) for l in e['loc']] + [e['msg']]
+        assert sorted(actual_errors or [], key=key) == sorted(expected_errors, key=key)
+    else:
+        assert actual_errors is None
+        assert actual == [{k: v.value if k == 'gender' else v for k, v in c.items()} for c in expected]
+
+
+@pytest.mark.parametrize("field,value", [(k, v) for k, values in VALUES.items() for v in values])
+def test_field_parity(field, value):
+    assert_same({"citizens": [dict(CITIZEN, **{field: value})]})
+
+
+@pytest.mark.parametrize("field", list(CITIZEN))
+def test_missing_field_parity(field):
+    citizen = dict(CITIZEN)
+    del citizen[field]
+    assert_same({"citizens": [citizen]})
+
+
+@pytest.mark.parametrize("data", [
+    {"citizens": []},
+    {"citizens": [dict(CITIZEN, extra=1)]},
+    {"citizens": [CITIZEN], "extra": 1},
+    {"citizens": [dict(CITIZEN, town="")], "extra": 1},
+    {"citizens": [CITIZEN, CITIZEN]},
+    {"citizens": [CITIZEN, CITIZEN], "extra": 1},
+    {"citizens": [dict(CITIZEN, relatives=[2])]},
+    {"citizens": [dict(CITIZEN, relatives=[2]), dict(CITIZEN, citizen_id=2, relatives=[1])]},
+    {"citizens": [dict(CITIZEN, relatives=[2]), dict(CITIZEN, citizen_id=2, relatives=[])]},
+    {"citizens": [dict(CITIZEN, relatives=[1])]},
+    {"citizens": [dict(CITIZEN, relatives=[2]), dict(CITIZEN, citizen_id=2, relatives=["x"])]},
+    {"citizens": [CITIZEN, 1, None, "x", [["citizen_id", 1]]]},
+    {"citizens": None},
+    {"citizens": "x"},
+    {"citizens": {}},
+    {"citizens": (CITIZEN,)},
+    {},
+])
+def test_import_parity(data):
+    assert_same(data)
+
+
+def test_generated_import_parity():
+    citizens = list(Generator(seed=1).citizens(2000))
+    assert_same({"citizens": citizens})
+
+    citizens[100]['relatives'].append(citizens[1500]['citizen_id'])
+    assert_same({"citizens": citizens})
+
+
+def test_not_dict():
+    with pytest.raises(ImportValidationError) as e:
+        validate_import([1])
+    assert e.value.display(loc=("body", "data")) == \
+        "1 validation error\nbody -> data\n  value is not a valid dict (type=type_error.dict)"
+
+    with pytest.raises(ImportValidationError) as e:
+        validate_import(None)
+    assert e.value.errors[0]['msg'] == "field required"
+
+
+def test_display_matches_pydantic():
+    data = {"citizens": [dict(CITIZEN, town="", citizen_id=-1)]}
+    try:
+        Import(**copy.deepcopy(data))
+    except ValidationError as e:
+        expected = str(e)
+
+    with pytest.raises(ImportValidationError) as e:
+        validate_import(data)
+    assert sorted(str(e.value).split('\n')) == sorted(expected.split('\n'))
+
+
+def test_fast_fail_stops_after_max_errors():
+    citizens = [dict(CITIZEN, citizen_id=i, town="", apartment=-1) for i in range(10000)]
+    with pytest.raises(ImportValidationError) as e:
+        validate_import({"citizens": citizens}, max_errors=5)
+    assert len(e.value.errors) == 5
+    assert e.value.truncated
+    assert {err['loc'][1] for err in e.value.errors} == {0, 1, 2}
+
+    compact = e.value.compact(loc=("body", "data"))
+    assert compact[0] == {"loc": ["body", "data", "citizens", 0, "apartment"],
+                          "msg": "ensure this value is greater than or equal to 0",
+                          "type": "value_error.number.not_ge"}
+    assert compact[-1]['type'] == "value_error.too_many_errors"
+    assert len(compact) == 6
+
+
+def test_fast_fail_reports_the_same_errors_below_the_limit():
+    data = {"citizens": [dict(CITIZEN, town=""), dict(CITIZEN, citizen_id=2, gender="x")], "extra": 1}
+    _, expected = lean_result(copy.deepcopy(data))
+
+    with pytest.raises(ImportValidationError) as e:
+        validate_import(copy.deepcopy(data), max_errors=10)
+    assert e.value.errors == expected
+    assert not e.value.truncated
+    assert e.value.compact()[-1]['type'] != "value_error.too_many_errors"
+
+
+def test_fast_fail_checks_duplicate_ids_first():
+    citizens = [dict(CITIZEN, citizen_id=i % 100, town="") for i in range(1000)]
+    with pytest.raises(ImportValidationError) as e:
+        validate_import({"citizens": citizens}, max_errors=10)
+    assert e.value.errors == [{"loc": ("citizens",), "msg": "citizens must have unique id's", "type": "value_error"}]
+
+    # without the fast-fail mode the per-citizen errors come first, as with pydantic
+    with pytest.raises(ImportValidationError) as e:
+        validate_import({"citizens": [dict(CITIZEN, citizen_id=i % 100, town="") for i in range(1000)]})
+    assert len(e.value.errors) == 1000
+
+
+def test_max_citizens():
+    citizens = [dict(CITIZEN, citizen_id=i) for i in range(11)]
+    with pytest.raises(ImportValidationError) as e:
+        validate_import({"citizens": citizens}, max_citizens=10)
+    assert e.value.errors[0]['type'] == "value_error.list.max_items"
+
+    assert len(validate_import({"citizens": citizens[:10]}, max_citizens=10)) == 10
@@ -0,0 +1,114 @@
+import copy
+
+from diff import diff_citizens
+from journal import apply_patch
+from tools.generate import Generator
+from working_set import WorkingSet, HotImport
+
+
+def test_citizens_round_trip():
+    citizens = list(Generator(seed=0).citizens(500))
+    hot = HotImport((0, None, "a"), copy.deepcopy(citizens))
+    assert hot.citizens() == citizens
+
+    batches = list(hot.batches(["town"], 200))
+    assert [len(b) for b in batches] == [200, 200, 100]
+    assert [c for b in batches for c in b] == [{"citizen_id": c['citizen_id'], "town": c['town']} for c in citizens]
+
+
+def test_patches_match_dicts():
+    citizens = list(Generator(seed=1).citizens(200))
+    expected = {c['citizen_id']: c for c in copy.deepcopy(citizens)}
+    hot = HotImport((0, None, "a"), copy.deepcopy(citizens))
+
+    ids = list(expected)
+    patches = [
+        (ids[0], {"name": "name", "town": "town"}),
+        (ids[1], {"relatives": [ids[2], ids[3]]}),
+        (ids[2], {"relatives": []}),
+        (ids[3], {"relatives": [ids[1], ids[4]], "birth_date": "01.01.2000"}),
+    ]
+    for citizen_id, fields in patches:
+        apply_patch(expected, citizen_id, copy.deepcopy(fields))
+        apply_patch(hot, citizen_id, copy.deepcopy(fields))
+
+    assert hot.citizens() == list(expected.values())
+
+
+def test_stale_entry_is_dropped():
+    ws = WorkingSet(10 ** 9)
+    citizens = list(Generator(seed=2).citizens(10))
+    ws.put(1, (0, None, "a"), citizens)
+
+    assert ws.get(1, (0, None, "a")) is not None
+    assert ws.get(1, (1, None, "a")) is None
+    assert 1 not in ws.imports
+    assert ws.bytes == 0
+    assert ws.stats["working_set.stale"] == 1
+
+
+def test_least_recently_used_are_evicted():
+    citizens = list(Generator(seed=3).citizens(100))
+    size = HotImport(None, citizens).size
+    ws = WorkingSet(size * 3)
+
+    for import_id in range(1, 4):
+        ws.put(import_id, (0, None, str(import_id)), citizens)
+    ws.get(1, (0, None, "1"))
+    ws.put(4, (0, None, "4"), citizens)
+
+    assert list(ws.imports) == [3, 1, 4]
+    assert ws.bytes == size * 3
+    assert ws.stats["working_set.evicted"] == 1
+
+    # an import larger than the whole budget is returned but not kept
+    hot = ws.put(5, (0, None, "5"), citizens * 4)
+    assert len(hot) == 400
+    assert 5 not in ws.imports
+
+
+def test_patches_update_size():
+    citizens = list(Generator(seed=4).citizens(100))
+    ws = WorkingSet(10 ** 9)
+    hot = ws.put(1, (0, None, "a"), copy.deepcopy(citizens))
+    loaded = hot.size
+
+    # lists grown by patches may have more spare capacity than the loaded ones, so sizes are compared roughly
+    ids = [c['citizen_id'] for c in citizens]
+    ws.patch(1, ids[0], {"name": "x" * 1000, "relatives": ids[1:50]})
+    assert ws.stats["working_set.patched"] == 1
+    assert hot.size > loaded + 1000
+    assert abs(hot.size - HotImport(None, hot.citizens()).size) < loaded * 0.05
+    assert ws.bytes == hot.size
+
+    ws.patch(1, ids[0], {"name": "", "relatives": []})
+    assert abs(hot.size - HotImport(None, hot.citizens()).size) < loaded * 0.05
+    assert ws.bytes == hot.size
+
+    # growing over the budget evicts the import
+    ws.max_bytes = hot.size
+    ws.patch(1, ids[0], {"name": "x" * 1000})
+    assert 1 not in ws.imports
+    assert ws.bytes == 0
+
+
+def test_replace_is_applied_to_the_entry():
+    old = list(Generator(seed=6).citizens(100))
+    removed_ids = {c['citizen_id'] for c in old[:10]}
+    new = [dict(c, relatives=[r for r in c['relatives'] if r not in removed_ids]) for c in copy.deepcopy(old[10:])]
+    for c in new[:5]:
+        c['name'] = "new name"
+    new.append(dict(old[0], citizen_id=1000, relatives=[]))
+
+    ws = WorkingSet(10 ** 9)
+    hot = ws.put(1, (0, None, "a"), copy.deepcopy(old))
+    removed, changed, added = diff_citizens(old, new)
+    ws.apply_diff(1, (0, None, "a"), (1, None, "a"), removed, changed, added)
+
+    assert ws.get(1, (1, None, "a")) is hot
+    assert sorted(hot.citizens(), key=lambda c: c['citizen_id']) == sorted(new, key=lambda c: c['citizen_id'])
+    assert ws.bytes == hot.size == hot.measure()
+
+    # an entry at another stamp is dropped
+    ws.apply_diff(1, (0, None, "a"), (2, None, "a"), [], {}, [])
+    assert 1 not in ws.imports
@@ -5,6 +5,7 @@ from copy import deepcopy
 
 from pymongo import MongoClient
 
+from sharding import parse_mongo_urls
 from .examples import CITIZEN
 
 
@@ -59,18 +60,14 @@ def get_random_citizen(relatives=False):
     return c
 
 
-def clear_mongo_db():
-    mongo_url = os.getenv('YB_MONGO_URL', 'mongodb://localhost:27017/')
-
-    client = MongoClient(mongo_url)
-
-    db = client['yaback']
-
-    imports = db['imports']
+def get_shard_dbs():
+    """Returns name -> `yaback` database of every shard the application uses"""
+    urls = parse_mongo_urls(os.getenv('YB_MONGO_URLS', ''), os.getenv('YB_MONGO_URL', 'mongodb://localhost:27017/'))
+    return {name: MongoClient(url)['yaback'] for name, url in urls}
 
-    counter = db['counter']
-
-    imports.drop()
-
-    counter.drop()
 
+def clear_mongo_db():
+    for db in get_shard_dbs().values():
+        # keep the collections and their indexes created by the application
+        for name in ('imports', 'counter', 'patches', 'dedup', 'imports_moving'):
+            db[name].delete_many({})
@@ -0,0 +1,134 @@
+"""Runs `explain` for every query shape the application has issued and reports collection scans.
+
+Usage:
+    YB_MONGO_URLS="..." python -m tools.explain record
+    ... run the application and the tests against it ...
+    YB_MONGO_URLS="..." python -m tools.explain
+
+Queries are not listed by hand, they are taken from the MongoDB profiler: `record` turns it on for
+the `yaback` database of every shard, so every query the application issues is recorded in
+`system.profile` (MongoDB 3.6+). Without `record` the tool explains each recorded query shape once
+and exits with code 1 if any of them is executed with COLLSCAN, or if there are no recorded queries,
+so it can be run in CI after the integration tests.
+"""
+import json
+import os
+import sys
+
+from pymongo import MongoClient
+
+from sharding import parse_mongo_urls
+
+# collections of the application, other namespaces in the profile are ignored
+COLLECTIONS = {"imports", "patches", "dedup", "counter", "imports_moving"}
+
+# commands which can be explained, inserts and index builds have no query plan
+EXPLAINABLE = {"find", "aggregate", "findAndModify", "distinct", "count", "update", "delete"}
+
+# fields of recorded commands which explain does not accept or which do not change the plan
+IGNORED_FIELDS = {"lsid", "txnNumber", "readConcern", "writeConcern", "cursor", "batchSize", "singleBatch"}
+
+
+def shard_dbs():
+    urls = parse_mongo_urls(os.getenv('YB_MONGO_URLS', ''), os.getenv('YB_MONGO_URL', 'mongodb://localhost:27017/'))
+    return {name: MongoClient(url)['yaback'] for name, url in urls}
+
+
+def record(db):
+    """Starts recording every query of the database in `system.profile`"""
+    db.command("profile", 2)
+
+
+def explain_command(entry):
+    """Returns the command to explain for a profiler entry, None if the operation has no query plan"""
+    collection = entry['ns'].split('.', 1)[1]
+    command = entry.get('command')
+    if collection not in COLLECTIONS or command is None:
+        return None
+    if entry['op'] == 'update':
+        return {"update": collection, "updates": [command]}
+    if entry['op'] == 'remove':
+        return {"delete": collection, "deletes": [command]}
+    if entry['op'] not in ('query', 'command') or not set(command).intersection(EXPLAINABLE):
+        return None
+    command = {k: v for k, v in command.items() if not k.startswith('$') and k not in IGNORED_FIELDS}
+    if "aggregate" in command:
+        command["cursor"] = {}
+    return command
+
+
+def shape(value):
+    """The command with values replaced by their types, commands differing only in values share a shape"""
+    if isinstance(value, dict):
+        return {k: shape(v) for k, v in value.items()}
+    if isinstance(value, list):
+        # lists of values of one shape, like `$in` lists, share the shape whatever their length is
+        shapes = [shape(v) for v in value]
+        return shapes[:1] if all(s == shapes[0] for s in shapes) else shapes
+    return type(value).__name__
+
+
+def query_shapes(db):
+    """Recorded queries as (shape, explain command), one command per shape"""
+    shapes = {}
+    for entry in db['system.profile'].find({}, sort=[("ts", 1)]):
+        command = explain_command(entry)
+        if command is not None:
+            shapes.setdefault(json.dumps(shape(command), sort_keys=True), command)
+    return list(shapes.items())
+
+
+def winning_plans(explain):
+    """Yields winning plans from explain output of any command"""
+    if isinstance(explain, dict):
+        for k, v in explain.items():
+            if k == "winningPlan":
+                yield v
+            else:
+                yield from winning_plans(v)
+    elif isinstance(explain, list):
+        for v in explain:
+            yield from winning_plans(v)
+
+
+def stages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for k, v in plan.items():
+            if k in ("inputStage", "inputStages", "queryPlan", "shards"):
+                yield from stages(v)
+    elif isinstance(plan, list):
+        for v in plan:
+            yield from stages(v)
+
+
+def plan_stages(db, command):
+    explain = db.command("explain", command, verbosity="queryPlanner")
+    return [s for p in winning_plans(explain) for s in stages(p)]
+
+
+def main():
+    dbs = shard_dbs()
+    if sys.argv[1:] == ["record"]:
+        for db in dbs.values():
+            record(db)
+        return
+
+    failed = False
+    recorded = 0
+    for name, db in dbs.items():
+        for query, command in query_shapes(db):
+            recorded += 1
+            found = plan_stages(db, command)
+            status = "COLLSCAN" if "COLLSCAN" in found else "ok"
+            failed = failed or status != "ok"
+            print(f"{status:8} {name} {query}: {' <- '.join(found)}")
+
+    if not recorded:
+        print("No queries are recorded, run `python -m tools.explain record` before the application")
+    sys.exit(1 if failed or not recorded else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""Deterministic generator of realistic imports for load and performance tests.
+
+Towns follow a Zipf distribution, relatives form mutual family clusters and birth dates
+follow a normal distribution of ages. The same arguments and seed always produce the same data.
+
+Usage:
+    python -m tools.generate -n 1000000 --format ndjson -o citizens.ndjson
+    python -m tools.generate -n 10000 --imports 5 --post http://0.0.0.0:8080
+"""
+import argparse
+import datetime
+import json
+import random
+import sys
+import time
+
+import requests
+
+MALE_NAMES = ["Иван", "Пётр", "Сергей", "Алексей", "Дмитрий", "Андрей", "Михаил"]
+FEMALE_NAMES = ["Анна", "Мария", "Елена", "Ольга", "Наталья", "Татьяна", "Ирина"]
+LAST_NAMES = ["Иванов", "Петров", "Сидоров", "Смирнов", "Кузнецов", "Попов", "Васильев", "Соколов", "Михайлов"]
+STREETS = ["Ленина", "Мира", "Советская", "Гагарина", "Лесная", "Садовая", "Школьная", "Набережная", "Полевая"]
+
+
+class Generator:
+    def __init__(self, seed=0, towns=1000, town_skew=1.1, family_size=4, family_density=0.8,
+                 age_mean=40, age_sd=18, streets=200, today=datetime.date(2019, 1, 1)):
+        self.rnd = random.Random(seed)
+        self.towns = [f"Город {i}" for i in range(towns)]
+        # Zipf: k-th most popular town has weight 1 / k^s
+        weights = [1 / (k ** town_skew) for k in range(1, towns + 1)]
+        self.town_weights = []
+        total = 0
+        for w in weights:
+            total += w
+            self.town_weights.append(total)
+        self.streets = [f"{self.rnd.choice(STREETS)} {i}" for i in range(streets)]
+        self.family_size = family_size
+        self.family_density = family_density
+        self.age_mean = age_mean
+        self.age_sd = age_sd
+        # birth dates are counted back from a fixed date, so the output doesn't change from day to day
+        self.today = today.toordinal()
+        self.dates = {}
+
+    def choice(self, seq):
+        # much cheaper than Random.choice, which matters for millions of citizens
+        return seq[int(self.rnd.random() * len(seq))]
+
+    def birth_date(self):
+        age = max(0.0, self.rnd.gauss(self.age_mean, self.age_sd))
+        ordinal = self.today - 1 - int(age * 365.25)
+        date = self.dates.get(ordinal)
+        if date is None:
+            d = datetime.date.fromordinal(ordinal)
+            date = self.dates[ordinal] = f"{d.day:02}.{d.month:02}.{d.year}"
+        return date
+
+    def family_sizes(self, n):
+        """Splits n citizens into families, mean size is `family_size`"""
+        while n > 0:
+            size = 1
+            if self.family_size > 1:
+                size = min(n, 1 + int(self.rnd.expovariate(1 / (self.family_size - 1))))
+            yield size
+            n -= size
+
+    def citizens(self, n, first_id=1):
+        """Yields n citizens, families are generated together so relatives are always mutual"""
+        rnd = self.rnd
+        citizen_id = first_id
+        for size in self.family_sizes(n):
+            ids = list(range(citizen_id, citizen_id + size))
+            citizen_id += size
+
+            relatives = {i: [] for i in ids}
+            for a in range(size):
+                for b in range(a + 1, size):
+                    if rnd.random() < self.family_density:
+                        relatives[ids[a]].append(ids[b])
+                        relatives[ids[b]].append(ids[a])
+
+            # families mostly live together
+            town = rnd.choices(self.towns, cum_weights=self.town_weights)[0]
+            street = self.choice(self.streets)
+            building = str(1 + int(rnd.random() * 200))
+            apartment = 1 + int(rnd.random() * 500)
+            last_name = self.choice(LAST_NAMES)
+
+            for i in ids:
+                male = rnd.random() < 0.5
+                yield {
+                    "citizen_id": i,
+                    "town": town,
+                    "street": street,
+                    "building": building,
+                    "apartment": apartment,
+                    "name": f"{last_name} {self.choice(MALE_NAMES)}" if male else
+                            f"{last_name}а {self.choice(FEMALE_NAMES)}",
+                    "birth_date": self.birth_date(),
+                    "gender": "male" if male else "female",
+                    "relatives": relatives[i]
+                }
+
+
+class CitizenEncoder:
+    """Encodes citizens to JSON several times faster than json.dumps by caching encoded strings"""
+
+    def __init__(self):
+        self.strings = {}
+
+    def string(self, s):
+        encoded = self.strings.get(s)
+        if encoded is None:
+            encoded = self.strings[s] = json.dumps(s, ensure_ascii=False)
+        return encoded
+
+    def encode(self, c):
+        s = self.string
+        return (f'{{"citizen_id": {c["citizen_id"]}, "town": {s(c["town"])}, "street": {s(c["street"])}, '
+                f'"building": {s(c["building"])}, "apartment": {c["apartment"]}, "name": {s(c["name"])}, '
+                f'"birth_date": "{c["birth_date"]}", "gender": "{c["gender"]}", '
+                f'"relatives": [{", ".join(map(str, c["relatives"]))}]}}')
+
+
+def write_ndjson(citizens, out):
+    encode = CitizenEncoder().encode
+    lines = []
+    for c in citizens:
+        lines.append(encode(c))
+        if len(lines) >= 10000:
+            lines.append('')
+            out.write('\n'.join(lines))
+            lines = []
+    lines.append('')
+    out.write('\n'.join(lines))
+
+
+def iter_json(citizens):
+    """Yields import body as `{"citizens": [...]}` in chunks"""
+    encode = CitizenEncoder().encode
+    yield '{"citizens": ['
+    chunk = []
+    first = True
+    for c in citizens:
+        chunk.append(encode(c))
+        if len(chunk) >= 10000:
+            yield ('' if first else ',') + ','.join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield ('' if first else ',') + ','.join(chunk)
+    yield ']}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--citizens", type=int, default=10000, help="citizens per import")
+    parser.add_argument("--imports", type=int, default=1, help="number of imports")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--towns", type=int, default=1000, help="number of distinct towns")
+    parser.add_argument("--town-skew", type=float, default=1.1, help="Zipf exponent of town popularity")
+    parser.add_argument("--family-size", type=float, default=4, help="mean size of a family")
+    parser.add_argument("--family-density", type=float, default=0.8,
+                        help="probability that two members of a family are relatives")
+    parser.add_argument("--age-mean", type=float, default=40)
+    parser.add_argument("--age-sd", type=float, default=18)
+    parser.add_argument("--today", type=lambda v: datetime.datetime.strptime(v, '%Y-%m-%d').date(),
+                        default=datetime.date(2019, 1, 1), help="birth dates are generated before this date")
+    parser.add_argument("--format", choices=("ndjson", "json"), default="json",
+                        help="ndjson: one citizen per line, json: import request body per line")
+    parser.add_argument("-o", "--output", help="output file (stdout by default)")
+    parser.add_argument("--post", metavar="APP_URL", help="post imports to the application instead of writing them")
+    args = parser.parse_args()
+
+    generator = Generator(seed=args.seed, towns=args.towns, town_skew=args.town_skew,
+                          family_size=args.family_size, family_density=args.family_density,
+                          age_mean=args.age_mean, age_sd=args.age_sd, today=args.today)
+
+    started = time.perf_counter()
+
+    if args.post:
+        for _ in range(args.imports):
+            body = (chunk.encode('utf-8') for chunk in iter_json(generator.citizens(args.citizens)))
+            r = requests.post(f"{args.post}/imports", data=body, headers={"Content-Type": "application/json"})
+            print(r.status_code, r.text, file=sys.stderr)
+    else:
+        out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+        try:
+            for _ in range(args.imports):
+                citizens = generator.citizens(args.citizens)
+                if args.format == "ndjson":
+                    write_ndjson(citizens, out)
+                else:
+                    for chunk in iter_json(citizens):
+                        out.write(chunk)
+                    out.write('\n')
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+    print(f"Generated {args.imports * args.citizens} citizens in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Moves imports to the shards given by the hash ring of YB_MONGO_URLS, while the application keeps serving them.
+
+Usage:
+    YB_MONGO_URLS="a=mongodb://localhost:27017/ b=mongodb://localhost:27018/" python -m tools.rebalance
+    YB_MONGO_URLS="..." python -m tools.rebalance --dry-run
+
+Restart all workers with the new YB_MONGO_URLS first: they create new imports on the new shards right away
+and find the old ones wherever they are until this tool has moved them. A move of one import:
+
+1. the move is recorded in `imports_moving` of the target shard;
+2. the import document on the source gets `moving_to`, after that new journaled patches of the import wait
+   until the move is over and are appended on the target, see PatchJournal.commit. The tool waits until
+   the patches which were being appended before that are written;
+3. journaled patches of the import are folded into the import document on the source shard;
+4. the document is copied to `imports_moving` of the target shard, a reader which finds the import
+   nowhere else waits for the move to finish;
+5. the document is deleted from the source only if its `version` and `journal_seq` are still the same,
+   otherwise it was changed meanwhile and the move starts over;
+6. the document is inserted into `imports` of the target and removed from `imports_moving`.
+
+A run interrupted in the middle of a move finishes or rolls it back on the next run. An import whose
+patches are still being appended after `--append-timeout` seconds, e.g. because a worker died in the
+middle of an append and left its batch in `journal_appending` of the import, is skipped.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
+
+from journal import PatchJournal
+from sharding import HashRing, parse_mongo_urls
+
+
+class Shard:
+    def __init__(self, name, url):
+        self.name = name
+        self.client = AsyncIOMotorClient(url)
+        db = self.client['yaback']
+        self.imports = db['imports']
+        self.moving = db['imports_moving']
+        self.patches = db['patches']
+        # compaction does not allocate sequence numbers, so the shard's own counter collection is never used
+        self.journal = PatchJournal(self.imports, self.patches, db['counter'])
+
+
+async def finish(target, doc):
+    """Step 6 of the move of `doc`, which is already deleted from the source"""
+    doc = {k: v for k, v in doc.items() if k != 'moving_from'}
+    try:
+        await target.imports.insert_one(doc)
+    except DuplicateKeyError:
+        # inserted before the previous run was interrupted
+        pass
+    await target.moving.delete_one({"import_id": doc['import_id']})
+
+
+async def roll_back(source, target, import_id):
+    await source.imports.update_one({"import_id": import_id}, {"$unset": {"moving_to": ""}})
+    await target.moving.delete_one({"import_id": import_id})
+
+
+async def wait_appends(source, import_id, timeout):
+    """Waits until the patches which were being appended when the import got `moving_to` are written"""
+    deadline = time.monotonic() + timeout
+    while True:
+        doc = await source.imports.find_one({"import_id": import_id}, projection={"journal_appending": True})
+        if doc is None or not doc.get('journal_appending'):
+            return True
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+
+
+async def move(source, target, import_id, append_timeout):
+    """Moves the import, returns False if it does not exist on the source anymore or was skipped"""
+    while True:
+        await target.moving.replace_one({"import_id": import_id},
+                                        {"import_id": import_id, "moving_from": source.name}, upsert=True)
+        r = await source.imports.update_one({"import_id": import_id}, {"$set": {"moving_to": target.name}})
+        if r.matched_count == 0:
+            await target.moving.delete_one({"import_id": import_id})
+            return False
+
+        if not await wait_appends(source, import_id, append_timeout):
+            await roll_back(source, target, import_id)
+            print(f"skipped import {import_id}: patches are still being appended after {append_timeout}s")
+            return False
+
+        await source.journal.compact(import_id)
+        doc = await source.imports.find_one({"import_id": import_id})
+        if doc is None:
+            await target.moving.delete_one({"import_id": import_id})
+            return False
+        if await source.patches.find_one({"import_id": import_id}, projection={"_id": True}) is not None:
+            # compaction raced with a write to the import, patches are never left behind on the source
+            continue
+
+        doc = {k: v for k, v in doc.items() if k not in ('moving_to', 'journal_appending')}
+        doc['moving_from'] = source.name
+        await target.moving.replace_one({"import_id": import_id}, doc, upsert=True)
+
+        r = await source.imports.delete_one({"_id": doc['_id'], "version": doc.get('version'),
+                                             "journal_seq": doc.get('journal_seq')})
+        if r.deleted_count == 1:
+            await finish(target, doc)
+            return True
+
+        # changed by a write which is not journaled, readers still see the source
+        await roll_back(source, target, import_id)
+
+
+async def recover(shards):
+    """Finishes moves which were interrupted after the source document had been deleted, rolls back the others"""
+    for target in shards.values():
+        async for doc in target.moving.find({}):
+            import_id = doc['import_id']
+            source = shards.get(doc.get('moving_from'))
+            if source is not None and await source.imports.find_one({"import_id": import_id}) is not None:
+                await roll_back(source, target, import_id)
+                print(f"rolled back move of import {import_id} to {target.name}")
+            elif 'citizens' in doc:
+                await finish(target, doc)
+                print(f"finished move of import {import_id} to {target.name}")
+            else:
+                # the import was deleted before its document was copied
+                await target.moving.delete_one({"import_id": import_id})
+
+
+async def rebalance(shards, ring, dry_run, append_timeout):
+    if not dry_run:
+        await recover(shards)
+
+    moved = 0
+    started = time.monotonic()
+    for source in shards.values():
+        async for doc in source.imports.find({}, projection={"import_id": True}):
+            import_id = doc['import_id']
+            target = shards[ring.shard_for(import_id)]
+            if target is source:
+                continue
+            if dry_run:
+                print(f"import {import_id}: {source.name} -> {target.name}")
+            elif await move(source, target, import_id, append_timeout):
+                print(f"moved import {import_id}: {source.name} -> {target.name}")
+            moved += 1
+
+    print(f"{'would move' if dry_run else 'moved'} {moved} imports in {time.monotonic() - started:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="only print the imports which would be moved")
+    parser.add_argument("--append-timeout", type=float, default=60,
+                        help="seconds to wait for the journaled patches being appended to an import before "
+                             "skipping it (default: 60)")
+    args = parser.parse_args()
+
+    urls = parse_mongo_urls(os.getenv('YB_MONGO_URLS', ''), os.getenv('YB_MONGO_URL', 'mongodb://localhost:27017/'))
+    shards = {name: Shard(name, url) for name, url in urls}
+
+    ring = HashRing([name for name, _ in urls])
+    asyncio.get_event_loop().run_until_complete(rebalance(shards, ring, args.dry_run, args.append_timeout))
+
+
+if __name__ == '__main__':
+    main()
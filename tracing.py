@@ -0,0 +1,269 @@
+"""Minimal request tracing.
+
+Sampled requests are recorded as Zipkin v2 JSON spans (one JSON array per request and line)
+into a rotating local file. Trace id is taken from and returned in `X-B3-TraceId` header,
+`X-B3-Sampled: 1` forces sampling of a request.
+
+When a request is not sampled, the middleware passes it on without wrapping anything, and `span`
+returns a shared no-op object, so spans in the handlers cost one dict check. Traces are serialized
+and written by a background thread, never on the event loop.
+"""
+import asyncio
+import atexit
+import functools
+import json
+import os
+import queue
+import random
+import time
+from logging import getLogger, Formatter, INFO
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+SAMPLE_RATE = float(os.getenv('YB_TRACE_SAMPLE_RATE', '0'))
+
+TRACE_FILE = os.getenv('YB_TRACE_FILE', 'traces.jsonl')
+
+TRACE_FILE_MAX_BYTES = int(os.getenv('YB_TRACE_FILE_MAX_BYTES', str(100 * 1024 * 1024)))
+
+TRACE_FILE_BACKUP_COUNT = int(os.getenv('YB_TRACE_FILE_BACKUP_COUNT', '5'))
+
+SERVICE_NAME = 'yaback'
+
+TRACE_ID_HEADER = b'x-b3-traceid'
+
+SAMPLED = (b'x-b3-sampled', b'1')
+
+NOT_SAMPLED = (b'x-b3-sampled', b'0')
+
+# traces waiting for the writer thread, more are dropped
+TRACE_QUEUE_SIZE = 10000
+
+current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+
+# task -> trace of the request the task is working on, empty unless a sampled request is in progress
+traces = {}
+
+writer = None
+
+dropped = 0
+
+
+def new_id():
+    return '%016x' % random.getrandbits(64)
+
+
+class SpansFormatter(Formatter):
+    def format(self, record):
+        return json.dumps(record.msg)
+
+
+class TraceQueueHandler(QueueHandler):
+    """Hands traces over to the writer thread as they are, so they are serialized there"""
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        global dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped += 1
+
+
+def get_writer():
+    global writer
+    if writer is None:
+        file_handler = RotatingFileHandler(TRACE_FILE, maxBytes=TRACE_FILE_MAX_BYTES,
+                                           backupCount=TRACE_FILE_BACKUP_COUNT, encoding='utf-8')
+        file_handler.setFormatter(SpansFormatter())
+        traces_queue = queue.Queue(TRACE_QUEUE_SIZE)
+        listener = QueueListener(traces_queue, file_handler)
+        listener.start()
+        # traces queued before the exit are written
+        atexit.register(listener.stop)
+
+        writer = getLogger('yaback.traces')
+        writer.setLevel(INFO)
+        writer.propagate = False
+        writer.addHandler(TraceQueueHandler(traces_queue))
+    return writer
+
+
+class Trace:
+    def __init__(self, trace_id, name):
+        self.trace_id = trace_id
+        self.root_id = new_id()
+        self.name = name
+        self.started = time.time()
+        self.body_read = None
+        self.handler_finished = None
+        self.spans = []
+        self.tags = {}
+
+    def add(self, name, start, end, tags=None):
+        span = {
+            "traceId": self.trace_id,
+            "parentId": self.root_id,
+            "id": new_id(),
+            "name": name,
+            "timestamp": int(start * 1e6),
+            "duration": int((end - start) * 1e6),
+            "localEndpoint": {"serviceName": SERVICE_NAME}
+        }
+        if tags:
+            span["tags"] = {k: str(v) for k, v in tags.items()}
+        self.spans.append(span)
+
+    def finish(self):
+        end = time.time()
+        root = {
+            "traceId": self.trace_id,
+            "id": self.root_id,
+            "kind": "SERVER",
+            "name": self.name,
+            "timestamp": int(self.started * 1e6),
+            "duration": int((end - self.started) * 1e6),
+            "localEndpoint": {"serviceName": SERVICE_NAME},
+            "tags": self.tags
+        }
+        get_writer().info([root] + self.spans)
+
+
+class Span:
+    __slots__ = ('trace', 'name', 'tags', 'start')
+
+    def __init__(self, trace, name, tags):
+        self.trace = trace
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.trace.add(self.name, self.start, time.time(), self.tags)
+        return False
+
+
+class NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+def get_trace():
+    if not traces:
+        return None
+    return traces.get(current_task())
+
+
+def span(name, **tags):
+    """Context manager which records a span in the trace of the current request, if it is sampled"""
+    if not traces:
+        return NOOP_SPAN
+    trace = traces.get(current_task())
+    if trace is None:
+        return NOOP_SPAN
+    return Span(trace, name, tags)
+
+
+def inherit(task):
+    """Makes spans of `task` part of the trace of the current request"""
+    trace = get_trace()
+    if trace is not None:
+        traces[task] = trace
+        task.add_done_callback(lambda t: traces.pop(t, None))
+
+
+def traced(handler):
+    """Records validation (time from reading the body to the handler call) and handler spans"""
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        trace = traces.get(current_task()) if traces else None
+        if trace is None:
+            return await handler(*args, **kwargs)
+
+        started = time.time()
+        trace.add("validate", trace.body_read or trace.started, started)
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            trace.handler_finished = time.time()
+            trace.add("handler", started, trace.handler_finished)
+
+    return wrapper
+
+
+class TracingMiddleware:
+    """Starts a trace for sampled requests and records reading the body and serialization of the response"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, scope, receive, send):
+        # a request which is not sampled gets the application's coroutine itself, without another frame around it
+        if scope['type'] != 'http':
+            return self.app(scope, receive, send)
+
+        # B3 values of the header are exactly "1" and "0", so a lookup of the whole pair is enough,
+        # which is much cheaper than a loop over the headers
+        headers = scope['headers']
+        if SAMPLE_RATE == 0:
+            sampled = SAMPLED in headers
+        elif SAMPLED in headers:
+            sampled = True
+        elif NOT_SAMPLED in headers:
+            sampled = False
+        else:
+            sampled = random.random() < SAMPLE_RATE
+
+        if not sampled:
+            return self.app(scope, receive, send)
+        return self.trace(scope, receive, send)
+
+    async def trace(self, scope, receive, send):
+        trace_id = None
+        for k, v in scope['headers']:
+            if k == TRACE_ID_HEADER:
+                trace_id = v.decode('latin-1')
+
+        trace = Trace(trace_id or new_id(), f"{scope['method']} {scope['path']}")
+        trace.tags["http.path"] = scope['path']
+
+        async def traced_receive():
+            message = await receive()
+            if message['type'] == 'http.request' and not message.get('more_body', False):
+                trace.body_read = time.time()
+                trace.add("read_body", trace.started, trace.body_read)
+            return message
+
+        async def traced_send(message):
+            if message['type'] == 'http.response.start':
+                now = time.time()
+                if trace.handler_finished is not None:
+                    trace.add("serialize", trace.handler_finished, now)
+                else:
+                    # rejected before the handler, e.g. by validation
+                    trace.add("validate", trace.body_read or trace.started, now)
+                trace.tags["http.status_code"] = str(message['status'])
+                headers = list(message.get('headers', []))
+                headers.append((TRACE_ID_HEADER, trace.trace_id.encode('latin-1')))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        task = current_task()
+        traces[task] = trace
+        try:
+            await self.app(scope, traced_receive, traced_send)
+        finally:
+            del traces[task]
+            trace.finish()
@@ -0,0 +1,266 @@
+"""Validation of import bodies without building pydantic models.
+
+`validate_import` applies the same rules as `Import` and `Citizen` models in main.py to decoded JSON,
+reports the same errors, and returns the citizens as dicts ready to be inserted into MongoDB.
+Valid values of the expected types are checked in place, other values are coerced the same way pydantic does.
+
+In the fast-fail mode (`max_errors` > 0) cheap checks of the whole list run first and validation stops after
+`max_errors` errors, so a huge malformed import is rejected without validating all of it. Errors are the same,
+but not all of them are reported and the order of checks differs from pydantic's.
+"""
+import datetime
+import re
+from collections import deque
+from types import GeneratorType
+
+from tracing import span
+
+INT_FIELDS = ("citizen_id", "apartment")
+
+STR_FIELDS = ("town", "street", "building", "name", "birth_date")
+
+# fields which must contain at least one alphanumeric character
+WORD_FIELDS = frozenset(("town", "street", "building", "birth_date"))
+
+FIELDS = frozenset(INT_FIELDS + STR_FIELDS + ("gender", "relatives"))
+
+GENDERS = frozenset(("male", "female"))
+
+MIN_LENGTH = 1
+
+MAX_LENGTH = 256
+
+WORD = re.compile(r"\w")
+
+SEQUENCE_TYPES = (list, tuple, set, frozenset, GeneratorType, deque)
+
+
+class ImportValidationError(ValueError):
+    """Raised with the list of errors in the format of pydantic's `ValidationError.errors()`.
+
+    `truncated` is True if validation stopped before all errors were found.
+    """
+
+    def __init__(self, errors, truncated=False):
+        super().__init__(errors)
+        self.errors = errors
+        self.truncated = truncated
+
+    def compact(self, loc=()):
+        """Errors as a JSON-ready list, the last item tells if validation stopped early"""
+        result = [{"loc": list(loc + e['loc']), "msg": e['msg'], "type": e['type']} for e in self.errors]
+        if self.truncated:
+            result.append(truncated_error(loc, len(self.errors)))
+        return result
+
+    def display(self, loc=()):
+        """Same text as str() of pydantic's ValidationError, `loc` is prepended to the location of each error"""
+        lines = [f"{len(self.errors)} validation error{'' if len(self.errors) == 1 else 's'}"]
+        for e in self.errors:
+            ctx = ''.join(f'; {k}={v}' for k, v in e['ctx'].items()) if 'ctx' in e else ''
+            lines.append(' -> '.join(str(l) for l in loc + e['loc']))
+            lines.append(f"  {e['msg']} (type={e['type']}{ctx})")
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.display()
+
+
+def error(loc, msg, type_, **ctx):
+    e = {"loc": loc, "msg": msg, "type": type_}
+    if ctx:
+        e["ctx"] = ctx
+    return e
+
+
+def truncated_error(loc, n):
+    return {"loc": list(loc), "msg": f"validation stopped after {n} errors", "type": "value_error.too_many_errors"}
+
+
+def coerce_int(v, loc, errors):
+    if isinstance(v, int) and not isinstance(v, bool):
+        return v
+    try:
+        return int(v)
+    except (TypeError, ValueError, OverflowError):
+        errors.append(error(loc, "value is not a valid integer", "type_error.integer"))
+        return None
+
+
+def coerce_str(v, loc, errors):
+    if isinstance(v, str):
+        return v
+    if v is None:
+        errors.append(error(loc, "none is not an allowed value", "type_error.none.not_allowed"))
+    elif isinstance(v, (int, float)):
+        return str(v)
+    elif isinstance(v, (bytes, bytearray)):
+        return v.decode()
+    else:
+        errors.append(error(loc, "str type expected", "type_error.str"))
+    return None
+
+
+def check_length(v, loc, errors):
+    if len(v) < MIN_LENGTH:
+        errors.append(error(loc, f"ensure this value has at least {MIN_LENGTH} characters",
+                            "value_error.any_str.min_length", limit_value=MIN_LENGTH))
+        return False
+    if len(v) > MAX_LENGTH:
+        errors.append(error(loc, f"ensure this value has at most {MAX_LENGTH} characters",
+                            "value_error.any_str.max_length", limit_value=MAX_LENGTH))
+        return False
+    return True
+
+
+def check_birth_date(v, today, dates):
+    """Returns error message for a birth date or None, results are cached in `dates`"""
+    try:
+        return dates[v]
+    except KeyError:
+        pass
+    try:
+        d = datetime.datetime.strptime(v, '%d.%m.%Y')
+    except ValueError as e:
+        message = str(e)
+    else:
+        message = "birth_date should be in past" if d > today else None
+    dates[v] = message
+    return message
+
+
+def validate_citizen(c, i, today, dates, errors):
+    """Validates and normalizes citizen dict `c` in place, appends errors to `errors`"""
+    if c.keys() != FIELDS:
+        for k in FIELDS.difference(c):
+            errors.append(error(("citizens", i, k), "field required", "value_error.missing"))
+        for k in set(c).difference(FIELDS):
+            errors.append(error(("citizens", i, k), "extra fields not permitted", "value_error.extra"))
+
+    for k in INT_FIELDS:
+        if k not in c:
+            continue
+        v = c[k]
+        if type(v) is not int:
+            v = c[k] = coerce_int(v, ("citizens", i, k), errors)
+            if v is None:
+                continue
+        if v < 0:
+            errors.append(error(("citizens", i, k), "ensure this value is greater than or equal to 0",
+                                "value_error.number.not_ge", limit_value=0))
+
+    for k in STR_FIELDS:
+        if k not in c:
+            continue
+        v = c[k]
+        if type(v) is not str:
+            v = c[k] = coerce_str(v, ("citizens", i, k), errors)
+            if v is None:
+                continue
+        if not check_length(v, ("citizens", i, k), errors):
+            continue
+        if k in WORD_FIELDS and WORD.match(v) is None:
+            errors.append(error(("citizens", i, k), 'string does not match regex "\\w"', "value_error.str.regex",
+                                pattern="\\w"))
+            continue
+        if k == "birth_date":
+            message = check_birth_date(v, today, dates)
+            if message is not None:
+                errors.append(error(("citizens", i, k), message, "value_error"))
+
+    if "gender" in c:
+        v = c["gender"]
+        if not isinstance(v, str) or v not in GENDERS:
+            errors.append(error(("citizens", i, "gender"), "value is not a valid enumeration member",
+                                "type_error.enum"))
+
+    if "relatives" in c:
+        v = c["relatives"]
+        if type(v) is not list:
+            if not isinstance(v, SEQUENCE_TYPES):
+                errors.append(error(("citizens", i, "relatives"), "value is not a valid list", "type_error.list"))
+                return
+            v = c["relatives"] = list(v)
+        for j, r in enumerate(v):
+            if type(r) is not int:
+                v[j] = coerce_int(r, ("citizens", i, "relatives", j), errors)
+
+
+def validate_import(data, max_errors=0, max_citizens=0):
+    """Validates decoded import body, returns list of citizen dicts or raises ImportValidationError.
+
+    Citizen dicts of `data` are normalized in place and returned, so `data` must not be used afterwards.
+    `max_errors` enables the fast-fail mode, `max_citizens` limits the number of citizens, 0 means no limit.
+    """
+    if data is None:
+        raise ImportValidationError([error((), "field required", "value_error.missing")])
+    if not isinstance(data, dict):
+        raise ImportValidationError([error((), "value is not a valid dict", "type_error.dict")])
+
+    errors = []
+    for k in data:
+        if k != "citizens":
+            errors.append(error((k,), "extra fields not permitted", "value_error.extra"))
+
+    if "citizens" not in data:
+        raise ImportValidationError([error(("citizens",), "field required", "value_error.missing")] + errors)
+
+    citizens = data["citizens"]
+    if type(citizens) is not list:
+        if not isinstance(citizens, SEQUENCE_TYPES):
+            raise ImportValidationError([error(("citizens",), "value is not a valid list", "type_error.list")]
+                                        + errors)
+        citizens = list(citizens)
+
+    if max_citizens and len(citizens) > max_citizens:
+        raise ImportValidationError([error(("citizens",), f"ensure this value has at most {max_citizens} items",
+                                           "value_error.list.max_items", limit_value=max_citizens)] + errors)
+
+    if max_errors:
+        # ids which are already integers are checked before the citizens, as the cheapest sign of a broken import
+        with span("validate.unique_ids"):
+            ids = [c.get("citizen_id") for c in citizens if isinstance(c, dict)]
+            ids = [v for v in ids if type(v) is int]
+            if len(set(ids)) != len(ids):
+                raise ImportValidationError([error(("citizens",), "citizens must have unique id's", "value_error")]
+                                            + errors)
+
+    today = datetime.datetime.utcnow()
+    dates = {}
+    citizen_errors = []
+    truncated = False
+    for i, c in enumerate(citizens):
+        if max_errors and len(citizen_errors) >= max_errors:
+            truncated = True
+            break
+        if not isinstance(c, dict):
+            citizen_errors.append(error(("citizens", i), "value is not a valid dict", "type_error.dict"))
+            continue
+        validate_citizen(c, i, today, dates, citizen_errors)
+
+    if citizen_errors:
+        if max_errors and len(citizen_errors) + len(errors) > max_errors:
+            truncated = True
+            citizen_errors = (citizen_errors + errors)[:max_errors]
+        else:
+            citizen_errors += errors
+        raise ImportValidationError(citizen_errors, truncated)
+
+    # same as the whole list validators of Import, they run only if every citizen is valid
+    with span("validate.unique_ids"):
+        relatives = {c["citizen_id"]: c["relatives"] for c in citizens}
+        if len(relatives) != len(citizens):
+            raise ImportValidationError([error(("citizens",), "citizens must have unique id's", "value_error")]
+                                        + errors)
+
+    with span("validate.relatives"):
+        for c, rs in relatives.items():
+            for r in rs:
+                if r not in relatives or c not in relatives[r]:
+                    raise ImportValidationError([error(("citizens",), "relatives must be mutual", "value_error")]
+                                                + errors)
+
+    if errors:
+        raise ImportValidationError(errors)
+
+    return citizens
@@ -0,0 +1,10 @@
+"""Worker class of the production runtime, see gunicorn.conf.py.
+
+gunicorn 19 takes the worker class by its import path only, so it is kept in a module of its own.
+"""
+from uvicorn.workers import UvicornWorker
+
+
+class Worker(UvicornWorker):
+    # uvloop and httptools if they are installed, asyncio and h11 otherwise
+    CONFIG_KWARGS = {"loop": "auto", "http": "auto"}
@@ -0,0 +1,167 @@
+"""In-process working set of hot imports.
+
+An import in the working set is kept decoded as a list of `Record` objects (with `__slots__`, so without
+a dict per citizen) and a map from citizen_id to its slot in the list. Every entry carries the version stamp
+of the import it was loaded at, and is used only if the stamp just read from MongoDB is the same,
+so a worker never serves data older than the last acknowledged write of any worker.
+
+The total size of the entries is estimated from the sizes of the records and their values, and updated when
+a patch is applied, least recently used imports are evicted first when it exceeds `max_bytes`.
+"""
+import sys
+from collections import Counter, OrderedDict
+
+from journal import apply_patch
+
+FIELDS = ("citizen_id", "town", "street", "building", "apartment", "name", "birth_date", "gender", "relatives")
+
+
+class Record:
+    """Citizen of a hot import, supports the item access of a citizen dict used by `journal.apply_patch`"""
+    __slots__ = FIELDS
+
+    def __init__(self, citizen):
+        for f in FIELDS:
+            setattr(self, f, citizen[f])
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        setattr(self, field, value)
+
+    def update(self, fields):
+        for k, v in fields.items():
+            setattr(self, k, v)
+
+    def to_dict(self):
+        c = {f: getattr(self, f) for f in FIELDS}
+        c['relatives'] = list(self.relatives)
+        return c
+
+    def size(self):
+        return sys.getsizeof(self) + sum(sys.getsizeof(getattr(self, f)) for f in FIELDS)
+
+
+class HotImport:
+    """Citizens of one import version, a mapping citizen_id -> Record"""
+
+    def __init__(self, stamp, citizens):
+        self.stamp = stamp
+        self.records = [Record(c) for c in citizens]
+        self.slots = {r.citizen_id: i for i, r in enumerate(self.records)}
+        self.size = self.measure()
+
+    def measure(self):
+        return sys.getsizeof(self.records) + sys.getsizeof(self.slots) + sum(r.size() for r in self.records)
+
+    def __getitem__(self, citizen_id):
+        return self.records[self.slots[citizen_id]]
+
+    def __contains__(self, citizen_id):
+        return citizen_id in self.slots
+
+    def __len__(self):
+        return len(self.records)
+
+    def citizens(self):
+        return [r.to_dict() for r in self.records]
+
+    def batches(self, fields, batch_size):
+        """Yields citizens with `fields` and citizen_id in batches, as `iter_citizens` does"""
+        fields = set(fields) | {"citizen_id"}
+        for start in range(0, len(self.records), batch_size):
+            yield [{f: getattr(r, f) for f in fields} for r in self.records[start:start + batch_size]]
+
+
+class WorkingSet:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        # import_id -> HotImport, least recently used first
+        self.imports = OrderedDict()
+        self.stats = Counter()
+
+    def get(self, import_id, stamp):
+        """Returns the import if it is in the working set at `stamp`, a stale entry is dropped"""
+        hot = self.imports.get(import_id)
+        if hot is None:
+            self.stats["working_set.misses"] += 1
+            return None
+        if hot.stamp != stamp:
+            self.stats["working_set.stale"] += 1
+            self.drop(import_id)
+            return None
+        self.imports.move_to_end(import_id)
+        self.stats["working_set.hits"] += 1
+        return hot
+
+    def put(self, import_id, stamp, citizens):
+        """Adds the import at `stamp`, returns it even if it does not fit into the working set"""
+        hot = HotImport(stamp, citizens)
+        self.drop(import_id)
+        if hot.size > self.max_bytes:
+            self.stats["working_set.too_large"] += 1
+            return hot
+
+        self.imports[import_id] = hot
+        self.bytes += hot.size
+        self.stats["working_set.loaded"] += 1
+        self.evict()
+        return hot
+
+    def patch(self, import_id, citizen_id, fields):
+        """Applies the patch to the import, the size is updated by the size change of the patched records"""
+        hot = self.imports[import_id]
+        patched = {citizen_id} | set(hot[citizen_id].relatives) | set(fields.get('relatives', ()))
+        records = [hot[i] for i in patched if i in hot]
+        before = sum(r.size() for r in records)
+        apply_patch(hot, citizen_id, fields)
+        delta = sum(r.size() for r in records) - before
+        hot.size += delta
+        self.bytes += delta
+        self.stats["working_set.patched"] += 1
+        self.evict()
+
+    def apply_diff(self, import_id, stamp, new_stamp, removed, changed, added):
+        """Applies a replace of the import at `stamp` (see diff.diff_citizens), an entry at another stamp is dropped"""
+        hot = self.imports.get(import_id)
+        if hot is None:
+            return
+        if hot.stamp != stamp:
+            self.drop(import_id)
+            return
+        for citizen_id, fields in changed.items():
+            hot[citizen_id].update(fields)
+        removed = set(removed)
+        hot.records = [r for r in hot.records if r.citizen_id not in removed]
+        hot.records.extend(Record(c) for c in added)
+        hot.slots = {r.citizen_id: i for i, r in enumerate(hot.records)}
+        hot.stamp = new_stamp
+
+        size = hot.measure()
+        self.bytes += size - hot.size
+        hot.size = size
+        self.stats["working_set.replaced"] += 1
+        self.evict()
+
+    def evict(self):
+        while self.bytes > self.max_bytes:
+            _, evicted = self.imports.popitem(last=False)
+            self.bytes -= evicted.size
+            self.stats["working_set.evicted"] += 1
+
+    def drop(self, import_id):
+        hot = self.imports.pop(import_id, None)
+        if hot is not None:
+            self.bytes -= hot.size
+
+    def clear(self):
+        self.imports.clear()
+        self.bytes = 0
+
+    def get_stats(self):
+        result = dict(self.stats)
+        result["working_set.imports"] = len(self.imports)
+        result["working_set.bytes"] = self.bytes
+        return result